@@ -1,33 +1,114 @@
 """
 API functions
 """
+import base64
+import binascii
+import datetime
+import functools
+import hashlib
+import json
+import time
+import types
 import typing
 from typing import List, Optional
 
-from db import models
+from config import config
+from db import models, replica, schemas
+from db.activity import activity_buffer, write_records
+from db.user_cache import user_cache
 from fastapi import Query, Request
+from fastapi.exceptions import HTTPException
 from fastapi_jwt_auth import AuthJWT
+from pony.orm import desc, flush, select
+from pony.orm.core import Query as PonyQuery
 from pydantic import BaseModel, Field
+from utils.cache import TTLCache
+from utils.stats import Histogram
+
+# verified claims by token hash, an entry never outlives the token exp
+jwt_cache = TTLCache(
+    max_size=config.get('JWT_CACHE_SIZE', cast=int, default=10000),
+    ttl=config.get('JWT_CACHE_SECONDS', cast=float, default=300.0),
+)
+jwt_decode_time = Histogram()
+# users allowed on /api/admin/, user search and export, comma separated
+ADMIN_EMAILS = frozenset(
+    email.strip()
+    for email in config.get('ADMIN_EMAILS', default='').split(',')
+    if email.strip()
+)
 
 
 def create_user_record(user: models.User):
-    """Update login time and create new user active record"""
-    record = models.UserActivieRecord(
-        user=user
-    )
-    user.last_login_time = record.created_at
+    """
+    Update login time and create new user active record
+    Notes:
+        Must run inside db_executor.run
+    """
+    user.last_login_time = datetime.datetime.now()
+    # new user needs id before the raw insert
+    flush()
+    write_records([(user.id, user.last_login_time)])
+
+
+class CachedAuthJWT(AuthJWT):
+    """
+    AuthJWT which decodes and verifies each token once,
+    CSRF double submit and denylist checks still run on every request
+    Examples:
+        async def profile(authorize: AuthJWT = Depends(CachedAuthJWT)):
+            pass
+    """
+
+    def _verified_token(
+            self,
+            encoded_token: str,
+            issuer: Optional[str] = None,
+    ) -> dict:
+        """Claims from jwt_cache or verified by AuthJWT"""
+        key = (hashlib.sha256(encoded_token.encode()).digest(), issuer)
+        claims = jwt_cache.get(key, None)
+        if claims is not None:
+            return dict(claims)
+        started_at = time.perf_counter()
+        claims = super()._verified_token(encoded_token, issuer)
+        jwt_decode_time.observe(time.perf_counter() - started_at)
+        ttl = jwt_cache.ttl
+        if 'exp' in claims:
+            ttl = min(ttl, claims['exp'] - time.time())
+        if ttl > 0:
+            jwt_cache.set(key, dict(claims), ttl=ttl)
+        return claims
+
+
+def jwt_cache_stats() -> dict:
+    """
+    Returns:
+        jwt_cache stats, decode time and the decode time saved by hits
+    """
+    decode_time = jwt_decode_time.snapshot()
+    mean = 0.0
+    if decode_time['count']:
+        mean = decode_time['sum'] / decode_time['count']
+    stats = jwt_cache.stats()
+    return {
+        **stats,
+        'decode_time': decode_time,
+        'saved_seconds': round(stats['hits'] * mean, 6),
+    }
 
 
 def update_user_from_jwt(authorize: AuthJWT):
     """
     Update user by authorize.get_jwt_subject()
-    get user then update user.last_login_time
+    get user then queue the hit to activity_buffer,
+    user.last_login_time is updated when the buffer flushes
     Args:
          authorize: AuthJWT
     Returns:
         User or None
     Notes:
-        Each api can only use db_session once
+        Must run inside db_executor.run
     Raises:
         Status code 422 from authorize.jwt_required()
     """
@@ -35,11 +116,63 @@ def update_user_from_jwt(authorize: AuthJWT):
     email = authorize.get_jwt_subject()
     user = models.User.get(email=email, deleted=False)
     if user:
-        create_user_record(user)
+        activity_buffer.record(user.id)
 
     return user
 
 
+async def get_current_user(
+        authorize: AuthJWT,
+) -> typing.Optional[schemas.UserSnapshot]:
+    """
+    Same as update_user_from_jwt but from user_cache,
+    no db round trip while the snapshot is cached
+    Args:
+         authorize: AuthJWT
+    Returns:
+        UserSnapshot or None
+    Raises:
+        Status code 422 from authorize.jwt_required()
+    """
+    authorize.jwt_required()
+    email = authorize.get_jwt_subject()
+    # read-your-writes after the user's own update
+    if replica.is_sticky(email):
+        replica.pin_primary()
+    user = await user_cache.get(email)
+    if user:
+        activity_buffer.record(user.id)
+
+    return user
+
+
+async def get_required_user(authorize: AuthJWT) -> schemas.UserSnapshot:
+    """
+    get_current_user for routes which need a live user
+    Raises:
+        Status code 422 from authorize.jwt_required()
+        HTTPException(401) when the user is deleted or gone
+    """
+    user = await get_current_user(authorize)
+    if not user:
+        raise HTTPException(status_code=401, detail='User not found')
+    return user
+
+
+async def get_admin_user(authorize: AuthJWT) -> schemas.UserSnapshot:
+    """
+    get_required_user limited to ADMIN_EMAILS
+    Raises:
+        Status code 422 from authorize.jwt_required()
+        HTTPException(401) when the user is deleted or gone
+        HTTPException(403) for other users
+    """
+    user = await get_required_user(authorize)
+    if user.email not in ADMIN_EMAILS:
+        raise HTTPException(status_code=403, detail='Admin only')
+    return user
+
+
 class Pagination:
     """
     from fastapi conrtib to get it
@@ -55,8 +188,8 @@ class Pagination:
         @app.get("/")
         async def list(pagination: Pagination = Depends()):
             filter_kwargs = {}
-            return await pagination.paginate(
-                serializer_class=SomeSerializer, **filter_kwargs
+            return await db_executor.run(
+                pagination.paginate, SomeModel.select(**filter_kwargs)
             )
     Subclass this pagination to define custom
     default & maximum values for offset & limit:
@@ -66,9 +199,17 @@ class Pagination:
             default_limit = 1
             max_offset = 100`
             max_limit = 2000
+    Cursor mode, pass `cursor` (empty for the first page) instead of offset,
+    pages are ordered by indexed (created_at, id) and `next`/`previous`
+    carry opaque cursors, so deep pages cost the same as the first one:
+    .. code-block:: python
+        GET /api/user/?cursor=&limit=100
+        GET /api/user/?cursor=WyIyMDIx...&limit=100
     :param request: starlette Request object
     :param offset: query param of how many records to skip
     :param limit: query param of how many records to show
+    :param cursor: query param of cursor mode, opaque page cursor
+    :param with_count: query param, count total records in cursor mode
     """
 
     default_offset = 0
@@ -81,10 +222,20 @@ class Pagination:
             request: Request,
             offset: int = Query(default=default_offset, ge=0, le=max_offset),
             limit: int = Query(default=default_limit, ge=1, le=max_limit),
+            cursor: Optional[str] = Query(
+                default=None,
+                description='Cursor mode, empty for the first page'
+            ),
+            with_count: bool = Query(
+                default=False,
+                description='Count total records in cursor mode'
+            ),
     ):
         self.request = request
         self.offset = offset
         self.limit = limit
+        self.cursor = cursor
+        self.with_count = with_count
         self.model = None
         self.count = None
         self.list = []
@@ -130,38 +281,224 @@ class Pagination:
             )
         )
 
-    async def paginate(
+    @staticmethod
+    def encode_cursor(row, forward: bool) -> str:
+        """
+        Build opaque cursor from a row
+        :return: urlsafe base64 of [created_at, id, forward]
+        """
+        key = [row.created_at.isoformat(), row.id, forward]
+        raw = json.dumps(key, separators=(',', ':')).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> typing.Tuple[
+        typing.Optional[typing.Tuple[datetime.datetime, int]], bool
+    ]:
+        """
+        Parse cursor from encode_cursor
+        :return: ((created_at, id) or None for first page, forward)
+        """
+        if not cursor:
+            return None, True
+        try:
+            padding = '=' * (-len(cursor) % 4)
+            created_at, id_, forward = json.loads(
+                base64.urlsafe_b64decode(cursor + padding)
+            )
+            key = datetime.datetime.fromisoformat(created_at), int(id_)
+        except (binascii.Error, TypeError, ValueError) as exc:
+            raise HTTPException(
+                status_code=422, detail='Invalid cursor'
+            ) from exc
+        return key, bool(forward)
+
+    def get_cursor_url(self, cursor: str) -> str:
+        """
+        :return: URL of the page at cursor
+        """
+        url = self.request.url.remove_query_params(keys=['offset'])
+        return str(url.include_query_params(limit=self.limit, cursor=cursor))
+
+    def paginate_cursor(
+            self,
+            query: PonyQuery,
+            fields: typing.Optional[typing.Sequence[str]] = None,
+    ) -> dict:
+        """
+        Keyset pagination over (created_at, id), must run inside db_session
+        :param query: entity query with created_at and id
+        :param fields: see paginate
+        :return: dict that should be returned as a response
+        """
+        key, forward = self.decode_cursor(self.cursor)
+        self.count = query.count() if self.with_count else None
+        if key is not None:
+            created_at, id_ = key
+            # row comparison, an index range condition on (created_at, id)
+            if forward:
+                query = query.filter(
+                    lambda x: (x.created_at, x.id) > (created_at, id_)
+                )
+            else:
+                query = query.filter(
+                    lambda x: (x.created_at, x.id) < (created_at, id_)
+                )
+        if forward:
+            query = query.order_by(lambda x: (x.created_at, x.id))
+        else:
+            query = query.order_by(
+                lambda x: (desc(x.created_at), desc(x.id))
+            )
+        if fields is None:
+            rows = query[:self.limit + 1]
+        else:
+            # cursors need the key, read after the fields
+            columns = tuple(fields) + tuple(
+                column for column in ('created_at', 'id')
+                if column not in fields
+            )
+            rows = select_columns(query, columns)[:self.limit + 1]
+        has_more = len(rows) > self.limit
+        rows = list(rows[:self.limit])
+        if not forward:
+            rows.reverse()
+
+        def key_row(row):
+            """row with created_at and id attributes"""
+            if fields is None:
+                return row
+            return types.SimpleNamespace(**dict(zip(columns, row)))
+
+        next_url = previous_url = None
+        if rows:
+            if (forward and has_more) or not forward:
+                next_url = self.get_cursor_url(
+                    self.encode_cursor(key_row(rows[-1]), True)
+                )
+            if (not forward and has_more) or (forward and key is not None):
+                previous_url = self.get_cursor_url(
+                    self.encode_cursor(key_row(rows[0]), False)
+                )
+        return {
+            'count': self.count,
+            'next': next_url,
+            'previous': previous_url,
+            'data': rows if fields is None else project(rows, fields),
+        }
+
+    def paginate(
             self,
-            query: Query
+            query: PonyQuery,
+            fields: typing.Optional[typing.Sequence[str]] = None,
     ) -> dict:
         """
-        Actual pagination function, takes serializer class,
+        Actual pagination function, must run inside db_session,
+        takes serializer class,
         filter options as kwargs and returns dict with the following fields:
             * count - counts for query list, filtered by kwargs
             * next - URL for next "page" of paginated results
             * previous - URL for previous "page" of paginated results
             * result - actual list of records (dicts)
         :param query:
+        :param fields: two or more attribute names, records are dicts of
+            them read as column tuples, no entity is built
         :return: dict that should be returned as a response
         """
+        if self.cursor is not None:
+            return self.paginate_cursor(query, fields)
         self.count = query.count()
+        if fields is None:
+            data = query.limit(self.limit, offset=self.offset)[:]
+        else:
+            data = project(
+                select_columns(query, fields).limit(
+                    self.limit, offset=self.offset
+                ),
+                fields,
+            )
         return {
             'count': self.count,
             'next': self.get_next_url(),
             'previous': self.get_previous_url(),
-            'data': query.limit(self.limit, offset=self.offset)[:],
+            'data': data,
         }
 
 
+class CursorPagination(Pagination):
+    """
+    Pagination in cursor mode only, no offset and no total count
+    For filtered queries where deep offsets or counting every match
+    would cost more than the page itself
+    """
+
+    def __init__(
+            self,
+            request: Request,
+            limit: int = Query(
+                default=Pagination.default_limit,
+                ge=1,
+                le=Pagination.max_limit,
+            ),
+            cursor: str = Query(
+                default='', description='Page cursor, empty for the first page'
+            ),
+    ):
+        super().__init__(
+            request, offset=0, limit=limit, cursor=cursor, with_count=False
+        )
+
+
+def select_columns(
+        query: PonyQuery,  # pylint: disable=unused-argument
+        columns: typing.Sequence[str],
+):
+    """
+    Tuple query of entity attributes, filters and order of query are kept
+    Args:
+        query: entity query
+        columns: two or more attribute names
+    Returns:
+        Pony query of tuples
+    """
+    if len(columns) < 2 or not all(
+            column.isidentifier() for column in columns
+    ):
+        raise ValueError(f'Bad columns: {columns}')
+    attributes = ', '.join(f'x.{column}' for column in columns)
+    # Pony translates the text with the names of this frame (query)
+    return select(f'({attributes}) for x in query')
+
+
+def project(
+        rows: typing.Iterable[tuple],
+        fields: typing.Sequence[str],
+) -> List[dict]:
+    """
+    Column tuples into dicts, no pydantic validation
+    Args:
+        rows: tuples of select_columns, extra trailing columns are dropped
+        fields: names of the leading columns
+    Returns:
+        list of dict for FastJSONResponse
+    """
+    return [dict(zip(fields, row)) for row in rows]
+
+
+@functools.lru_cache(maxsize=None)
 def get_pagination_schema(schema) -> typing.Union[type, BaseModel]:
     """Generate Pagination schema
+    Notes:
+        One class per schema, openapi fails on two models of the same name
     Returns:
         PageModel
     """
 
     class PageModel(BaseModel):
         """Response Schema for Pagination"""
-        count: int = Field(..., description='total count')
+        count: Optional[int] = Field(
+            ..., description='total count, null in cursor mode by default'
+        )
         next: Optional[str] = Field(None, description='next page')
         previous: Optional[str] = Field(None, description='previous page')
         data: List[schema] = Field(
@@ -0,0 +1,90 @@
+"""
+Admin api, users in ADMIN_EMAILS only
+"""
+import asyncio
+
+from api.deps import CachedAuthJWT, get_admin_user
+from api.responses import FastJSONResponse
+from api.route_handler import ACCESS_TOKEN, init_router_with_log, jwt_cookie
+from db import batch, schemas
+from db.executor import db_executor
+from db.user_cache import user_cache
+from fastapi import Depends
+from fastapi_jwt_auth import AuthJWT
+
+router = init_router_with_log()
+
+
+async def run_batch(action: str, user_batch: schemas.UserBatch):
+    """
+    Run batch.run in one db transaction then drop changed users from cache
+    Returns:
+        UserBatchResponse
+    """
+    results, changed_emails = await db_executor.run(
+        batch.run, action, user_batch.emails, user_batch.ids
+    )
+    await asyncio.gather(
+        *(user_cache.invalidate(email) for email in changed_emails)
+    )
+    return FastJSONResponse({'results': results})
+
+
+@router.post(
+    '/users/lookup/',
+    name='Batch lookup users',
+    response_model=schemas.UserBatchResponse
+)
+@jwt_cookie(ACCESS_TOKEN)
+async def lookup_users(
+        user_batch: schemas.UserBatch,
+        authorize: AuthJWT = Depends(CachedAuthJWT),
+):
+    """
+    Users by emails and/or ids, deleted ones included \\n
+    Raises: \\n
+        403 -> not an admin \\n
+    """
+    await get_admin_user(authorize)
+    results, _ = await db_executor.read(
+        batch.run, 'lookup', user_batch.emails, user_batch.ids
+    )
+    return FastJSONResponse({'results': results})
+
+
+@router.post(
+    '/users/verify/',
+    name='Batch verify users',
+    response_model=schemas.UserBatchResponse
+)
+@jwt_cookie(ACCESS_TOKEN)
+async def verify_users(
+        user_batch: schemas.UserBatch,
+        authorize: AuthJWT = Depends(CachedAuthJWT),
+):
+    """
+    Mark users verified, deleted users are left alone \\n
+    Raises: \\n
+        403 -> not an admin \\n
+    """
+    await get_admin_user(authorize)
+    return await run_batch('verify', user_batch)
+
+
+@router.post(
+    '/users/delete/',
+    name='Batch soft delete users',
+    response_model=schemas.UserBatchResponse
+)
+@jwt_cookie(ACCESS_TOKEN)
+async def delete_users(
+        user_batch: schemas.UserBatch,
+        authorize: AuthJWT = Depends(CachedAuthJWT),
+):
+    """
+    Soft delete users, sets deleted and deleted_at \\n
+    Raises: \\n
+        403 -> not an admin \\n
+    """
+    await get_admin_user(authorize)
+    return await run_batch('delete', user_batch)
@@ -1,42 +1,59 @@
 """
 Auth api
 """
+import datetime
 from urllib.parse import urljoin
 
-from api.deps import create_user_record, update_user_from_jwt
-from api.route_handler import init_router_with_log
-from authlib.integrations.starlette_client import OAuth
+import httpx
+from api.deps import CachedAuthJWT, create_user_record, get_current_user
+from api.route_handler import (ACCESS_TOKEN, REFRESH_TOKEN,
+                                init_router_with_log, jwt_cookie,
+                                session_cookie)
 from config import config
 from db import models, schemas
+from db.executor import db_executor
+from db.user_cache import user_cache
 from fastapi import Depends, Request
 from fastapi.exceptions import HTTPException
 from fastapi.responses import RedirectResponse
 from fastapi_jwt_auth import AuthJWT
-from starlette.config import Config
+from utils import encrypt, oauth, timing
+from utils.admission import (AUTH_CONCURRENCY, AUTH_RATE_PER_EMAIL,
+                             AUTH_RATE_PER_IP, admission)
+from utils.hasher import password_hasher
+from utils.http import BREAKER_RESET_SECONDS, CircuitOpen
 
 router = init_router_with_log()
 
-config_data = {
-    'GOOGLE_CLIENT_ID': config.get('GOOGLE_CLIENT_ID'),
-    'GOOGLE_CLIENT_SECRET': config.get('GOOGLE_CLIENT_SECRET'),
-    'FACEBOOK_CLIENT_ID': config.get('FACEBOOK_CLIENT_ID'),
-    'FACEBOOK_CLIENT_SECRET': config.get('FACEBOOK_CLIENT_SECRET'),
-}
-starlette_config = Config(environ=config_data)
-oauth = OAuth(starlette_config)
-google_url = 'https://accounts.google.com/.well-known/openid-configuration'
-oauth.register(
-    name='google',
-    server_metadata_url=google_url,
-    client_kwargs={'scope': 'openid email profile'},
-)
-oauth.register(
-    name='facebook',
-    api_base_url='https://graph.facebook.com/v7.0/',
-    access_token_url='https://graph.facebook.com/v7.0/oauth/access_token',
-    authorize_url='https://www.facebook.com/v7.0/dialog/oauth',
-    client_kwargs={'scope': 'email public_profile'},
-)
+
+async def oauth_user_data(
+        provider: oauth.OAuthProvider,
+        request: Request,
+        redirect_uri: str,
+) -> dict:
+    """
+    Finish the authorization code flow of provider
+    Returns:
+        oauth user info with email and name
+    Raises:
+        HTTPException(401) for a callback which can not be trusted
+        HTTPException(503) when the provider can not be reached
+    """
+    try:
+        with timing.span('http'):
+            token = await provider.exchange(request, redirect_uri)
+            user_data = await provider.user_info(request, token)
+    except oauth.OAuthError as exc:
+        raise HTTPException(status_code=401, detail=str(exc)) from exc
+    except (CircuitOpen, httpx.HTTPError) as exc:
+        raise HTTPException(
+            status_code=503,
+            detail=f'{provider.name} is unavailable',
+            headers={'Retry-After': str(int(BREAKER_RESET_SECONDS))},
+        ) from exc
+    if not user_data.get('email'):
+        raise HTTPException(status_code=401, detail='No email granted')
+    return user_data
 
 
 @AuthJWT.load_config
@@ -49,44 +66,72 @@ def get_config():
     return schemas.Settings()
 
 
+def get_or_signup_oauth_user(user_data: dict, register_from: int):
+    """
+    Get user or signup a user from oauth user data
+    Args:
+        user_data: oauth user info with email and name
+        register_from: 2: facebook|3: google
+    Notes:
+        Must run inside db_executor.run
+    """
+    user = models.User.get(email=user_data['email'])
+    if not user:
+        user = models.User(
+            email=user_data['email'],
+            name=user_data['name'],
+            register_from=register_from,
+            verify=True,
+        )
+    else:
+        user.login_count += 1
+        # incremental exports pick changed rows by updated_at
+        user.updated_at = datetime.datetime.now()
+    create_user_record(user)
+
+
 @router.get('/login/google/', name='Google Auth login')
+@session_cookie
 async def google_login(request: Request):
     """Login with google auth"""
     redirect_uri = urljoin(
         config.get('BACKEND_BASE_URL'),
         '/api/auth/login/google/authorized/'
     )
-    return await oauth.google.authorize_redirect(request, redirect_uri)
+    try:
+        url = await oauth.google.authorization_url(request, redirect_uri)
+    except (oauth.OAuthError, CircuitOpen, httpx.HTTPError) as exc:
+        raise HTTPException(
+            status_code=503, detail='google is unavailable'
+        ) from exc
+    return RedirectResponse(url)
 
 
 @router.get(
     '/login/google/authorized/',
     name='Google Oauth authorized redirect'
 )
+@session_cookie
 async def google_login_authorized(
         request: Request,
-        authorize: AuthJWT = Depends()
+        authorize: AuthJWT = Depends(CachedAuthJWT)
 ):
     """
     Get google authorized \n
     Signup user if email is not found \n
     Create new acctess_token in cookie then redirect to frontent
     """
-    # get user from token
-    token = await oauth.google.authorize_access_token(request)
-    user_data = await oauth.google.parse_id_token(request, token)
-    # get user or signup a user
-    user = models.User.get(email=user_data['email'])
-    if not user:
-        user = models.User(
-            email=user_data['email'],
-            name=user_data['name'],
-            register_from=3,  # google
-            verify=True,
-        )
-    else:
-        user.login_count += 1
-    create_user_record(user)
+    redirect_uri = urljoin(
+        config.get('BACKEND_BASE_URL'),
+        '/api/auth/login/google/authorized/'
+    )
+    user_data = await oauth_user_data(oauth.google, request, redirect_uri)
+    await db_executor.run(
+        get_or_signup_oauth_user,
+        user_data,
+        register_from=3,  # google
+    )
+    await user_cache.invalidate(user_data['email'])
 
     access_token = authorize.create_access_token(subject=user_data['email'])
     refresh_token = authorize.create_refresh_token(subject=user_data['email'])
@@ -100,46 +145,42 @@ async def google_login_authorized(
 
 
 @router.get('/login/facebook/', name='Facebook Auth login')
+@session_cookie
 async def facebook_login(request: Request):
     """Login with facebook auth"""
     redirect_uri = urljoin(
         config.get('BACKEND_BASE_URL'),
         '/api/auth/login/facebook/authorized/'
     )
-    return await oauth.facebook.authorize_redirect(request, redirect_uri)
+    url = await oauth.facebook.authorization_url(request, redirect_uri)
+    return RedirectResponse(url)
 
 
 @router.get(
     '/login/facebook/authorized/',
     name='Facebook Oauth authorized redirect'
 )
+@session_cookie
 async def facebook_login_authorized(
         request: Request,
-        authorize: AuthJWT = Depends()
+        authorize: AuthJWT = Depends(CachedAuthJWT)
 ):
     """
     Get facebook authorized \n
     Signup user if email is not found \n
     Create new acctess_token in cookie then redirect to frontent
     """
-    # get user from token
-    token = await oauth.facebook.authorize_access_token(request)
-    res = await oauth.facebook.get('me?fields=name,email,picture', token=token)
-    user_data = res.json()
-
-    # # get user or signup a user
-    user = models.User.get(email=user_data['email'])
-    if not user:
-        user = models.User(
-            email=user_data['email'],
-            name=user_data['name'],
-            register_from=2,  # facebook
-            verify=True,
-        )
-    else:
-        user.login_count += 1
-
-    create_user_record(user)
+    redirect_uri = urljoin(
+        config.get('BACKEND_BASE_URL'),
+        '/api/auth/login/facebook/authorized/'
+    )
+    user_data = await oauth_user_data(oauth.facebook, request, redirect_uri)
+    await db_executor.run(
+        get_or_signup_oauth_user,
+        user_data,
+        register_from=2,  # facebook
+    )
+    await user_cache.invalidate(user_data['email'])
     access_token = authorize.create_access_token(subject=user_data['email'])
     refresh_token = authorize.create_refresh_token(subject=user_data['email'])
 
@@ -156,27 +197,61 @@ async def facebook_login_authorized(
     name='Login',
     response_model=schemas.MessageResponse
 )
+@admission(
+    AUTH_CONCURRENCY, per_ip=AUTH_RATE_PER_IP, per_email=AUTH_RATE_PER_EMAIL
+)
 async def login(
         user_login: schemas.UserLogin,
-        authorize: AuthJWT = Depends(),
+        authorize: AuthJWT = Depends(CachedAuthJWT),
 ):
     """
     Only for web login \n
     Raises: \n
         HttpExcetpion(401) for fail \n
     """
-    user = models.User.get(
-        email=user_login.email,
-        register_from=1,
-        verify=True,
-        deleted=False,
-    )
 
-    if not user or not user.check_password(user_login.password):
+    def get_user():
+        user = models.User.get(
+            email=user_login.email,
+            register_from=1,
+            verify=True,
+            deleted=False,
+        )
+        if not user:
+            return None
+        return user.id, user.salt, user.password
+
+    user_data = await db_executor.run(get_user)
+    if not user_data:
+        raise HTTPException(status_code=401, detail='Bad email or password')
+    user_id, salt, password = user_data
+    if not await password_hasher.check_password(
+            user_login.password, salt, password
+    ):
         raise HTTPException(status_code=401, detail='Bad email or password')
 
-    user.login_count += 1
-    create_user_record(user)
+    # upgrade old hash version while we have the raw password
+    new_password = None
+    if encrypt.needs_rehash(password):
+        new_password = await password_hasher.make_password(
+            user_login.password
+        )
+
+    def login_user():
+        # deleted while the password was checked
+        user = models.User.get(id=user_id, deleted=False)
+        if not user:
+            raise HTTPException(
+                status_code=401, detail='Bad email or password'
+            )
+        if new_password:
+            user.salt, user.password = new_password
+        user.login_count += 1
+        user.updated_at = datetime.datetime.now()
+        create_user_record(user)
+
+    await db_executor.run(login_user)
+    await user_cache.invalidate(user_login.email)
     access_token = authorize.create_access_token(subject=user_login.email)
     refresh_token = authorize.create_refresh_token(subject=user_login.email)
 
@@ -191,7 +266,8 @@ async def login(
     name='Refresh Token',
     response_model=schemas.MessageResponse
 )
-async def refresh(authorize: AuthJWT = Depends()):
+@jwt_cookie(REFRESH_TOKEN)
+async def refresh(authorize: AuthJWT = Depends(CachedAuthJWT)):
     """
     Refresh token by headers
     """
@@ -200,11 +276,15 @@ async def refresh(authorize: AuthJWT = Depends()):
     current_user = authorize.get_jwt_subject()
     access_token = authorize.create_access_token(subject=current_user)
     refresh_token = authorize.create_refresh_token(subject=current_user)
-    user = models.User.get(email=current_user, deleted=False)
-    # update user last_login_time
-    if not user:
-        raise HTTPException(status_code=404, detail='No found user')
-    create_user_record(user)
+
+    def refresh_user():
+        user = models.User.get(email=current_user, deleted=False)
+        # update user last_login_time
+        if not user:
+            raise HTTPException(status_code=404, detail='No found user')
+        create_user_record(user)
+
+    await db_executor.run(refresh_user)
 
     # Set the JWT cookies in the response
     authorize.set_access_cookies(access_token)
@@ -217,12 +297,13 @@ async def refresh(authorize: AuthJWT = Depends()):
     name='Logout',
     response_model=schemas.MessageResponse
 )
-async def logout(authorize: AuthJWT = Depends()):
+@jwt_cookie(ACCESS_TOKEN)
+async def logout(authorize: AuthJWT = Depends(CachedAuthJWT)):
     """
     Because the JWT are stored in an httponly cookie now, we cannot \n
     log the user out by simply deleting the cookies in the frontend. \n
     We need the backend to send us a response to delete the cookies.
     """
-    update_user_from_jwt(authorize)
+    await get_current_user(authorize)
     authorize.unset_jwt_cookies()
     return {'msg': 'Successfully logout'}
@@ -2,22 +2,34 @@
 Usr api
 """
 import datetime
+import typing
 import uuid
 from urllib.parse import urljoin
 
-from api.deps import (Pagination, create_user_record, get_pagination_schema,
+from api.deps import (CachedAuthJWT, CursorPagination, Pagination,
+                      create_user_record, get_admin_user, get_current_user,
+                      get_pagination_schema, get_required_user,
                       update_user_from_jwt)
-from api.route_handler import init_router_with_log
+from api.responses import FastJSONResponse
+from api.route_handler import (ACCESS_TOKEN, init_router_with_log,
+                               jwt_cookie)
 from config import config
-from db import models, schemas
-from fastapi import Depends
+from db import export, models, schemas, search
+from db.executor import db_executor
+from db.statistics import statistics_cache
+from db.user_cache import user_cache
+from fastapi import Depends, Query
 from fastapi.exceptions import HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi_jwt_auth import AuthJWT
-from pony.orm import count, select
-from utils import encrypt, mail
+from utils import mail
+from utils.admission import (AUTH_CONCURRENCY, AUTH_RATE_PER_EMAIL,
+                             AUTH_RATE_PER_IP, admission)
+from utils.hasher import password_hasher
 
 router = init_router_with_log()
+# read as column tuples for list responses
+USER_FIELDS = tuple(schemas.UserResponse.__fields__)
 
 
 @router.get(
@@ -25,15 +37,16 @@ router = init_router_with_log()
     name='Self User profile',
     response_model=schemas.UserResponse
 )
+@jwt_cookie(ACCESS_TOKEN)
 async def profile(
-        authorize: AuthJWT = Depends(),
+        authorize: AuthJWT = Depends(CachedAuthJWT),
 ):
     """
     Get self user profile \n
     Raises: \n
         raise 404 -> Not found \n
     """
-    user = update_user_from_jwt(authorize)
+    user = await get_current_user(authorize)
     if not user:
         raise HTTPException(status_code=404, detail='Not found user')
     return user
@@ -44,14 +57,112 @@ async def profile(
     name='Get All users',
     response_model=get_pagination_schema(schemas.UserResponse),
 )
+@jwt_cookie(ACCESS_TOKEN)
 async def get_users(
         page: Pagination = Depends(),
-        authorize: AuthJWT = Depends(),
+        authorize: AuthJWT = Depends(CachedAuthJWT),
 ):
-    """Get all users"""
-    update_user_from_jwt(authorize)
-    query = models.User.select()
-    return await page.paginate(query)
+    """
+    Get all users \n
+    Columns are read into dicts directly, response_model is kept for docs
+    """
+
+    await get_required_user(authorize)
+
+    def get_page():
+        return page.paginate(models.User.select(), fields=USER_FIELDS)
+
+    return FastJSONResponse(await db_executor.read(get_page))
+
+
+@router.get(
+    '/search/',
+    name='Search users',
+    response_model=get_pagination_schema(schemas.UserResponse),
+)
+@jwt_cookie(ACCESS_TOKEN)
+async def search_users(
+        q: str = Query(
+            ...,
+            min_length=search.USER_SEARCH_MIN_LENGTH,
+            max_length=100,
+            description='Part of email or name, case-insensitive'
+        ),
+        mode: str = Query(
+            'contains',
+            regex='^(prefix|contains)$',
+            description='prefix or contains'
+        ),
+        include_deleted: bool = Query(
+            False, description='Also match deleted users'
+        ),
+        page: CursorPagination = Depends(),
+        authorize: AuthJWT = Depends(CachedAuthJWT),
+):
+    """
+    Find users by email or name \n
+    Pages by cursor in created_at order, `count` stops at
+    USER_SEARCH_MAX_COUNT (1000 by default) \n
+    Raises: \n
+        403 -> not an admin \n
+    """
+    await get_admin_user(authorize)
+    term = q.strip().lower()
+    if len(term) < search.USER_SEARCH_MIN_LENGTH:
+        raise HTTPException(status_code=422, detail='Search term is too short')
+
+    def get_page():
+        query = search.match_users(term, mode, include_deleted)
+        data = page.paginate(query, fields=USER_FIELDS)
+        data['count'] = search.capped_count(query)
+        return data
+
+    return FastJSONResponse(await db_executor.read(get_page))
+
+
+@router.get(
+    '/export/',
+    name='Export users or activity records',
+    response_class=StreamingResponse,
+)
+@jwt_cookie(ACCESS_TOKEN)
+async def export_rows(
+        table: str = Query(
+            'users',
+            regex='^(users|records)$',
+            description='users or records(UserActivieRecord)'
+        ),
+        file_format: str = Query(
+            'ndjson',
+            alias='format',
+            regex='^(ndjson|csv)$',
+            description='ndjson or csv'
+        ),
+        since: typing.Optional[datetime.datetime] = Query(
+            None,
+            description='Only rows created or updated after since'
+        ),
+        authorize: AuthJWT = Depends(CachedAuthJWT),
+):
+    """
+    Stream the whole table for analytics jobs \n
+    Memory stays flat whatever the table size \n
+    Raises: \n
+        403 -> not an admin \n
+        503 -> no database connection is free \n
+    """
+    await get_admin_user(authorize)
+    chunks = await export.prefetch(
+        export.iter_export(table, file_format, since)
+    )
+    return StreamingResponse(
+        chunks,
+        media_type=export.MEDIA_TYPES[file_format],
+        headers={
+            'Content-Disposition':
+                f'attachment; filename="{table}.{file_format}"'
+        },
+    )
 
 
 @router.post(
@@ -59,28 +170,47 @@ async def get_users(
     name='Reset password',
     response_model=schemas.MessageResponse
 )
+@jwt_cookie(ACCESS_TOKEN)
+@admission(AUTH_CONCURRENCY, per_ip=AUTH_RATE_PER_IP)
 async def reset_password(
         user_reset_password: schemas.UserResetPassword,
-        authorize: AuthJWT = Depends(),
+        authorize: AuthJWT = Depends(CachedAuthJWT),
 ):
     """
     User reset password \n
     Raises: \n
         422 -> password is not correct \n
+        401 -> user is deleted \n
     """
-    user = update_user_from_jwt(authorize)
-    if user.register_from != 1:
-        raise HTTPException(
-            status_code=422,
-            detail='Signup is not using password'
-        )
-    if not user.check_password(user_reset_password.old_password):
+
+    def get_password():
+        user = update_user_from_jwt(authorize)
+        if not user:
+            raise HTTPException(status_code=401, detail='User not found')
+        if user.register_from != 1:
+            raise HTTPException(
+                status_code=422,
+                detail='Signup is not using password'
+            )
+        return user.id, user.email, user.salt, user.password
+
+    user_id, email, salt, password = await db_executor.run(get_password)
+    if not await password_hasher.check_password(
+            user_reset_password.old_password, salt, password
+    ):
         raise HTTPException(status_code=422, detail='Password is not correct')
-    salt = encrypt.get_salt()
-    hash_password = encrypt.get_hash(user_reset_password.new_password, salt)
-    user.salt = encrypt.transfter_salt_to_str(salt)
-    user.password = hash_password
-    user.updated_at = datetime.datetime.now()
+    new_salt, new_password = await password_hasher.make_password(
+        user_reset_password.new_password
+    )
+
+    def update_password():
+        user = models.User[user_id]
+        user.salt = new_salt
+        user.password = new_password
+        user.updated_at = datetime.datetime.now()
+
+    await db_executor.run(update_password)
+    await user_cache.invalidate(email)
     return {'msg': 'success'}
 
 
@@ -89,18 +219,28 @@ async def reset_password(
     name='update self user',
     response_model=schemas.MessageResponse
 )
+@jwt_cookie(ACCESS_TOKEN)
 async def update_self_user(
         user_update: schemas.UserUpdate,
-        authorize: AuthJWT = Depends(),
+        authorize: AuthJWT = Depends(CachedAuthJWT),
 ):
     """
     Uupdate suer user \n
     Raises: \n
         422 -> password is not correct \n
+        401 -> user is deleted \n
     """
-    user = update_user_from_jwt(authorize)
-    user.name = user_update.name
-    user.updated_at = datetime.datetime.now()
+
+    def update_user():
+        user = update_user_from_jwt(authorize)
+        if not user:
+            raise HTTPException(status_code=401, detail='User not found')
+        user.name = user_update.name
+        user.updated_at = datetime.datetime.now()
+        return user.email
+
+    email = await db_executor.run(update_user)
+    await user_cache.invalidate(email)
     return {'msg': 'success'}
 
 
@@ -109,31 +249,53 @@ async def update_self_user(
     name='Signup',
     response_model=schemas.MessageResponse
 )
+@admission(
+    AUTH_CONCURRENCY, per_ip=AUTH_RATE_PER_IP, per_email=AUTH_RATE_PER_EMAIL
+)
 async def signup(
         usersignup: schemas.UserSignup
 ):
-    """User Signup"""
-    salt = encrypt.get_salt()
-    hash_password = encrypt.get_hash(usersignup.password, salt)
+    """
+    User Signup \n
+    Raises: \n
+        422 -> email is register \n
+    """
+
+    def email_exists():
+        return models.User.exists(email=usersignup.email)
+
+    # no hashing for a taken email, create_user checks again on primary
+    if await db_executor.read(email_exists):
+        raise HTTPException(status_code=422, detail='Email is register')
+    salt, hash_password = await password_hasher.make_password(
+        usersignup.password
+    )
     verify_id = str(uuid.uuid4())
     verify_url = urljoin(
         config.get('FRONTEND_BASE_URL'),
         f'/user/verify/{verify_id}'
     )
-    models.User(
-        email=usersignup.email,
-        name=usersignup.name,
-        register_from=1,
-        password=hash_password,
-        salt=encrypt.transfter_salt_to_str(salt),
-        verify=False,
-        verify_id=verify_id
-    )
-    mail.send_email(
-        to=usersignup.email,
-        subject='Verify your account',
-        message=f'link: {verify_url}'
-    )
+
+    def create_user():
+        if models.User.exists(email=usersignup.email):
+            raise HTTPException(status_code=422, detail='Email is register')
+        models.User(
+            email=usersignup.email,
+            name=usersignup.name,
+            register_from=1,
+            password=hash_password,
+            salt=salt,
+            verify=False,
+            verify_id=verify_id
+        )
+        mail.enqueue_email(
+            to=usersignup.email,
+            subject='Verify your account',
+            message=f'link: {verify_url}'
+        )
+
+    await db_executor.run(create_user)
+    mail.email_dispatcher.wake()
     return {
         'msg': 'Please go to receive email to verify account'
     }
@@ -146,20 +308,28 @@ async def signup(
 )
 async def verify(
         verify_id: str,
-        authorize: AuthJWT = Depends(),
+        authorize: AuthJWT = Depends(CachedAuthJWT),
 ):
     """Verify by id"""
-    user = models.User.get(verify_id=verify_id, deleted=False)
-    if not user:
+
+    def verify_user():
+        user = models.User.get(verify_id=verify_id, deleted=False)
+        if not user:
+            return None
+        user.updated_at = datetime.datetime.now()
+        user.verify = True
+        user.verify_id = None
+        # verify and to dashbaord
+        user.login_count += 1
+        create_user_record(user)
+        return user.email
+
+    email = await db_executor.run(verify_user)
+    if not email:
         return JSONResponse(status_code=404, content=dict(msg='not found'))
-    user.updated_at = datetime.datetime.now()
-    user.verify = True
-    user.verify_id = None
-    # verify and to dashbaord
-    user.login_count += 1
-    create_user_record(user)
-    access_token = authorize.create_access_token(subject=user.email)
-    refresh_token = authorize.create_refresh_token(subject=user.email)
+    await user_cache.invalidate(email)
+    access_token = authorize.create_access_token(subject=email)
+    refresh_token = authorize.create_refresh_token(subject=email)
 
     # Set the JWT cookies in the response
     authorize.set_access_cookies(access_token)
@@ -167,50 +337,17 @@ async def verify(
     return {'msg': 'Successfully verify'}
 
 
-# noinspection PyTypeChecker,PyChainedComparisons
 @router.get(
     '/statistics/',
     name='Statistics',
     response_model=schemas.StatisticsResponse
 )
+@jwt_cookie(ACCESS_TOKEN)
 async def statistics(
-        authorize: AuthJWT = Depends(),
+        authorize: AuthJWT = Depends(CachedAuthJWT),
 ):
     """
-    Statistics data
-    """
-    update_user_from_jwt(authorize)
-    # get sign up count
-    sign_up_count = models.User.select(lambda x: not x.deleted).count()
-
-    # get today active sessions
-    today = datetime.datetime.today()
-    today_st = today.replace(hour=0, minute=0, second=0, microsecond=0)
-    today_ed = today.replace(hour=23, minute=59, second=59, microsecond=59)
-    today_active_count = models.User.select(
-        lambda x:
-        not x.deleted and
-        today_ed >= x.last_login_time and
-        x.last_login_time >= today_st
-    ).count()
-
-    # Average number of active session users in the last 7 days rolling.
-    count_list = []
-    for day in range(7):
-        that_day = today - datetime.timedelta(days=day)
-        day_st = that_day.replace(hour=0, minute=0, second=0, microsecond=0)
-        day_ed = that_day.replace(hour=23, minute=59, second=59,
-                                  microsecond=59)
-        total_count = select(
-            count(record.user.id) for record in models.UserActivieRecord
-            if record.created_at >= day_st and record.created_at <= day_ed
-        ).first()
-        count_list.append(total_count)
-
-    last_7days_active_avg = round(sum(count_list) / 7, 2)
-
-    return {
-        'sign_up_count': sign_up_count,
-        'today_active_count': today_active_count,
-        'last_7days_active_avg': last_7days_active_avg,
-    }
+    Statistics data from daily rollups, cached for a short time
+    """
+    await get_required_user(authorize)
+    return await statistics_cache.get()
@@ -0,0 +1,51 @@
+"""
+Default response class of the app
+Examples:
+    app = FastAPI(default_response_class=FastJSONResponse)
+    # data already in response shape, skips response_model validation
+    return FastJSONResponse(page)
+
+orjson is used when installed, stdlib json otherwise
+"""
+import datetime
+import json
+import typing
+
+from fastapi.responses import JSONResponse
+from utils import timing
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def _json_default(value: typing.Any) -> str:
+    """Serialize datetime like pydantic does"""
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def dumps(content: typing.Any) -> bytes:
+    """
+    Returns:
+        compact json bytes, datetime as isoformat
+    """
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(
+        content,
+        ensure_ascii=False,
+        allow_nan=False,
+        separators=(',', ':'),
+        default=_json_default,
+    ).encode('utf-8')
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse encoded by dumps, timed as span encode"""
+
+    def render(self, content: typing.Any) -> bytes:
+        with timing.span('encode'):
+            return dumps(content)
@@ -5,22 +5,171 @@ Examples:
     async def login():
         pass
 
+    @router.get('/profile/')
+    @jwt_cookie(ACCESS_TOKEN)
+    async def profile():
+        pass
+
+    @router.get('/login/google/')
+    @session_cookie
+    async def google_login(request: Request):
+        pass
+
 """
+import random
 import typing
+import zlib
 
+from config import config
 from fastapi import APIRouter, Request, Response
 from fastapi.exceptions import HTTPException, ValidationError
 from fastapi.routing import APIRoute
+from starlette.middleware.sessions import SessionMiddleware
+from starlette.routing import Match
+from starlette.types import Scope
+from utils import admission, timing
 from utils.log import logger
 
+# request body is cut to this size in logs
+LOG_MAX_BODY_BYTES = config.get('LOG_MAX_BODY_BYTES', cast=int, default=2048)
+# share of 4xx errors logged, 5xx are always logged
+LOG_4XX_SAMPLE_RATE = config.get(
+    'LOG_4XX_SAMPLE_RATE', cast=float, default=1.0
+)
+# per route override, "/api/user/signup/=0.1,/api/auth/login/=0.01"
+LOG_4XX_SAMPLE_ROUTES = {
+    path.strip(): float(rate)
+    for path, rate in (
+        item.split('=', 1)
+        for item in config.get('LOG_4XX_SAMPLE_ROUTES', default='').split(',')
+        if '=' in item
+    )
+}
+# decoded size of compressed request bodies, blocks zip bombs
+REQUEST_MAX_BODY_BYTES = config.get(
+    'REQUEST_MAX_BODY_BYTES', cast=int, default=1024 * 1024
+)
+# Content-Encoding -> zlib wbits
+REQUEST_ENCODINGS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'x-gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+# signs the starlette session cookie of session_cookie routes
+SESSION_SECRET_KEY = config.get('session_secret_key')
+
+ACCESS_TOKEN = 'access'
+REFRESH_TOKEN = 'refresh'
+
+
+def jwt_cookie(*tokens: str) -> typing.Callable:
+    """
+    Declare which JWT cookies the endpoint needs
+    ErrorLoggingRoute keeps them for the OpenAPI security annotations
+    Args:
+        tokens: ACCESS_TOKEN and/or REFRESH_TOKEN
+    """
+
+    def decorator(func: typing.Callable) -> typing.Callable:
+        func.jwt_cookies = frozenset(tokens)
+        return func
+
+    return decorator
+
+
+def session_cookie(func: typing.Callable) -> typing.Callable:
+    """
+    Declare that the endpoint uses request.session
+    Only these routes get SessionMiddleware, the others never verify
+    or sign the session cookie
+    """
+    func.session_cookie = True
+    return func
+
+
+def body_for_log(body: typing.Optional[bytes]) -> typing.Optional[str]:
+    """
+    Cut request body to LOG_MAX_BODY_BYTES
+    Returns:
+        decoded body for logging
+    """
+    if body is None:
+        return None
+    if len(body) <= LOG_MAX_BODY_BYTES:
+        return body.decode(errors='replace')
+    return (
+        f'{body[:LOG_MAX_BODY_BYTES].decode(errors="replace")}'
+        f'...({len(body)} bytes)'
+    )
+
 
 class GzipRequest(Request):
-    """For custom_route_handler"""
+    """
+    For custom_route_handler
+    gzip/deflate body is decoded while it is received
+    """
+
+    async def decode_body(self, encoding: str) -> bytes:
+        """
+        Decompress the body stream chunk by chunk
+        Raises:
+            HTTPException(415) for unknown encoding
+            HTTPException(400) for broken or incomplete data
+            HTTPException(413) when decoded over REQUEST_MAX_BODY_BYTES
+        """
+        if encoding not in REQUEST_ENCODINGS:
+            raise HTTPException(
+                status_code=415,
+                detail=f'Unsupported Content-Encoding: {encoding}'
+            )
+        decompressor = zlib.decompressobj(REQUEST_ENCODINGS[encoding])
+        chunks = []
+        size = 0
+        try:
+            async for chunk in self.stream():
+                data = decompressor.decompress(
+                    chunk, REQUEST_MAX_BODY_BYTES - size + 1
+                )
+                size += len(data)
+                if (
+                        size > REQUEST_MAX_BODY_BYTES or
+                        decompressor.unconsumed_tail
+                ):
+                    raise HTTPException(
+                        status_code=413, detail='Request body is too large'
+                    )
+                chunks.append(data)
+            data = decompressor.flush()
+            if not decompressor.eof:
+                # cut before the end of the stream and its checksum
+                raise zlib.error('incomplete stream')
+        except zlib.error as exc:
+            raise HTTPException(
+                status_code=400, detail='Invalid compressed body'
+            ) from exc
+        if size + len(data) > REQUEST_MAX_BODY_BYTES:
+            raise HTTPException(
+                status_code=413, detail='Request body is too large'
+            )
+        chunks.append(data)
+        return b''.join(chunks)
 
     async def body(self) -> bytes:
         """Get data and store it as a variable"""
         if not hasattr(self, '_body'):
-            body = await super().body()
+            encoding = self.headers.get('content-encoding', 'identity')
+            encoding = encoding.strip().lower()
+            if encoding == 'identity':
+                body = await super().body()
+            else:
+                try:
+                    body = await self.decode_body(encoding)
+                except HTTPException:
+                    # stream is consumed, error log reads an empty body
+                    # noinspection PyAttributeOutsideInit
+                    self._body = b''
+                    raise
             # noinspection PyAttributeOutsideInit
             self._body = body
         return self._body
@@ -29,6 +178,33 @@ class GzipRequest(Request):
 class ErrorLoggingRoute(APIRoute):
     """Record all fail log"""
 
+    def __init__(self, path: str, endpoint: typing.Callable, **kwargs):
+        # set before super().__init__ which builds the route handler
+        self.jwt_cookies = getattr(endpoint, 'jwt_cookies', frozenset())
+        self.log_sample_rate = LOG_4XX_SAMPLE_ROUTES.get(
+            path, LOG_4XX_SAMPLE_RATE
+        )
+        # 429/503 before the endpoint, see utils.admission
+        self.admission = admission.for_endpoint(path, endpoint)
+        super().__init__(path, endpoint, **kwargs)
+        if getattr(endpoint, 'session_cookie', False):
+            self.app = SessionMiddleware(
+                self.app, secret_key=SESSION_SECRET_KEY
+            )
+
+    def matches(self, scope: Scope) -> typing.Tuple[Match, Scope]:
+        """Add path template for utils.metrics route label"""
+        match, child_scope = super().matches(scope)
+        if match != Match.NONE:
+            child_scope['route_path'] = self.path
+        return match, child_scope
+
+    def should_log(self, status_code: int) -> bool:
+        """Sample 4xx errors by log_sample_rate"""
+        if status_code >= 500 or self.log_sample_rate >= 1:
+            return True
+        return random.random() < self.log_sample_rate
+
     def get_route_handler(self) -> typing.Callable:
         """Override old function"""
         original_route_handler = super().get_route_handler()
@@ -37,23 +213,37 @@ class ErrorLoggingRoute(APIRoute):
             """Log it if catch error"""
             try:
                 request = GzipRequest(request.scope, request.receive)
-                return await original_route_handler(request)
+                if 'content-encoding' in request.headers:
+                    # errors of decoding are not turned into 400 by fastapi
+                    await request.body()
+                # endpoint with validation and encoding, spans inside it
+                # (db, hash, encode) are reported on their own too
+                with timing.span('app'):
+                    if self.admission is not None:
+                        return await self.admission.handle(
+                            request, original_route_handler
+                        )
+                    return await original_route_handler(request)
             except ValidationError as exc:
                 body = await request.body()
                 detail = {
                     'errors': exc.errors(),
                     'body': body.decode() if body is not None else None
                 }
-                query = {}
-                for key in request.query_params:
-                    query[key] = request.query_params[key]
-                logger.error(
-                    f'url:{request.url} status: {422} '
-                    f'query: {query} '
-                    f'detail: {detail} body: {body}'
-                )
+                if self.should_log(422):
+                    query = dict(request.query_params)
+                    log_body = body_for_log(body)
+                    logger.bind(
+                        url=str(request.url), status=422, query=query,
+                    ).error(
+                        f'url:{request.url} status: {422} '
+                        f'query: {query} '
+                        f'detail: {exc.errors()} body: {log_body}'
+                    )
                 raise HTTPException(status_code=422, detail=detail) from exc
             except HTTPException as exc:
+                if not self.should_log(exc.status_code):
+                    raise exc
                 # 很多 api 都會來亂
                 if exc.status_code == 401:
                     logger.info(
@@ -61,13 +251,13 @@ class ErrorLoggingRoute(APIRoute):
                     raise exc
                 body = await request.body()
 
-                query = {}
-                for key in request.query_params:
-                    query[key] = request.query_params[key]
-                logger.error(
+                query = dict(request.query_params)
+                logger.bind(
+                    url=str(request.url), status=exc.status_code, query=query,
+                ).error(
                     f'url:{request.url} status: {exc.status_code} '
                     f'query: {query} '
-                    f'detail: {exc.detail} body: {body}')
+                    f'detail: {exc.detail} body: {body_for_log(body)}')
                 raise exc
 
         return custom_route_handler
@@ -3,8 +3,9 @@ api_router all router with prefix api/
 """
 from fastapi import APIRouter
 
-from .endpoints import auth, user
+from .endpoints import admin, auth, user
 
 api_router = APIRouter()
 api_router.include_router(auth.router, prefix='/auth', tags=['auth'])
 api_router.include_router(user.router, prefix='/user', tags=['user'])
+api_router.include_router(admin.router, prefix='/admin', tags=['admin'])
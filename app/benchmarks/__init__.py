@@ -0,0 +1,13 @@
+"""
+Load tests and micro-benchmarks
+Examples:
+    cd app
+    # synthetic users and activity records in the configured postgres
+    python -m benchmarks.seed --users 10000 --records 100000
+    # boots main.app in process and drives the routes
+    python -m benchmarks.load --concurrency 20 --requests 2000 \\
+        --save baseline.json
+    python -m benchmarks.micro --save micro.json
+    # later, fail when p95 or rps got worse by more than 10%
+    python -m benchmarks.compare baseline.json current.json --threshold 10
+"""
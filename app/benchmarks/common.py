@@ -0,0 +1,86 @@
+"""
+Result summary and baseline files shared by the benchmarks
+"""
+import datetime
+import json
+import os
+import platform
+import typing
+
+
+def percentile(values: typing.List[float], q: float) -> float:
+    """
+    Args:
+        values: sorted values
+        q: 0 ~ 1
+    Returns:
+        nearest-rank percentile
+    """
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(q * len(values))) - 1))
+    return values[index]
+
+
+def summarize(
+        latencies: typing.List[float],
+        elapsed: float,
+        errors: int = 0,
+) -> dict:
+    """
+    Args:
+        latencies: seconds of every call
+        elapsed: wall time of the whole run
+        errors: failed calls
+    Returns:
+        count, errors, rps and latency percentiles in milliseconds
+    """
+    values = sorted(latencies)
+    count = len(values)
+    return {
+        'count': count,
+        'errors': errors,
+        'rps': round(count / elapsed, 2) if elapsed else 0.0,
+        'mean_ms': round(sum(values) / count * 1000, 3) if count else 0.0,
+        'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(values, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+        'max_ms': round(values[-1] * 1000, 3) if count else 0.0,
+    }
+
+
+def print_results(results: typing.Dict[str, dict]):
+    """Print one line per benchmark"""
+    print(
+        f'{"name":<30}{"count":>8}{"errors":>8}{"rps":>10}'
+        f'{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}'
+    )
+    for name, result in results.items():
+        print(
+            f'{name:<30}{result["count"]:>8}{result["errors"]:>8}'
+            f'{result["rps"]:>10}{result["p50_ms"]:>10}'
+            f'{result["p95_ms"]:>10}{result["p99_ms"]:>10}'
+        )
+
+
+def save(path: str, results: typing.Dict[str, dict], **options):
+    """Write results with the run options and machine info"""
+    data = {
+        'meta': {
+            'created_at': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'tag': os.environ.get('TAG'),
+            'options': options,
+        },
+        'results': results,
+    }
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(data, file, indent=2)
+
+
+def load(path: str) -> dict:
+    """Read file of save"""
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
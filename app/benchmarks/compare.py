@@ -0,0 +1,88 @@
+"""
+Diff two result files of benchmarks.load or benchmarks.micro
+Examples:
+    python -m benchmarks.compare baseline.json current.json --threshold 10
+
+Exit code is 1 when p95/p99 grew or rps dropped by more than threshold %
+"""
+import argparse
+import sys
+import typing
+
+from benchmarks import common
+
+# key -> True if bigger is better
+METRICS = {
+    'rps': True,
+    'p50_ms': False,
+    'p95_ms': False,
+    'p99_ms': False,
+}
+# only these fail the run, p50 is printed for reference
+CHECKED = ('rps', 'p95_ms', 'p99_ms')
+
+
+def change(before: float, after: float) -> float:
+    """
+    Returns:
+        percent change from before to after
+    """
+    if not before:
+        return 0.0
+    return (after - before) / before * 100
+
+
+def compare(
+        baseline: dict,
+        current: dict,
+        threshold: float,
+) -> typing.List[str]:
+    """
+    Print the diff table
+    Returns:
+        regressions, "name metric +x%"
+    """
+    regressions = []
+    print(f'{"name":<30}{"metric":<10}{"baseline":>12}{"current":>12}'
+          f'{"change":>10}')
+    for name, after in current['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            print(f'{name:<30}new')
+            continue
+        for metric, higher_is_better in METRICS.items():
+            diff = change(before[metric], after[metric])
+            worse = -diff if higher_is_better else diff
+            mark = ''
+            if metric in CHECKED and worse > threshold:
+                mark = ' !'
+                regressions.append(f'{name} {metric} {diff:+.1f}%')
+            print(
+                f'{name:<30}{metric:<10}{before[metric]:>12}'
+                f'{after[metric]:>12}{diff:>+9.1f}%{mark}'
+            )
+    return regressions
+
+
+def main():
+    """Command line entry"""
+    parser = argparse.ArgumentParser(description='Diff benchmark results')
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument(
+        '--threshold', type=float, default=10.0,
+        help='percent of regression allowed'
+    )
+    args = parser.parse_args()
+    regressions = compare(
+        common.load(args.baseline),
+        common.load(args.current),
+        args.threshold,
+    )
+    if regressions:
+        print('regressions:', ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""
+Local identity provider for Google and Facebook login tests
+Examples:
+    python -m benchmarks.fake_idp --port 5050 --latency-ms 50
+
+Start the api with GOOGLE_DISCOVERY_URL and FACEBOOK_*_URL pointing here
+(see readme), any client id and secret are accepted
+Authorize redirects straight back with a code, the id_token is signed
+with a key generated at start, POST /rotate replaces it (kid-miss refetch)
+GET /stats counts the calls of every path, a social login should cost one
+token call (plus /me for Facebook) once metadata is cached
+"""
+import argparse
+import asyncio
+import collections
+import secrets
+import time
+from urllib.parse import urlencode
+
+from authlib.jose import JsonWebKey, JsonWebToken
+from authlib.oidc.core.util import create_half_hash
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, RedirectResponse
+
+EMAIL = 'oauth{}@example.com'
+
+
+class FakeIdP:
+    """State of the fake provider"""
+
+    def __init__(self, issuer: str, latency: float):
+        self.issuer = issuer
+        self.latency = latency
+        self.calls = collections.Counter()
+        # code -> (client_id, nonce)
+        self.codes = {}
+        self.tokens = set()
+        self.key = None
+        self.rotate()
+
+    def rotate(self):
+        """New signing key with a new kid"""
+        self.key = JsonWebKey.generate_key(
+            'RSA', 2048, is_private=True, options={'kid': secrets.token_hex(8)}
+        )
+
+    def id_token(self, client_id: str, nonce: str, access_token: str) -> str:
+        """Signed id_token of a random user"""
+        now = int(time.time())
+        user = secrets.randbelow(1000)
+        payload = {
+            'iss': self.issuer,
+            'sub': str(user),
+            'aud': client_id,
+            'iat': now,
+            'exp': now + 3600,
+            'email': EMAIL.format(user),
+            'email_verified': True,
+            'name': f'OAuth {user}',
+            'at_hash': create_half_hash(access_token, 'RS256').decode(),
+        }
+        if nonce:
+            payload['nonce'] = nonce
+        header = {'alg': 'RS256', 'kid': self.key.as_dict()['kid']}
+        return JsonWebToken(['RS256']).encode(
+            header, payload, self.key
+        ).decode()
+
+
+def create_app(idp: FakeIdP) -> Starlette:
+    """Starlette app serving the OIDC and Graph endpoints"""
+    app = Starlette()
+
+    @app.middleware('http')
+    async def count(request: Request, call_next):
+        idp.calls[request.url.path] += 1
+        if idp.latency:
+            await asyncio.sleep(idp.latency)
+        return await call_next(request)
+
+    @app.route('/.well-known/openid-configuration')
+    async def discovery(_):
+        return JSONResponse({
+            'issuer': idp.issuer,
+            'authorization_endpoint': f'{idp.issuer}/authorize',
+            'token_endpoint': f'{idp.issuer}/token',
+            'jwks_uri': f'{idp.issuer}/jwks',
+            'id_token_signing_alg_values_supported': ['RS256'],
+        })
+
+    @app.route('/jwks')
+    async def jwks(_):
+        public = {
+            key: value for key, value in idp.key.as_dict().items()
+            if key in ('kty', 'kid', 'n', 'e')
+        }
+        return JSONResponse({'keys': [public]})
+
+    @app.route('/authorize')
+    @app.route('/dialog/oauth')
+    async def authorize(request: Request):
+        params = request.query_params
+        code = secrets.token_urlsafe(16)
+        idp.codes[code] = (params['client_id'], params.get('nonce'))
+        query = urlencode({'code': code, 'state': params.get('state', '')})
+        return RedirectResponse(f'{params["redirect_uri"]}?{query}')
+
+    @app.route('/token', methods=['POST'])
+    @app.route('/oauth/access_token', methods=['POST'])
+    async def token(request: Request):
+        form = await request.form()
+        grant = idp.codes.pop(form.get('code'), None)
+        if grant is None:
+            return JSONResponse({'error': 'invalid_grant'}, status_code=400)
+        client_id, nonce = grant
+        access_token = secrets.token_urlsafe(24)
+        idp.tokens.add(access_token)
+        return JSONResponse({
+            'access_token': access_token,
+            'token_type': 'Bearer',
+            'expires_in': 3600,
+            'id_token': idp.id_token(client_id, nonce, access_token),
+        })
+
+    @app.route('/me')
+    async def me(request: Request):
+        if request.query_params.get('access_token') not in idp.tokens:
+            return JSONResponse({'error': 'invalid token'}, status_code=401)
+        user = secrets.randbelow(1000)
+        return JSONResponse({
+            'id': str(user),
+            'name': f'OAuth {user}',
+            'email': EMAIL.format(user),
+        })
+
+    @app.route('/rotate', methods=['POST'])
+    async def rotate(_):
+        idp.rotate()
+        return JSONResponse({'kid': idp.key.as_dict()['kid']})
+
+    @app.route('/stats')
+    async def stats(_):
+        return JSONResponse(dict(idp.calls))
+
+    return app
+
+
+def main():
+    """Command line entry"""
+    parser = argparse.ArgumentParser(description='Fake Google/Facebook IdP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument(
+        '--latency-ms', type=float, default=0.0,
+        help='added to every response, a stand-in for the network',
+    )
+    args = parser.parse_args()
+    import uvicorn  # pylint: disable=import-outside-toplevel
+    idp = FakeIdP(f'http://{args.host}:{args.port}', args.latency_ms / 1000)
+    uvicorn.run(create_app(idp), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
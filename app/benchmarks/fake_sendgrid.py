@@ -0,0 +1,99 @@
+"""
+Local SendGrid mail send api for email outbox tests
+Examples:
+    python -m benchmarks.fake_sendgrid --port 5060 --latency-ms 100
+
+Start the api with SENDGRID_API_URL=http://127.0.0.1:5060, any api key is
+accepted and every mail is answered 202
+POST /fail {"statuses": [503, 429]} answers the next sends with those
+statuses instead, GET /stats returns the sent mails and failed answers
+"""
+import argparse
+import asyncio
+import collections
+import typing
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+
+class FakeSendGrid:
+    """State of the fake mail api"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        # mail send bodies answered 202
+        self.sent: typing.List[dict] = []
+        # statuses of the next sends, then 202 again
+        self.statuses: typing.Deque[int] = collections.deque()
+        self.failed = 0
+
+    def recipients(self) -> typing.List[str]:
+        """Emails of the sent mails in send order"""
+        return [
+            to['email']
+            for body in self.sent
+            for personalization in body['personalizations']
+            for to in personalization['to']
+        ]
+
+
+def create_app(sendgrid: FakeSendGrid) -> Starlette:
+    """Starlette app serving /v3/mail/send"""
+    app = Starlette()
+
+    @app.route('/v3/mail/send', methods=['POST'])
+    async def send(request: Request):
+        if sendgrid.latency:
+            await asyncio.sleep(sendgrid.latency)
+        if not request.headers.get('authorization', '').startswith('Bearer'):
+            return JSONResponse(
+                {'errors': [{'message': 'authorization required'}]},
+                status_code=401,
+            )
+        if sendgrid.statuses:
+            sendgrid.failed += 1
+            return JSONResponse(
+                {'errors': [{'message': 'fake failure'}]},
+                status_code=sendgrid.statuses.popleft(),
+            )
+        sendgrid.sent.append(await request.json())
+        return Response(status_code=202)
+
+    @app.route('/fail', methods=['POST'])
+    async def fail(request: Request):
+        body = await request.json()
+        sendgrid.statuses.extend(body['statuses'])
+        return JSONResponse({'pending': len(sendgrid.statuses)})
+
+    @app.route('/stats')
+    async def stats(_):
+        return JSONResponse({
+            'sent': len(sendgrid.sent),
+            'failed': sendgrid.failed,
+            'recipients': sendgrid.recipients(),
+        })
+
+    return app
+
+
+def main():
+    """Command line entry"""
+    parser = argparse.ArgumentParser(description='Fake SendGrid mail api')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5060)
+    parser.add_argument(
+        '--latency-ms', type=float, default=0.0,
+        help='added to every send, a stand-in for the network',
+    )
+    args = parser.parse_args()
+    import uvicorn  # pylint: disable=import-outside-toplevel
+    uvicorn.run(
+        create_app(FakeSendGrid(args.latency_ms / 1000)),
+        host=args.host, port=args.port,
+    )
+
+
+if __name__ == '__main__':
+    main()
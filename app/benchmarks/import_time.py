@@ -0,0 +1,112 @@
+"""
+Measure worker cold start against a budget
+Examples:
+    python -m benchmarks.import_time --budget-ms 500
+    # import plus startup events, needs postgres
+    python -m benchmarks.import_time --startup --budget-ms 1000
+
+Runs a fresh interpreter with -X importtime, prints the slowest modules
+and exits with 1 when over budget
+"""
+import argparse
+import os
+import subprocess
+import sys
+import typing
+
+APP_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STARTUP_CODE = (
+    'import asyncio, time\n'
+    'started_at = time.perf_counter()\n'
+    'from main import app\n'
+    'imported_at = time.perf_counter()\n'
+    '{startup}'
+    'print(f"import_ms={{(imported_at - started_at) * 1000:.1f}}")\n'
+    'print(f"ready_ms={{(ready_at - started_at) * 1000:.1f}}")\n'
+)
+RUN_STARTUP = (
+    'loop = asyncio.get_event_loop()\n'
+    'loop.run_until_complete(app.router.startup())\n'
+    'ready_at = time.perf_counter()\n'
+    'loop.run_until_complete(app.router.shutdown())\n'
+)
+
+
+def parse_importtime(
+        stderr: str
+) -> typing.List[typing.Tuple[str, int, int]]:
+    """
+    Parse -X importtime output
+    Returns:
+        [(module, self us, cumulative us), ...]
+    """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((name.rstrip(), int(self_us), int(cumulative_us)))
+    return modules
+
+
+def measure(startup: bool) -> typing.Tuple[dict, list]:
+    """
+    Returns:
+        ({'import_ms', 'ready_ms'}, parse_importtime result)
+    """
+    code = STARTUP_CODE.format(
+        startup=RUN_STARTUP if startup else 'ready_at = imported_at\n'
+    )
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=APP_PATH,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if result.returncode != 0:
+        print(result.stderr[-4000:], file=sys.stderr)
+        sys.exit(result.returncode)
+    timings = {}
+    for line in result.stdout.splitlines():
+        key, _, value = line.partition('=')
+        if key in ('import_ms', 'ready_ms'):
+            timings[key] = float(value)
+    return timings, parse_importtime(result.stderr)
+
+
+def main():
+    """Command line entry"""
+    parser = argparse.ArgumentParser(description='Import time budget')
+    parser.add_argument(
+        '--budget-ms', type=float, default=500.0,
+        help='fail when import (or ready with --startup) takes longer'
+    )
+    parser.add_argument(
+        '--startup', action='store_true', help='run startup events too'
+    )
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+    timings, modules = measure(args.startup)
+
+    # top level packages only, children are in their cumulative time
+    top_level = [module for module in modules if module[0].strip() and
+                 not module[0].startswith('  ')]
+    top_level.sort(key=lambda module: module[2], reverse=True)
+    print(f'{"module":<40}{"self ms":>10}{"cumulative ms":>15}')
+    for name, self_us, cumulative_us in top_level[:args.top]:
+        print(f'{name.strip():<40}{self_us / 1000:>10.1f}'
+              f'{cumulative_us / 1000:>15.1f}')
+    print(f'import: {timings["import_ms"]} ms')
+    measured = timings['import_ms']
+    if args.startup:
+        print(f'ready: {timings["ready_ms"]} ms')
+        measured = timings['ready_ms']
+    if measured > args.budget_ms:
+        print(f'over budget {args.budget_ms} ms')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""
+Drive the api routes at a fixed concurrency
+Examples:
+    # main.app in process through the ASGI transport
+    python -m benchmarks.load --concurrency 20 --requests 2000
+    # a server started by uvicorn/gunicorn
+    python -m benchmarks.load --url http://localhost:5000 --save run.json
+
+Run benchmarks.seed first, requests log in as the seeded users
+In process mode client and server share one event loop, use --url
+for numbers comparable with production
+Every request comes from one ip, so the admission rate limits
+(AUTH_RATE_PER_IP) would answer most logins with 429: in process mode
+ADMISSION_ENABLED defaults to false, start a --url server with
+ADMISSION_ENABLED=false too. 429 responses are counted as rate_limited
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+import typing
+
+import httpx
+from benchmarks import common, seed
+
+# name -> (method, path, needs login)
+ROUTES = {
+    'login': ('POST', '/api/auth/login/', False),
+    'profile': ('GET', '/api/user/profile/', True),
+    'get_users': ('GET', '/api/user/?limit=100', True),
+    'get_users_cursor': ('GET', '/api/user/?limit=100&cursor=', True),
+    'statistics': ('GET', '/api/user/statistics/', True),
+}
+
+
+def login_body(rand: random.Random, users: int) -> dict:
+    """Body of a seeded user"""
+    return {
+        'email': seed.EMAIL.format(rand.randrange(users)),
+        'password': seed.PASSWORD,
+    }
+
+
+async def login(client: httpx.AsyncClient) -> typing.Dict[str, str]:
+    """
+    Returns:
+        Cookie header of bench0
+    Notes:
+        jwt cookies are secure, they are sent by header so plain http
+        servers work too
+    """
+    response = await client.post(
+        ROUTES['login'][1], json=login_body(random.Random(0), 1)
+    )
+    response.raise_for_status()
+    cookie = '; '.join(
+        f'{name}={value}' for name, value in response.cookies.items()
+    )
+    return {'Cookie': cookie}
+
+
+async def run_route(
+        client: httpx.AsyncClient,
+        name: str,
+        headers: typing.Dict[str, str],
+        requests: int,
+        concurrency: int,
+        users: int,
+) -> dict:
+    """
+    Send requests to one route with concurrency workers
+    Returns:
+        common.summarize result
+    """
+    method, path, needs_login = ROUTES[name]
+    headers = headers if needs_login else {}
+    rand = random.Random(1)
+    latencies = []
+    errors = 0
+    rate_limited = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors, rate_limited
+        while remaining > 0:
+            remaining -= 1
+            body = login_body(rand, users) if method == 'POST' else None
+            started_at = time.perf_counter()
+            try:
+                response = await client.request(
+                    method, path, json=body, headers=headers
+                )
+                failed = response.status_code >= 400
+                rate_limited += response.status_code == 429
+            except httpx.HTTPError:
+                failed = True
+            latencies.append(time.perf_counter() - started_at)
+            errors += failed
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    result = common.summarize(
+        latencies, time.perf_counter() - started_at, errors
+    )
+    result['rate_limited'] = rate_limited
+    return result
+
+
+async def run(args) -> typing.Dict[str, dict]:
+    """
+    Run every selected route
+    Returns:
+        name -> common.summarize result
+    """
+    limits = httpx.Limits(
+        max_connections=args.concurrency,
+        max_keepalive_connections=args.concurrency,
+    )
+    if args.url:
+        client = httpx.AsyncClient(
+            base_url=args.url, limits=limits, timeout=30
+        )
+        app = None
+    else:
+        # read by utils.admission on import, ADMISSION_ENABLED=true keeps it
+        os.environ.setdefault('ADMISSION_ENABLED', 'false')
+        # pylint: disable=import-outside-toplevel
+        from main import app
+        await app.router.startup()
+        client = httpx.AsyncClient(
+            app=app, base_url='https://testserver', timeout=30
+        )
+    results = {}
+    try:
+        headers = await login(client)
+        for name in args.routes:
+            if args.warmup:
+                await run_route(
+                    client, name, headers, args.warmup,
+                    args.concurrency, args.users,
+                )
+            requests = args.requests
+            if name == 'login':
+                requests = args.login_requests
+            results[name] = await run_route(
+                client, name, headers, requests,
+                args.concurrency, args.users,
+            )
+    finally:
+        await client.aclose()
+        if app is not None:
+            await app.router.shutdown()
+    return results
+
+
+def main():
+    """Command line entry"""
+    parser = argparse.ArgumentParser(description='Load test api routes')
+    parser.add_argument('--url', help='server url, in process if not set')
+    parser.add_argument(
+        '--routes', nargs='+', choices=list(ROUTES), default=list(ROUTES)
+    )
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument(
+        '--requests', type=int, default=2000, help='requests per route'
+    )
+    parser.add_argument(
+        '--login-requests', type=int, default=200,
+        help='requests of login, password hashing is slow on purpose'
+    )
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument(
+        '--users', type=int, default=1000,
+        help='login as bench0 ~ bench{users - 1}'
+    )
+    parser.add_argument('--save', help='write results to json file')
+    args = parser.parse_args()
+    results = asyncio.get_event_loop().run_until_complete(run(args))
+    common.print_results(results)
+    if any(result['rate_limited'] for result in results.values()):
+        print('429 responses, run the server with ADMISSION_ENABLED=false')
+    if args.save:
+        common.save(args.save, results, **vars(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""
+Micro-benchmarks of hot functions
+Examples:
+    python -m benchmarks.micro
+    # without postgres
+    python -m benchmarks.micro --skip-db --save micro.json
+
+paginate reads the users seeded by benchmarks.seed
+"""
+import argparse
+import datetime
+import time
+import types
+import typing
+
+from benchmarks import common
+from db import schemas
+from utils import encrypt
+
+
+def measure(func: typing.Callable, iterations: int) -> dict:
+    """
+    Call func iterations times
+    Returns:
+        common.summarize result
+    """
+    latencies = []
+    started_at = time.perf_counter()
+    for _ in range(iterations):
+        call_started_at = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - call_started_at)
+    return common.summarize(latencies, time.perf_counter() - started_at)
+
+
+def fake_user(index: int) -> types.SimpleNamespace:
+    """Object with User attributes for from_orm"""
+    now = datetime.datetime.now()
+    return types.SimpleNamespace(
+        id=index,
+        email=f'bench{index}@example.com',
+        name=f'bench {index}',
+        register_from=1,
+        verify=True,
+        login_count=index,
+        last_login_time=now,
+        created_at=now,
+    )
+
+
+def bench_get_hash(iterations: int) -> dict:
+    """encrypt.get_hash of the current hash version"""
+    salt = encrypt.get_salt()
+    return measure(
+        lambda: encrypt.get_hash('benchmark-password', salt),
+        iterations,
+    )
+
+
+def bench_user_response(iterations: int) -> dict:
+    """One UserResponse from orm object to json"""
+    user = fake_user(1)
+    return measure(
+        lambda: schemas.UserResponse.from_orm(user).json(),
+        iterations,
+    )
+
+
+def bench_user_response_page(iterations: int) -> dict:
+    """Page of 100 UserResponse like get_users returns"""
+    # pylint: disable=import-outside-toplevel
+    from api.deps import get_pagination_schema
+    page_schema = get_pagination_schema(schemas.UserResponse)
+    page = {
+        'count': 10000,
+        'next': 'https://testserver/api/user/?limit=100&offset=100',
+        'previous': None,
+        'data': [fake_user(index) for index in range(100)],
+    }
+    return measure(lambda: page_schema(**page).json(), iterations)
+
+
+def bench_user_response_page_projected(iterations: int) -> dict:
+    """Same page from column tuples through FastJSONResponse like get_users"""
+    # pylint: disable=import-outside-toplevel
+    from api.deps import project
+    from api.responses import FastJSONResponse
+    fields = tuple(schemas.UserResponse.__fields__)
+    rows = [
+        tuple(getattr(fake_user(index), field) for field in fields)
+        for index in range(100)
+    ]
+
+    def render():
+        page = {
+            'count': 10000,
+            'next': 'https://testserver/api/user/?limit=100&offset=100',
+            'previous': None,
+            'data': project(rows, fields),
+        }
+        FastJSONResponse(page)
+
+    return measure(render, iterations)
+
+
+def bench_paginate(iterations: int, cursor: typing.Optional[str]) -> dict:
+    """
+    Pagination.paginate of 100 users at offset 0 or the first cursor page,
+    read as UserResponse column tuples like get_users
+    """
+    # pylint: disable=import-outside-toplevel
+    from api.deps import Pagination
+    from db import models
+    from pony.orm import db_session
+    from starlette.requests import Request
+
+    models.init_db()
+    fields = tuple(schemas.UserResponse.__fields__)
+    request = Request({
+        'type': 'http',
+        'method': 'GET',
+        'scheme': 'https',
+        'server': ('testserver', 443),
+        'path': '/api/user/',
+        'root_path': '',
+        'query_string': b'limit=100',
+        'headers': [],
+    })
+
+    def paginate():
+        with db_session:
+            page = Pagination(
+                request, offset=0, limit=100, cursor=cursor, with_count=False
+            )
+            page.paginate(models.User.select(), fields=fields)
+
+    return measure(paginate, iterations)
+
+
+def main():
+    """Command line entry"""
+    parser = argparse.ArgumentParser(description='Micro-benchmarks')
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument(
+        '--hash-iterations', type=int, default=100,
+        help='get_hash is slow on purpose'
+    )
+    parser.add_argument(
+        '--skip-db', action='store_true', help='skip benchmarks need postgres'
+    )
+    parser.add_argument('--save', help='write results to json file')
+    args = parser.parse_args()
+    results = {
+        'get_hash': bench_get_hash(args.hash_iterations),
+        'user_response': bench_user_response(args.iterations),
+        'user_response_page': bench_user_response_page(args.iterations // 10),
+        'user_response_page_projected': bench_user_response_page_projected(
+            args.iterations // 10
+        ),
+    }
+    if not args.skip_db:
+        results['paginate_offset'] = bench_paginate(args.iterations, None)
+        results['paginate_cursor'] = bench_paginate(args.iterations, '')
+    common.print_results(results)
+    if args.save:
+        common.save(args.save, results, **vars(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Seed synthetic users and activity records for the benchmarks
+Examples:
+    python -m benchmarks.seed --users 10000 --records 100000
+    python -m benchmarks.seed --reset
+
+Every seeded user has email bench{n}@example.com and password PASSWORD,
+the seed is fixed so two runs produce the same data
+"""
+import argparse
+import datetime
+import random
+
+import psycopg2
+from db import statistics
+from db.models import DB_PARAMS, init_db
+from pony.orm import db_session
+from psycopg2.extras import execute_values
+from utils import encrypt
+
+EMAIL = 'bench{}@example.com'
+EMAIL_PATTERN = 'bench%@example.com'
+PASSWORD = 'benchmark-password'
+
+INSERT_USERS_SQL = (
+    'INSERT INTO "User" (email, name, register_from, password, salt, '
+    'verify, login_count, last_login_time, created_at, deleted) '
+    'VALUES %s ON CONFLICT (email) DO NOTHING'
+)
+INSERT_RECORDS_SQL = (
+    'INSERT INTO "UserActivieRecord" (user_id, created_at) VALUES %s'
+)
+SEEDED_DAYS_SQL = (
+    'SELECT min(created_at)::date, max(created_at)::date '
+    'FROM "UserActivieRecord" WHERE user_id IN '
+    '(SELECT id FROM "User" WHERE email LIKE %(pattern)s)'
+)
+DELETE_SQL = (
+    'DELETE FROM "UserActivieRecord" WHERE user_id IN '
+    '(SELECT id FROM "User" WHERE email LIKE %(pattern)s);'
+    'DELETE FROM "DailyActiveUser" WHERE user_id IN '
+    '(SELECT id FROM "User" WHERE email LIKE %(pattern)s);'
+    'DELETE FROM "User" WHERE email LIKE %(pattern)s;'
+)
+
+
+def seed(users: int, records: int, days: int, seed_value: int = 0):
+    """
+    Insert users and records spread over the last days
+    Args:
+        users: number of users
+        records: number of UserActivieRecord rows
+        days: created_at range
+        seed_value: random seed
+    """
+    rand = random.Random(seed_value)
+    now = datetime.datetime.now()
+    # one hash for every user, hashing is not what is seeded
+    salt = encrypt.get_salt()
+    password = encrypt.make_password(PASSWORD, salt)
+    salt_str = encrypt.transfter_salt_to_str(salt)
+
+    def random_time() -> datetime.datetime:
+        return now - datetime.timedelta(seconds=rand.randint(0, days * 86400))
+
+    connection = psycopg2.connect(**DB_PARAMS)
+    try:
+        with connection, connection.cursor() as cursor:
+            execute_values(cursor, INSERT_USERS_SQL, (
+                (
+                    EMAIL.format(index), f'bench {index}', 1, password,
+                    salt_str, True, 0, created_at, created_at, False,
+                )
+                for index, created_at in (
+                    (index, random_time()) for index in range(users)
+                )
+            ), page_size=1000)
+            cursor.execute(
+                'SELECT id FROM "User" WHERE email LIKE %s',
+                (EMAIL_PATTERN,)
+            )
+            user_ids = [row[0] for row in cursor.fetchall()]
+            execute_values(cursor, INSERT_RECORDS_SQL, (
+                (rand.choice(user_ids), random_time())
+                for _ in range(records)
+            ), page_size=1000)
+    finally:
+        connection.close()
+    init_db()
+    with db_session:
+        statistics.backfill(days)
+
+
+def reset():
+    """
+    Delete every seeded user and its records, then rebuild the rollups
+    of the days they were active on
+    """
+    params = {'pattern': EMAIL_PATTERN}
+    connection = psycopg2.connect(**DB_PARAMS)
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.execute(SEEDED_DAYS_SQL, params)
+            since, until = cursor.fetchone()
+            cursor.execute(DELETE_SQL, params)
+            if since is not None:
+                statistics.rollup(
+                    cursor, since, until + datetime.timedelta(days=1)
+                )
+    finally:
+        connection.close()
+
+
+def main():
+    """Command line entry"""
+    parser = argparse.ArgumentParser(description='Seed benchmark data')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--reset', action='store_true', help='delete seeded data'
+    )
+    args = parser.parse_args()
+    if args.reset:
+        reset()
+        return
+    seed(args.users, args.records, args.days, args.seed)
+
+
+if __name__ == '__main__':
+    main()
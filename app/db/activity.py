@@ -0,0 +1,239 @@
+"""
+Write-behind buffer for user activity
+Examples:
+    activity_buffer.record(user.id)
+
+Hits of the same user inside one window are collapsed into one
+UserActivieRecord, a background task writes them with one multi-row
+INSERT and one batched UPDATE of User.last_login_time and updated_at
+The same INSERT keeps DailyActiveUser and DailyStatistics up to date
+"""
+import asyncio
+import datetime
+import threading
+import typing
+
+from config import config
+from db.executor import db_executor
+from db.models import db, raw_sql
+from psycopg2.extras import execute_values
+from utils.log import logger
+from utils.stats import Counter
+
+# rows per statement of execute_values
+PAGE_SIZE = 1000
+# rows of users which no longer exist are skipped
+RECORD_ACTIVITY_SQL = (
+    'WITH records AS ('
+    ' INSERT INTO "UserActivieRecord" (user_id, created_at)'
+    ' SELECT v.user_id, v.created_at'
+    ' FROM (VALUES %s) AS v (user_id, created_at)'
+    ' JOIN "User" AS u ON u.id = v.user_id'
+    ' RETURNING user_id, created_at'
+    '), new_days AS ('
+    ' INSERT INTO "DailyActiveUser" (day, user_id)'
+    ' SELECT DISTINCT created_at::date, user_id FROM records'
+    ' ON CONFLICT DO NOTHING'
+    ' RETURNING day'
+    ') '
+    'INSERT INTO "DailyStatistics" (day, active_users, activity_count) '
+    'SELECT r.day, COALESCE(n.active_users, 0), r.activity_count '
+    'FROM ('
+    ' SELECT created_at::date AS day, count(*) AS activity_count'
+    ' FROM records GROUP BY 1'
+    ') AS r LEFT JOIN ('
+    ' SELECT day, count(*) AS active_users FROM new_days GROUP BY 1'
+    ') AS n ON n.day = r.day '
+    'ON CONFLICT (day) DO UPDATE SET '
+    'active_users = "DailyStatistics".active_users + EXCLUDED.active_users, '
+    'activity_count = '
+    '"DailyStatistics".activity_count + EXCLUDED.activity_count'
+)
+# updated_at marks the row for incremental exports (db.export)
+UPDATE_LOGIN_TIME_SQL = (
+    'UPDATE "User" AS u '
+    'SET last_login_time = v.last_login_time, updated_at = now() '
+    'FROM (VALUES %s) AS v (id, last_login_time) '
+    'WHERE u.id = v.id AND v.last_login_time > u.last_login_time'
+)
+
+
+def pages(rows: list) -> int:
+    """Statements execute_values sends for rows"""
+    return -(-len(rows) // PAGE_SIZE)
+
+
+def write_records(records: typing.List[typing.Tuple[int, datetime.datetime]]):
+    """
+    Insert UserActivieRecord rows and update daily rollups
+    Args:
+        records: [(user_id, created_at), ...]
+    Notes:
+        Must run inside db_session
+    """
+    cursor = db.get_connection().cursor()
+    with raw_sql(pages(records)):
+        execute_values(
+            cursor, RECORD_ACTIVITY_SQL, records, page_size=PAGE_SIZE
+        )
+
+
+class ActivityBuffer:
+    """Collapse and batch user activity writes"""
+
+    def __init__(self, window: int, flush_interval: float, max_size: int):
+        """
+        Args:
+            window: seconds, hits of a user in one window make one record
+            flush_interval: seconds between background flushes
+            max_size: max users waiting for flush, others are dropped
+        """
+        self.window = window
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # user_id -> [last_seen, [record created_at, ...]]
+        self._pending = {}
+        # user_id -> window number of the last record
+        self._seen = {}
+        self._task = None
+        self.recorded = Counter()
+        self.collapsed = Counter()
+        self.dropped = Counter()
+        self.flushed = Counter()
+        self.flush_errors = Counter()
+
+    def record(self, user_id: int, when: datetime.datetime = None):
+        """
+        Queue one hit of user, never touches db
+        Notes:
+            Safe to call from db_executor threads
+        """
+        when = when or datetime.datetime.now()
+        window = int(when.timestamp() // self.window)
+        with self._lock:
+            pending = self._pending.get(user_id)
+            if pending is None:
+                if len(self._pending) >= self.max_size:
+                    self.dropped.inc()
+                    return
+                pending = self._pending[user_id] = [when, []]
+            elif when > pending[0]:
+                pending[0] = when
+
+            if self._seen.get(user_id) == window:
+                self.collapsed.inc()
+                return
+            self._seen[user_id] = window
+            pending[1].append(when)
+        self.recorded.inc()
+
+    def depth(self) -> int:
+        """
+        Returns:
+            users waiting for flush
+        """
+        return len(self._pending)
+
+    def take(self) -> typing.Dict[int, list]:
+        """
+        Swap out pending hits
+        Returns:
+            user_id -> [last_seen, [record created_at, ...]]
+        """
+        window = int(datetime.datetime.now().timestamp() // self.window)
+        with self._lock:
+            batch = self._pending
+            self._pending = {}
+            self._seen = {
+                user_id: seen for user_id, seen in self._seen.items()
+                if seen >= window
+            }
+        return batch
+
+    @staticmethod
+    def write(batch: typing.Dict[int, list]):
+        """
+        Write batch with one INSERT and one UPDATE
+        Notes:
+            Must run inside db_executor.run
+            Rows of users which no longer exist are skipped
+        """
+        records = [
+            (user_id, created_at)
+            for user_id, (_, created_ats) in batch.items()
+            for created_at in created_ats
+        ]
+        last_login_times = [
+            (user_id, last_seen)
+            for user_id, (last_seen, _) in batch.items()
+        ]
+        if records:
+            write_records(records)
+        cursor = db.get_connection().cursor()
+        with raw_sql(pages(last_login_times)):
+            execute_values(
+                cursor, UPDATE_LOGIN_TIME_SQL, last_login_times,
+                page_size=PAGE_SIZE,
+            )
+
+    async def flush(self):
+        """Write pending hits to db"""
+        batch = self.take()
+        if not batch:
+            return
+        size = sum(len(created_ats) for _, created_ats in batch.values())
+        try:
+            await db_executor.run(self.write, batch)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception(f'activity flush fail, drop {size} records')
+            self.flush_errors.inc()
+            self.dropped.inc(size)
+        else:
+            self.flushed.inc(size)
+
+    async def _flush_forever(self):
+        """Background flush loop"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        """Start background flush task"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._flush_forever())
+
+    async def stop(self):
+        """Stop background task then flush what is left"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            buffer depth and counters
+        """
+        return {
+            'depth': self.depth(),
+            'max_size': self.max_size,
+            'recorded': self.recorded.value,
+            'collapsed': self.collapsed.value,
+            'dropped': self.dropped.value,
+            'flushed': self.flushed.value,
+            'flush_errors': self.flush_errors.value,
+        }
+
+
+activity_buffer = ActivityBuffer(
+    window=config.get('ACTIVITY_WINDOW_SECONDS', cast=int, default=60),
+    flush_interval=config.get(
+        'ACTIVITY_FLUSH_SECONDS', cast=float, default=5.0
+    ),
+    max_size=config.get('ACTIVITY_BUFFER_SIZE', cast=int, default=10000),
+)
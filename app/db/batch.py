@@ -0,0 +1,114 @@
+"""
+Set-based user operations for the admin batch api
+Examples:
+    results, emails = await db_executor.run(
+        batch.run, 'delete', ['a@example.com'], [12, 13]
+    )
+
+Users are read with one IN query and changed with one UPDATE, all in
+the db_session (one transaction) of the db_executor call
+"""
+import datetime
+import typing
+
+from db import models, schemas
+from db.models import db
+
+Key = typing.Union[int, str]
+
+# rows already in the wanted state are left alone, reported as unchanged
+UPDATE_SQL = {
+    'verify': (
+        'UPDATE "User" SET verify = true, verify_id = NULL, updated_at = $now '
+        'WHERE id = ANY($ids) AND NOT verify AND deleted IS NOT TRUE '
+        'RETURNING id'
+    ),
+    'delete': (
+        'UPDATE "User" SET deleted = true, deleted_at = $now, '
+        'updated_at = $now '
+        'WHERE id = ANY($ids) AND deleted IS NOT TRUE '
+        'RETURNING id'
+    ),
+}
+
+
+def unique(items: typing.Iterable[Key]) -> typing.List[Key]:
+    """Drop repeated items, keep input order"""
+    return list(dict.fromkeys(items))
+
+
+def find_users(
+        emails: typing.List[str],
+        ids: typing.List[int],
+) -> typing.Dict[Key, models.User]:
+    """
+    One IN query for every email and id
+    Returns:
+        {email or id: User} of the found keys
+    """
+    email_keys = tuple(emails)
+    id_keys = tuple(ids)
+    users = models.User.select(
+        lambda x: x.email in email_keys or x.id in id_keys
+    )[:]
+    found = {}
+    for user in users:
+        found[user.email] = user
+        found[user.id] = user
+    return found
+
+
+def status_of(action: str, user: models.User, changed: bool) -> str:
+    """Item status of a found user, see schemas.UserBatchItem"""
+    if action == 'lookup':
+        return 'deleted' if user.deleted else 'found'
+    if changed:
+        return 'verified' if action == 'verify' else 'deleted'
+    if action == 'verify' and user.deleted:
+        return 'deleted'
+    return 'unchanged'
+
+
+def run(
+        action: str,
+        emails: typing.List[str],
+        ids: typing.List[int],
+) -> typing.Tuple[typing.List[dict], typing.List[str]]:
+    """
+    Lookup, verify or soft delete users
+    Notes:
+        Must run inside db_executor.run
+    Args:
+        action: lookup, verify or delete
+    Returns:
+        (UserBatchItem dicts in input order, emails of changed users)
+    """
+    keys = unique(emails) + unique(ids)
+    found = find_users(emails, ids)
+    changed = set()
+    sql = UPDATE_SQL.get(action)
+    if sql is not None:
+        user_ids = list({user.id for user in found.values()})
+        if user_ids:
+            params = {'ids': user_ids, 'now': datetime.datetime.now()}
+            cursor = db.execute(sql, {}, params)
+            changed = {row[0] for row in cursor.fetchall()}
+    fields = tuple(schemas.UserResponse.__fields__)
+    results = []
+    for key in keys:
+        user = found.get(key)
+        if user is None:
+            results.append({'key': key, 'status': 'not_found', 'user': None})
+            continue
+        item = {
+            'key': key,
+            'status': status_of(action, user, user.id in changed),
+            'user': None,
+        }
+        if action == 'lookup':
+            item['user'] = {field: getattr(user, field) for field in fields}
+        results.append(item)
+    changed_emails = [
+        user.email for user in found.values() if user.id in changed
+    ]
+    return results, unique(changed_emails)
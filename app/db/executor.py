@@ -0,0 +1,146 @@
+"""
+Run Pony work off the event loop
+Examples:
+    def get_user():
+        return models.User.get(email=email)
+
+    user = await db_executor.run(get_user)
+    # read-only, may run on a replica (db.replica)
+    user = await db_executor.read(get_user)
+"""
+import asyncio
+import contextvars
+import functools
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from config import config
+from db import replica
+from db.pool import PoolTimeout
+from fastapi.exceptions import HTTPException
+from pony.orm import db_session
+from utils import timing
+from utils.stats import Counter, Histogram
+
+
+class DBExecutor:
+    """
+    Bounded thread pool for Pony queries
+    Each call runs inside its own db_session, HTTPException still commits
+    like the old per-request db_session middleware did
+    """
+
+    def __init__(self, max_workers: int, max_queue: int):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.pending = 0
+        self.rejected = Counter()
+        self.queue_wait = Histogram()
+        self.execution = Histogram()
+        self._pool = None
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        """Create thread pool on first use"""
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix='db',
+            )
+        return self._pool
+
+    def _call(
+            self,
+            submitted_at: float,
+            read_only: bool,
+            func: typing.Callable,
+            args,
+            kwargs,
+    ):
+        """Run func inside db_session in worker thread"""
+        replica.set_read_only(read_only)
+        started_at = time.perf_counter()
+        self.queue_wait.observe(started_at - submitted_at)
+        timing.add('db_queue', started_at - submitted_at)
+        try:
+            with db_session(allowed_exceptions=(HTTPException,)):
+                return func(*args, **kwargs)
+        except PoolTimeout as exc:
+            self.rejected.inc()
+            raise HTTPException(
+                status_code=503,
+                detail='Database is busy',
+                headers={'Retry-After': '1'},
+            ) from exc
+        finally:
+            self.execution.observe(time.perf_counter() - started_at)
+
+    async def _submit(
+            self,
+            read_only: bool,
+            func: typing.Callable,
+            args,
+            kwargs,
+    ):
+        """
+        Run func with db_session in thread pool
+        Raises:
+            HTTPException(503) when the queue is full or no connection
+            is free within DB_POOL_ACQUIRE_TIMEOUT
+        """
+        if self.pending >= self.max_workers + self.max_queue:
+            self.rejected.inc()
+            raise HTTPException(
+                status_code=503,
+                detail='Database is busy',
+                headers={'Retry-After': '1'},
+            )
+        self.pending += 1
+        loop = asyncio.get_event_loop()
+        # keep the request timer of utils.timing in the worker thread
+        call = functools.partial(
+            contextvars.copy_context().run,
+            self._call, time.perf_counter(), read_only, func, args, kwargs
+        )
+        try:
+            return await loop.run_in_executor(self.pool, call)
+        finally:
+            self.pending -= 1
+
+    async def run(self, func: typing.Callable, *args, **kwargs):
+        """Run func with db_session on primary, see _submit"""
+        return await self._submit(False, func, args, kwargs)
+
+    async def read(self, func: typing.Callable, *args, **kwargs):
+        """
+        Run read-only func with db_session, on a replica when one is
+        healthy and the request is not pinned to primary, see _submit
+        """
+        return await self._submit(True, func, args, kwargs)
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            pool size, queue usage, queue wait and execution histograms
+        """
+        return {
+            'max_workers': self.max_workers,
+            'max_queue': self.max_queue,
+            'pending': self.pending,
+            'rejected': self.rejected.value,
+            'queue_wait': self.queue_wait.snapshot(),
+            'execution': self.execution.snapshot(),
+        }
+
+    def shutdown(self):
+        """Wait for running queries then stop threads"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+
+db_executor = DBExecutor(
+    max_workers=config.get('DB_POOL_SIZE', cast=int, default=8),
+    max_queue=config.get('DB_QUEUE_DEPTH', cast=int, default=64),
+)
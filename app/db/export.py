@@ -0,0 +1,183 @@
+"""
+Stream tables out of postgres without loading them
+Examples:
+    chunks = await prefetch(iter_export('users', 'ndjson', since=None))
+    return StreamingResponse(chunks)
+
+Rows come from a server-side cursor in chunks and are serialized from
+the db tuples directly, no Pony entities or pydantic models are built
+The connection is checked out of the Pony pool through db_executor.read
+(admission, replicas, PoolTimeout -> 503) and held while the response
+streams, it goes back when the stream ends, fails or is cancelled by a
+client disconnect
+"""
+import csv
+import datetime
+import io
+import json
+import typing
+import uuid
+
+from config import config
+from db.executor import db_executor
+from db.models import db, raw_sql
+from starlette.concurrency import run_in_threadpool
+
+# name -> (select sql, since filter)
+# User writes set updated_at, logins and activity flushes included
+EXPORTS = {
+    'users': (
+        'SELECT id, email, name, register_from, verify, login_count, '
+        'last_login_time, created_at, updated_at, deleted, deleted_at '
+        'FROM "User" {where} ORDER BY id',
+        'WHERE created_at >= %(since)s OR updated_at >= %(since)s',
+    ),
+    'records': (
+        'SELECT id, user_id, created_at '
+        'FROM "UserActivieRecord" {where} ORDER BY id',
+        'WHERE created_at >= %(since)s',
+    ),
+}
+MEDIA_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+CHUNK_SIZE = config.get('EXPORT_CHUNK_SIZE', cast=int, default=5000)
+
+
+def checkout():
+    """
+    Connection of the pool, a replica one when healthy
+    Notes:
+        Must run inside db_executor.read, give it back with release
+    """
+    connection, _ = db.provider.pool.connect()
+    return connection
+
+
+def release(connection):
+    """Give a checkout connection back, its cursors are closed"""
+    db.provider.pool.release(connection)
+
+
+def open_cursor(
+        connection,
+        name: str,
+        since: typing.Optional[datetime.datetime] = None,
+        chunk_size: int = CHUNK_SIZE,
+):
+    """
+    Server-side cursor over the table in a read-only transaction
+    Args:
+        name: key of EXPORTS
+        since: only rows created or updated after since
+        chunk_size: rows per fetch
+    """
+    sql, since_filter = EXPORTS[name]
+    sql = sql.format(where=since_filter if since else '')
+    with raw_sql(2):
+        with connection.cursor() as cursor:
+            # transaction scoped, nothing is left on the pooled connection
+            cursor.execute('SET TRANSACTION READ ONLY')
+        cursor = connection.cursor(name=f'export_{uuid.uuid4().hex}')
+        cursor.itersize = chunk_size
+        cursor.execute(sql, {'since': since})
+    return cursor
+
+
+def fetch(cursor, chunk_size: int = CHUNK_SIZE) -> list:
+    """Next rows of a cursor of open_cursor, one FETCH"""
+    with raw_sql():
+        return cursor.fetchmany(chunk_size)
+
+
+def _json_default(value):
+    """Serialize datetime for json.dumps"""
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def ndjson_chunk(columns: typing.List[str], rows: list, _: bool) -> bytes:
+    """NDJSON lines of rows"""
+    return ''.join(
+        json.dumps(dict(zip(columns, row)), default=_json_default) + '\n'
+        for row in rows
+    ).encode()
+
+
+def csv_chunk(columns: typing.List[str], rows: list, header: bool) -> bytes:
+    """CSV lines of rows, with the header line first when header"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(columns)
+    writer.writerows(rows)
+    return buffer.getvalue().encode()
+
+
+ENCODERS = {
+    'ndjson': ndjson_chunk,
+    'csv': csv_chunk,
+}
+
+
+async def iter_export(
+        name: str,
+        file_format: str,
+        since: typing.Optional[datetime.datetime] = None,
+        chunk_size: int = CHUNK_SIZE,
+) -> typing.AsyncIterator[bytes]:
+    """
+    Args:
+        name: key of EXPORTS
+        file_format: key of MEDIA_TYPES
+        since: only rows created or updated after since
+        chunk_size: rows per fetch
+    Returns:
+        iterator of encoded chunks, the first one is sent even without
+        rows for the csv header
+    Raises:
+        HTTPException(503) from db_executor.read on the first chunk
+    """
+    encode = ENCODERS[file_format]
+    connection = await db_executor.read(checkout)
+    try:
+        cursor = await run_in_threadpool(
+            open_cursor, connection, name, since, chunk_size
+        )
+        rows = await run_in_threadpool(fetch, cursor, chunk_size)
+        columns = [column[0] for column in cursor.description]
+        yield encode(columns, rows, True)
+        while rows:
+            rows = await run_in_threadpool(fetch, cursor, chunk_size)
+            if rows:
+                yield encode(columns, rows, False)
+    finally:
+        # also on cancel or close of a disconnected stream
+        await run_in_threadpool(release, connection)
+
+
+async def _chain(
+        first: bytes, chunks: typing.AsyncIterator[bytes]
+) -> typing.AsyncIterator[bytes]:
+    """first then the rest of chunks, chunks is closed with it"""
+    try:
+        yield first
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await chunks.aclose()
+
+
+async def prefetch(
+        chunks: typing.AsyncIterator[bytes]
+) -> typing.AsyncIterator[bytes]:
+    """
+    Take the first chunk before the response starts, so its errors
+    (HTTPException 503 of the checkout) are still sent as the response
+    Returns:
+        iterator of every chunk of chunks
+    """
+    first = await chunks.__anext__()
+    return _chain(first, chunks)
@@ -0,0 +1,153 @@
+"""
+Create tables and apply SQL migrations, run once per deploy
+Examples:
+    python -m db.migrate
+    python -m db.migrate --status
+
+Pony creates missing tables and indexes first, then every
+db/migrations/*.sql file not in schema_migrations is applied in name order
+A file starting with "-- no-transaction" runs in autocommit one statement
+at a time (CREATE INDEX CONCURRENTLY refuses a multi-statement string),
+statements end with ";" at end of line. Others run in one transaction each
+"""
+import argparse
+import os
+import re
+import typing
+
+import psycopg2
+from db.models import DB_PARAMS, init_db
+
+MIGRATIONS_PATH = os.path.join(os.path.dirname(__file__), 'migrations')
+NO_TRANSACTION = '-- no-transaction'
+# any constant, only one migrate runs at a time
+LOCK_ID = 7243001
+
+CREATE_TRACKING_SQL = (
+    'CREATE TABLE IF NOT EXISTS schema_migrations ('
+    ' name TEXT PRIMARY KEY,'
+    ' applied_at TIMESTAMP NOT NULL DEFAULT now()'
+    ')'
+)
+
+
+def migration_files() -> typing.List[str]:
+    """
+    Returns:
+        sorted names of db/migrations/*.sql
+    """
+    if not os.path.isdir(MIGRATIONS_PATH):
+        return []
+    return sorted(
+        name for name in os.listdir(MIGRATIONS_PATH) if name.endswith('.sql')
+    )
+
+
+def applied_migrations(cursor) -> typing.Set[str]:
+    """
+    Returns:
+        names in schema_migrations
+    """
+    cursor.execute('SELECT name FROM schema_migrations')
+    return {row[0] for row in cursor.fetchall()}
+
+
+def split_statements(sql: str) -> typing.List[str]:
+    """
+    Returns:
+        statements of sql, split at ";" ending a line, comments only dropped
+    """
+    statements = []
+    for chunk in re.split(r';[ \t]*$', sql, flags=re.MULTILINE):
+        lines = [
+            line for line in chunk.strip().splitlines()
+            if not line.lstrip().startswith('--')
+        ]
+        if lines:
+            statements.append(chunk.strip())
+    return statements
+
+
+def apply(connection, name: str):
+    """Run one migration file and record it"""
+    with open(os.path.join(MIGRATIONS_PATH, name), encoding='utf-8') as file:
+        sql = file.read()
+    if sql.startswith(NO_TRANSACTION):
+        connection.autocommit = True
+        try:
+            with connection.cursor() as cursor:
+                for statement in split_statements(sql):
+                    cursor.execute(statement)
+                cursor.execute(
+                    'INSERT INTO schema_migrations (name) VALUES (%s)',
+                    (name,)
+                )
+        finally:
+            connection.autocommit = False
+        return
+    with connection, connection.cursor() as cursor:
+        cursor.execute(sql)
+        cursor.execute(
+            'INSERT INTO schema_migrations (name) VALUES (%s)', (name,)
+        )
+
+
+def migrate() -> typing.List[str]:
+    """
+    Create tables then apply pending migrations
+    Returns:
+        applied names
+    """
+    init_db(create_tables=True)
+    connection = psycopg2.connect(**DB_PARAMS)
+    applied = []
+    try:
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_lock(%s)', (LOCK_ID,))
+            cursor.execute(CREATE_TRACKING_SQL)
+            done = applied_migrations(cursor)
+        connection.autocommit = False
+        for name in migration_files():
+            if name in done:
+                continue
+            print(f'apply {name}')
+            apply(connection, name)
+            applied.append(name)
+    finally:
+        connection.close()
+    return applied
+
+
+def status() -> typing.List[typing.Tuple[str, bool]]:
+    """
+    Returns:
+        [(name, applied), ...]
+    """
+    connection = psycopg2.connect(**DB_PARAMS)
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.execute(CREATE_TRACKING_SQL)
+            done = applied_migrations(cursor)
+    finally:
+        connection.close()
+    return [(name, name in done) for name in migration_files()]
+
+
+def main():
+    """Command line entry"""
+    parser = argparse.ArgumentParser(description='Database migrations')
+    parser.add_argument(
+        '--status', action='store_true', help='list migrations only'
+    )
+    args = parser.parse_args()
+    if args.status:
+        for name, done in status():
+            print(f'{"applied" if done else "pending"}  {name}')
+        return
+    applied = migrate()
+    print(f'{len(applied)} migrations applied')
+
+
+if __name__ == '__main__':
+    main()
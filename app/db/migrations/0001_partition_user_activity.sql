@@ -0,0 +1,48 @@
+-- UserActivieRecord partitioned by month of created_at, PostgreSQL 11+
+-- Rows are copied inside this transaction, writes to the table wait for it
+-- Later months are created and old ones rolled up and dropped by
+-- python -m db.partitions maintain
+ALTER TABLE "UserActivieRecord" RENAME TO "UserActivieRecord_legacy";
+-- keep the id sequence when the old table is dropped
+ALTER SEQUENCE "UserActivieRecord_id_seq" OWNED BY NONE;
+
+CREATE TABLE "UserActivieRecord" (
+    id INTEGER NOT NULL DEFAULT nextval('"UserActivieRecord_id_seq"'),
+    user_id INTEGER NOT NULL,
+    created_at TIMESTAMP NOT NULL
+) PARTITION BY RANGE (created_at);
+ALTER SEQUENCE "UserActivieRecord_id_seq" OWNED BY "UserActivieRecord".id;
+
+-- rows outside every month partition, moved out by maintain
+CREATE TABLE "UserActivieRecord_default"
+    PARTITION OF "UserActivieRecord" DEFAULT;
+
+DO $$
+DECLARE
+    first_day DATE := date_trunc('month', COALESCE(
+        (SELECT min(created_at) FROM "UserActivieRecord_legacy"), now()
+    ));
+BEGIN
+    WHILE first_day <= date_trunc('month', now()) + INTERVAL '2 months' LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF "UserActivieRecord" '
+            'FOR VALUES FROM (%L) TO (%L)',
+            'UserActivieRecord_p' || to_char(first_day, 'YYYYMM'),
+            first_day, first_day + INTERVAL '1 month'
+        );
+        first_day := first_day + INTERVAL '1 month';
+    END LOOP;
+END $$;
+
+INSERT INTO "UserActivieRecord" (id, user_id, created_at)
+SELECT id, user_id, created_at FROM "UserActivieRecord_legacy";
+DROP TABLE "UserActivieRecord_legacy";
+
+-- names Pony uses, so create_tables finds them
+ALTER TABLE "UserActivieRecord" ADD PRIMARY KEY (id, created_at);
+CREATE INDEX idx_useractivierecord__user_id
+    ON "UserActivieRecord" (user_id);
+CREATE INDEX idx_useractivierecord__created_at
+    ON "UserActivieRecord" (created_at);
+ALTER TABLE "UserActivieRecord" ADD CONSTRAINT fk_useractivierecord__user_id
+    FOREIGN KEY (user_id) REFERENCES "User" (id) ON DELETE CASCADE;
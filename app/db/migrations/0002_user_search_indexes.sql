@@ -0,0 +1,14 @@
+-- no-transaction
+-- Trigram indexes for GET /api/user/search/, LIKE 'term%' and '%term%'
+-- on lower(email) and lower(name), see db/search.py
+-- Built without blocking writes, a build that failed leaves an INVALID
+-- index which is dropped and rebuilt when migrate runs again
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+DROP INDEX CONCURRENTLY IF EXISTS idx_user__email_trgm;
+CREATE INDEX CONCURRENTLY idx_user__email_trgm
+    ON "User" USING gin (lower(email) gin_trgm_ops);
+
+DROP INDEX CONCURRENTLY IF EXISTS idx_user__name_trgm;
+CREATE INDEX CONCURRENTLY idx_user__name_trgm
+    ON "User" USING gin (lower(name) gin_trgm_ops);
@@ -0,0 +1,43 @@
+-- sign_up_count of GET /api/user/statistics/ without counting "User"
+-- Statement triggers add the live (not deleted) users each INSERT, UPDATE
+-- or DELETE adds or removes, raw SQL writes such as db/batch.py included
+-- Writes to "User" wait while the counter is seeded
+LOCK TABLE "User" IN SHARE ROW EXCLUSIVE MODE;
+
+CREATE OR REPLACE FUNCTION user_count_change() RETURNS trigger AS $$
+DECLARE
+    delta BIGINT := 0;
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        delta := delta + (
+            SELECT count(*) FROM new_rows WHERE deleted IS NOT TRUE
+        );
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        delta := delta - (
+            SELECT count(*) FROM old_rows WHERE deleted IS NOT TRUE
+        );
+    END IF;
+    IF delta <> 0 THEN
+        UPDATE "StatisticsCounter" SET value = value + delta
+        WHERE name = 'sign_up_count';
+    END IF;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS user_count_insert ON "User";
+CREATE TRIGGER user_count_insert AFTER INSERT ON "User"
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE user_count_change();
+DROP TRIGGER IF EXISTS user_count_update ON "User";
+CREATE TRIGGER user_count_update AFTER UPDATE ON "User"
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE user_count_change();
+DROP TRIGGER IF EXISTS user_count_delete ON "User";
+CREATE TRIGGER user_count_delete AFTER DELETE ON "User"
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE user_count_change();
+
+INSERT INTO "StatisticsCounter" (name, value)
+SELECT 'sign_up_count', count(*) FROM "User" WHERE deleted IS NOT TRUE
+ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value;
@@ -1,12 +1,22 @@
 """
 db with postgres
+Examples:
+    # once per process before the first query
+    init_db()
+    # SQL on a raw psycopg2 cursor, Pony's own SQL is hooked by init_db
+    with raw_sql():
+        cursor.execute(sql, params)
 """
 
+import contextlib
 import datetime
 
 from config import config
-from pony.orm import Database, Optional, Required, Set
-from utils import encrypt
+from pony.orm import (Database, Optional, PrimaryKey, Required, Set,
+                      composite_index)
+from db.pool import install_pool
+from db.replica import install_replicas
+from utils import encrypt, metrics, timing
 
 db = Database()
 
@@ -14,6 +24,7 @@ db = Database()
 class User(db.Entity):
     """User table"""
     _table_ = 'User'
+    id = PrimaryKey(int, auto=True)
     email = Required(str, unique=True, index=True)
     name = Required(str)
     register_from = Required(int)  # 1: web|2: facebook|3: google
@@ -28,10 +39,15 @@ class User(db.Entity):
     deleted = Optional(bool, default=False)
     deleted_at = Optional(datetime.datetime, nullable=True)
     records = Set('UserActivieRecord', reverse='user', lazy=True)
+    active_days = Set('DailyActiveUser', reverse='user', lazy=True)
+    # keyset pagination order
+    composite_index(created_at, id)
 
     def check_password(self, raw_password: str) -> bool:
         """
         Compare with encrypted password
+        Notes:
+            Blocking, use utils.hasher.password_hasher in api
         Args:
             raw_password: raw passowrd
         Returns:
@@ -40,22 +56,103 @@ class User(db.Entity):
         if self.password is None:
             return False
         salt_ = encrypt.transfer_salt_str_to_bytes(self.salt)
-        hashed_password = encrypt.get_hash(raw_password, salt_)
-        return hashed_password == self.password
+        return encrypt.check_password(raw_password, salt_, self.password)
 
 
 class UserActivieRecord(db.Entity):
-    """UserActivieRecord table"""
+    """
+    UserActivieRecord table, partitioned by month of created_at
+    Notes:
+        see db/migrations/0001_partition_user_activity.sql and db.partitions
+    """
     _table_ = 'UserActivieRecord'
     user = Required(User, column='user_id')
+    created_at = Required(
+        datetime.datetime, default=datetime.datetime.now, index=True
+    )
+
+
+class DailyActiveUser(db.Entity):
+    """DailyActiveUser table, one row per user per active day"""
+    _table_ = 'DailyActiveUser'
+    day = Required(datetime.date)
+    user = Required(User, column='user_id')
+    PrimaryKey(day, user)
+
+
+class DailyStatistics(db.Entity):
+    """DailyStatistics table, activity rollup per day"""
+    _table_ = 'DailyStatistics'
+    day = PrimaryKey(datetime.date)
+    active_users = Required(int, default=0)  # distinct users
+    activity_count = Required(int, default=0)  # UserActivieRecord rows
+
+
+class StatisticsCounter(db.Entity):
+    """
+    StatisticsCounter table, running totals
+    Notes:
+        sign_up_count is kept by the User triggers of
+        db/migrations/0003_user_count_trigger.sql
+    """
+    _table_ = 'StatisticsCounter'
+    name = PrimaryKey(str)
+    value = Required(int, size=64, default=0)
+
+
+class EmailOutbox(db.Entity):
+    """EmailOutbox table, mails waiting for utils.mail.email_dispatcher"""
+    _table_ = 'EmailOutbox'
+    PENDING, SENT, FAILED = 0, 1, 2
+    to = Required(str)  # comma separated
+    subject = Required(str)
+    message = Required(str)
+    status = Required(int, default=PENDING, index=True)
+    attempts = Required(int, default=0)
+    next_attempt_at = Required(
+        datetime.datetime, default=datetime.datetime.now, index=True
+    )
+    last_error = Optional(str, nullable=True)
     created_at = Required(datetime.datetime, default=datetime.datetime.now)
+    sent_at = Optional(datetime.datetime, nullable=True)
 
 
-db.bind(
-    provider='postgres',
+DB_PARAMS = dict(
     user=config.get('DB_USER'),
     password=config.get('DB_PASSWORD'),
     host=config.get('DB_HOST'),
     port=config.get('DB_PORT'),
-    database=config.get('DB_DATABASE_NAME'))
-db.generate_mapping(create_tables=True)
+    database=config.get('DB_DATABASE_NAME'),
+)
+
+
+@contextlib.contextmanager
+def raw_sql(statements: int = 1):
+    """
+    Count statements in DB_QUERIES and time the block as span db,
+    what the provider hooks of init_db do for SQL run by Pony
+    Args:
+        statements: statements the block sends
+    """
+    metrics.DB_QUERIES.inc(statements)
+    with timing.span('db'):
+        yield
+
+
+def init_db(create_tables: bool = False):
+    """
+    Bind db and generate mapping, safe to call more than once
+    Tables are created by `python -m db.migrate`, not on every boot
+    Args:
+        create_tables: create missing tables and indexes
+    """
+    if db.provider is None:
+        db.bind(provider='postgres', **DB_PARAMS)
+        install_pool(db.provider, DB_PARAMS)
+        install_replicas(db.provider, DB_PARAMS)
+        timing.instrument_provider(db.provider)
+        metrics.instrument_provider(db.provider)
+    if db.schema is None:
+        db.generate_mapping(create_tables=create_tables, check_tables=False)
+    elif create_tables:
+        db.create_tables()
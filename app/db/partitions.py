@@ -0,0 +1,285 @@
+"""
+Monthly partitions of UserActivieRecord
+Examples:
+    python -m db.partitions maintain
+    python -m db.partitions maintain --dry-run
+    python -m db.partitions status
+
+maintain is idempotent, it runs after every migrate (app/prestart.sh) and
+every ACTIVITY_MAINTAIN_SECONDS in the workers (partition_maintainer),
+the advisory lock lets one run at a time:
+    * creates the next ACTIVITY_PARTITIONS_AHEAD months
+    * moves rows of the default partition into month partitions
+    * rolls up months older than ACTIVITY_RETENTION_MONTHS into
+      DailyStatistics then drops them with their DailyActiveUser rows
+"""
+import argparse
+import asyncio
+import datetime
+import re
+import typing
+
+import psycopg2
+from config import config
+from db.models import DB_PARAMS
+from db.statistics import rollup
+from utils.log import logger
+
+ACTIVITY_RETENTION_MONTHS = config.get(
+    'ACTIVITY_RETENTION_MONTHS', cast=int, default=3
+)
+ACTIVITY_PARTITIONS_AHEAD = config.get(
+    'ACTIVITY_PARTITIONS_AHEAD', cast=int, default=2
+)
+# 0 disables the run in the workers
+ACTIVITY_MAINTAIN_SECONDS = config.get(
+    'ACTIVITY_MAINTAIN_SECONDS', cast=float, default=86400.0
+)
+PARENT = 'UserActivieRecord'
+DEFAULT_PARTITION = 'UserActivieRecord_default'
+PARTITION_NAME = re.compile(r'^UserActivieRecord_p(\d{4})(\d{2})$')
+# any constant, only one maintain runs at a time
+LOCK_ID = 7243002
+
+
+class NotPartitioned(Exception):
+    """UserActivieRecord is a plain table, migrations are not applied"""
+
+
+Plan = typing.Tuple[
+    typing.List[datetime.date], typing.Dict[datetime.date, str]
+]
+
+IS_PARTITIONED_SQL = (
+    "SELECT relkind = 'p' FROM pg_class "
+    'WHERE oid = \'"UserActivieRecord"\'::regclass'
+)
+LIST_PARTITIONS_SQL = (
+    'SELECT c.relname, c.reltuples::bigint, pg_total_relation_size(c.oid) '
+    'FROM pg_inherits AS i JOIN pg_class AS c ON c.oid = i.inhrelid '
+    'WHERE i.inhparent = \'"UserActivieRecord"\'::regclass '
+    'ORDER BY c.relname'
+)
+DEFAULT_MONTHS_SQL = (
+    'SELECT DISTINCT date_trunc(\'month\', created_at)::date '
+    'FROM "UserActivieRecord_default"'
+)
+CREATE_PARTITION_SQL = (
+    'CREATE TABLE "{name}" (LIKE "UserActivieRecord" INCLUDING DEFAULTS);'
+    'WITH moved AS ('
+    ' DELETE FROM "UserActivieRecord_default"'
+    ' WHERE created_at >= %(since)s AND created_at < %(until)s'
+    ' RETURNING id, user_id, created_at'
+    ') INSERT INTO "{name}" (id, user_id, created_at) '
+    'SELECT id, user_id, created_at FROM moved;'
+    'ALTER TABLE "UserActivieRecord" ATTACH PARTITION "{name}" '
+    'FOR VALUES FROM (%(since)s) TO (%(until)s)'
+)
+DROP_PARTITION_SQL = (
+    'DELETE FROM "DailyActiveUser" '
+    'WHERE day >= %(since)s AND day < %(until)s;'
+    'DROP TABLE "{name}"'
+)
+
+
+def add_months(day: datetime.date, months: int) -> datetime.date:
+    """
+    Returns:
+        first day of the month months after day
+    """
+    index = day.year * 12 + day.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: datetime.date) -> str:
+    """UserActivieRecord_pYYYYMM"""
+    return f'{PARENT}_p{month:%Y%m}'
+
+
+def month_partitions(cursor) -> typing.Dict[datetime.date, str]:
+    """
+    Returns:
+        {first day of month: partition name}
+    """
+    cursor.execute(LIST_PARTITIONS_SQL)
+    partitions = {}
+    for name, _, _ in cursor.fetchall():
+        match = PARTITION_NAME.match(name)
+        if match:
+            month = datetime.date(int(match[1]), int(match[2]), 1)
+            partitions[month] = name
+    return partitions
+
+
+def create_partition(cursor, month: datetime.date):
+    """Create month partition, rows of the month in default are moved in"""
+    cursor.execute(
+        CREATE_PARTITION_SQL.format(name=partition_name(month)),
+        {'since': month, 'until': add_months(month, 1)},
+    )
+
+
+def drop_partition(cursor, month: datetime.date, name: str):
+    """Roll up the month into DailyStatistics then drop its raw rows"""
+    params = {'since': month, 'until': add_months(month, 1)}
+    rollup(cursor, **params)
+    cursor.execute(DROP_PARTITION_SQL.format(name=name), params)
+
+
+def plan(
+        cursor,
+        today: datetime.date,
+        retention_months: int,
+        ahead_months: int,
+) -> Plan:
+    """
+    Returns:
+        (months to create, {month to drop: partition name})
+    """
+    partitions = month_partitions(cursor)
+    this_month = today.replace(day=1)
+    wanted = {
+        add_months(this_month, months) for months in range(ahead_months + 1)
+    }
+    cursor.execute(DEFAULT_MONTHS_SQL)
+    wanted.update(row[0] for row in cursor.fetchall())
+    cutoff = add_months(this_month, -retention_months)
+    to_create = sorted(month for month in wanted if month not in partitions)
+    # months below cutoff are created first so their rows are rolled up
+    to_drop = {
+        month: partitions.get(month, partition_name(month))
+        for month in sorted(set(partitions) | wanted) if month < cutoff
+    }
+    return to_create, to_drop
+
+
+def maintain(
+        retention_months: int = ACTIVITY_RETENTION_MONTHS,
+        ahead_months: int = ACTIVITY_PARTITIONS_AHEAD,
+        dry_run: bool = False,
+) -> typing.List[str]:
+    """
+    Create, roll up and drop partitions, one transaction per partition
+    Returns:
+        actions done, or planned with dry_run
+    Raises:
+        NotPartitioned before python -m db.migrate
+    """
+    connection = psycopg2.connect(**DB_PARAMS)
+    actions = []
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.execute(IS_PARTITIONED_SQL)
+            if not cursor.fetchone()[0]:
+                raise NotPartitioned(
+                    f'{PARENT} is not partitioned, run python -m db.migrate'
+                )
+            cursor.execute('SELECT pg_try_advisory_lock(%s)', (LOCK_ID,))
+            if not cursor.fetchone()[0]:
+                logger.info('partition maintain is running elsewhere, skip')
+                return actions
+            to_create, to_drop = plan(
+                cursor, datetime.date.today(), retention_months, ahead_months
+            )
+        for month in to_create:
+            actions.append(f'create {partition_name(month)}')
+            if not dry_run:
+                with connection, connection.cursor() as cursor:
+                    create_partition(cursor, month)
+        for month, name in to_drop.items():
+            actions.append(f'rollup and drop {name}')
+            if not dry_run:
+                with connection, connection.cursor() as cursor:
+                    drop_partition(cursor, month, name)
+    finally:
+        # closing the session releases the advisory lock
+        connection.close()
+    return actions
+
+
+class PartitionMaintainer:
+    """Run maintain every interval in background"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task = None
+
+    async def _run(self):
+        """Background loop, maintain runs in the default thread pool"""
+        loop = asyncio.get_event_loop()
+        while True:
+            # prestart.sh ran it when the server started
+            await asyncio.sleep(self.interval)
+            try:
+                actions = await loop.run_in_executor(None, maintain)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('partition maintain fail')
+                continue
+            if actions:
+                logger.info(f'partition maintain: {", ".join(actions)}')
+
+    def start(self):
+        """Start background task unless interval is 0"""
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop background task, a running maintain finishes in its thread"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+partition_maintainer = PartitionMaintainer(interval=ACTIVITY_MAINTAIN_SECONDS)
+
+
+def status() -> typing.List[typing.Tuple[str, int, int]]:
+    """
+    Returns:
+        [(partition name, estimated rows, total bytes), ...]
+    """
+    connection = psycopg2.connect(**DB_PARAMS)
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.execute(LIST_PARTITIONS_SQL)
+            return cursor.fetchall()
+    finally:
+        connection.close()
+
+
+def main():
+    """Command line entry"""
+    parser = argparse.ArgumentParser(description='Activity partitions')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    maintain_parser = subparsers.add_parser(
+        'maintain', help='create, roll up and drop partitions'
+    )
+    maintain_parser.add_argument(
+        '--retention-months', type=int, default=ACTIVITY_RETENTION_MONTHS
+    )
+    maintain_parser.add_argument(
+        '--ahead-months', type=int, default=ACTIVITY_PARTITIONS_AHEAD
+    )
+    maintain_parser.add_argument(
+        '--dry-run', action='store_true', help='print actions only'
+    )
+    subparsers.add_parser('status', help='list partitions and sizes')
+    args = parser.parse_args()
+    if args.command == 'status':
+        for name, rows, size in status():
+            print(f'{name:<32}{rows:>12} rows{size / 1048576:>10.1f} MB')
+        return
+    try:
+        actions = maintain(
+            args.retention_months, args.ahead_months, args.dry_run
+        )
+    except NotPartitioned as exc:
+        raise SystemExit(str(exc)) from exc
+    for action in actions:
+        print(action)
+    print(f'{len(actions)} partition actions')
+
+
+if __name__ == '__main__':
+    main()
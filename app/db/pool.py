@@ -0,0 +1,296 @@
+"""
+Process wide postgres connection pool for Pony
+Examples:
+    db.bind(provider='postgres', **DB_PARAMS)
+    install_pool(db.provider, DB_PARAMS)
+
+Pony keeps one connection per thread forever, ManagedPool shares at most
+DB_POOL_MAX_CONNECTIONS between all threads of the process:
+    * checkout waits DB_POOL_ACQUIRE_TIMEOUT seconds then raises PoolTimeout
+    * connections idle for DB_POOL_PING_AFTER_SECONDS are pinged on checkout
+    * connections idle for DB_POOL_IDLE_SECONDS are closed
+    * every statement is cut by postgres after DB_STATEMENT_TIMEOUT_MS
+"""
+import collections
+import os
+import threading
+import time
+import typing
+
+import psycopg2
+from config import config
+from utils.stats import Counter, Histogram
+
+DB_POOL_MAX_CONNECTIONS = config.get(
+    'DB_POOL_MAX_CONNECTIONS', cast=int, default=10
+)
+DB_POOL_ACQUIRE_TIMEOUT = config.get(
+    'DB_POOL_ACQUIRE_TIMEOUT', cast=float, default=5.0
+)
+DB_POOL_IDLE_SECONDS = config.get(
+    'DB_POOL_IDLE_SECONDS', cast=float, default=300.0
+)
+DB_POOL_PING_AFTER_SECONDS = config.get(
+    'DB_POOL_PING_AFTER_SECONDS', cast=float, default=30.0
+)
+DB_STATEMENT_TIMEOUT_MS = config.get(
+    'DB_STATEMENT_TIMEOUT_MS', cast=int, default=30000
+)
+
+
+class PoolTimeout(Exception):
+    """No connection was returned within acquire_timeout"""
+
+
+class ManagedPool:
+    """
+    Thread-safe pool with the interface of pony.orm.dbapiprovider.Pool
+    connect() -> (connection, is new), release(), drop(), disconnect()
+    """
+
+    def __init__(
+            self,
+            dbapi_module,
+            max_size: int,
+            acquire_timeout: float,
+            idle_timeout: float,
+            ping_after: float,
+            **connect_kwargs,
+    ):
+        """
+        Args:
+            dbapi_module: psycopg2
+            max_size: open connections of this process
+            acquire_timeout: seconds to wait for a free connection
+            idle_timeout: seconds before an idle connection is closed
+            ping_after: idle seconds before checkout runs SELECT 1
+            connect_kwargs: for dbapi_module.connect
+        """
+        self.dbapi_module = dbapi_module
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.idle_timeout = idle_timeout
+        self.ping_after = ping_after
+        self.connect_kwargs = connect_kwargs
+        self._condition = threading.Condition()
+        # (connection, released at), most recently used on the right
+        self._idle = collections.deque()
+        self._in_use = set()
+        # parent connections, closing them would end the parent sessions
+        self._forked = []
+        self._size = 0
+        self._waiting = 0
+        self._pid = os.getpid()
+        self.created = Counter()
+        self.closed = Counter()
+        self.timeouts = Counter()
+        self.ping_failures = Counter()
+        self.acquire_time = Histogram()
+
+    def _open(self):
+        """New connection, counted in _size by the caller"""
+        connection = self.dbapi_module.connect(**self.connect_kwargs)
+        if 'client_encoding' not in self.connect_kwargs:
+            connection.set_client_encoding('UTF8')
+        self.created.inc()
+        return connection
+
+    def _close(self, connection):
+        """Close without raising"""
+        self.closed.inc()
+        try:
+            connection.close()
+        except Exception:  # pylint: disable=broad-except
+            pass
+
+    def _reap(self, now: float) -> list:
+        """
+        Take connections idle longer than idle_timeout, holding the lock
+        Returns:
+            connections to close outside the lock
+        """
+        expired = []
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            expired.append(self._idle.popleft()[0])
+            self._size -= 1
+        return expired
+
+    def _check_fork(self):
+        """Connections of the parent process must not be used after fork"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._forked.extend(connection for connection, _ in self._idle)
+            self._forked.extend(self._in_use)
+            self._idle.clear()
+            self._in_use.clear()
+            self._size = 0
+
+    def _ping(self, connection) -> bool:
+        """SELECT 1 on a connection idle for a while"""
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            connection.rollback()
+            return True
+        except Exception:  # pylint: disable=broad-except
+            self.ping_failures.inc()
+            return False
+
+    def connect(self) -> typing.Tuple[typing.Any, bool]:
+        """
+        Check out a connection
+        Returns:
+            (connection, is new connection)
+        Raises:
+            PoolTimeout when every connection is in use for acquire_timeout
+        """
+        started_at = time.monotonic()
+        deadline = started_at + self.acquire_timeout
+        while True:
+            with self._condition:
+                self._check_fork()
+                expired = self._reap(time.monotonic())
+                connection = released_at = None
+                while connection is None:
+                    if self._idle:
+                        connection, released_at = self._idle.pop()
+                        self._in_use.add(connection)
+                    elif self._size < self.max_size:
+                        # reserve the slot, connect outside the lock
+                        self._size += 1
+                        break
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.timeouts.inc()
+                            raise PoolTimeout(
+                                f'No connection in {self.acquire_timeout}s, '
+                                f'pool size {self.max_size}'
+                            )
+                        self._waiting += 1
+                        try:
+                            self._condition.wait(remaining)
+                        finally:
+                            self._waiting -= 1
+            for expired_connection in expired:
+                self._close(expired_connection)
+
+            if connection is None:
+                try:
+                    connection = self._open()
+                except Exception:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+                with self._condition:
+                    self._in_use.add(connection)
+                self.acquire_time.observe(time.monotonic() - started_at)
+                return connection, True
+
+            idle_for = time.monotonic() - released_at
+            if idle_for < self.ping_after or self._ping(connection):
+                self.acquire_time.observe(time.monotonic() - started_at)
+                return connection, False
+            # broken, free its slot and try again
+            self.drop(connection)
+
+    def release(self, connection):
+        """
+        Reset session and put back
+        Notes:
+            called by Pony at the end of db_session
+        """
+        with self._condition:
+            self._check_fork()
+            if connection not in self._in_use:
+                return
+        try:
+            connection.rollback()
+            connection.autocommit = True
+            cursor = connection.cursor()
+            cursor.execute('DISCARD ALL')
+            connection.autocommit = False
+        except Exception:
+            self.drop(connection)
+            raise
+        with self._condition:
+            self._in_use.discard(connection)
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+    def drop(self, connection):
+        """Close a broken connection and free its slot"""
+        with self._condition:
+            self._check_fork()
+            if connection not in self._in_use:
+                return
+            self._in_use.discard(connection)
+            self._size -= 1
+            self._condition.notify()
+        self._close(connection)
+
+    def disconnect(self):
+        """Close every idle connection, in use ones come back on release"""
+        with self._condition:
+            idle = [connection for connection, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+        for connection in idle:
+            self._close(connection)
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            utilization and counters
+        """
+        with self._condition:
+            size, idle, waiting = self._size, len(self._idle), self._waiting
+        return {
+            'max_size': self.max_size,
+            'size': size,
+            'in_use': size - idle,
+            'idle': idle,
+            'waiting': waiting,
+            'created': self.created.value,
+            'closed': self.closed.value,
+            'timeouts': self.timeouts.value,
+            'ping_failures': self.ping_failures.value,
+            'acquire_time': self.acquire_time.snapshot(),
+        }
+
+
+def connect_options(statement_timeout_ms: int) -> str:
+    """
+    Returns:
+        libpq options, session defaults restored by DISCARD ALL too
+    """
+    return f'-c statement_timeout={statement_timeout_ms}'
+
+
+def create_pool(connect_kwargs: dict) -> ManagedPool:
+    """ManagedPool from the DB_POOL_* settings"""
+    return ManagedPool(
+        psycopg2,
+        max_size=DB_POOL_MAX_CONNECTIONS,
+        acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT,
+        idle_timeout=DB_POOL_IDLE_SECONDS,
+        ping_after=DB_POOL_PING_AFTER_SECONDS,
+        options=connect_options(DB_STATEMENT_TIMEOUT_MS),
+        **connect_kwargs,
+    )
+
+
+def install_pool(provider, connect_kwargs: dict) -> ManagedPool:
+    """
+    Replace the per-thread pool of a bound Pony provider
+    Args:
+        provider: db.provider after bind
+        connect_kwargs: DB_PARAMS
+    """
+    # connection opened by bind in this thread
+    provider.pool.disconnect()
+    pool = create_pool(connect_kwargs)
+    provider.pool = pool
+    return pool
@@ -0,0 +1,313 @@
+"""
+Route read-only db sessions to postgres replicas
+Examples:
+    # sessions of db_executor.read may use a replica
+    data = await db_executor.read(get_page)
+    # after a write of the user, reads of the user stay on primary a while
+    replica.stick(email)
+
+Replicas are DB_REPLICA_HOSTS (host:port, comma separated) with the DB_*
+user, password and database. A replica is used while its last health check
+succeeded and its replay lag is within DB_REPLICA_MAX_LAG_SECONDS,
+otherwise (or when its checkout fails) the session falls back to primary
+Sticky emails are kept per worker, user_cache shares them through the
+REDIS_URL invalidation channel. Without REDIS_URL only the worker which
+served the write keeps the user's reads on primary
+"""
+import asyncio
+import contextvars
+import itertools
+import threading
+import time
+import typing
+
+from config import config
+from db.pool import ManagedPool, PoolTimeout, create_pool
+from utils.cache import TTLCache
+from utils.log import logger
+from utils.stats import Counter
+
+DB_REPLICA_HOSTS = [
+    host.strip()
+    for host in config.get('DB_REPLICA_HOSTS', default='').split(',')
+    if host.strip()
+]
+DB_REPLICA_MAX_LAG_SECONDS = config.get(
+    'DB_REPLICA_MAX_LAG_SECONDS', cast=float, default=5.0
+)
+DB_REPLICA_CHECK_SECONDS = config.get(
+    'DB_REPLICA_CHECK_SECONDS', cast=float, default=2.0
+)
+DB_REPLICA_STICKY_SECONDS = config.get(
+    'DB_REPLICA_STICKY_SECONDS', cast=float, default=10.0
+)
+REDIS_URL = config.get('REDIS_URL', default=None)
+
+# 0 when replay caught up with what was received, an idle primary
+# does not make a replica look late
+LAG_SQL = (
+    'SELECT CASE'
+    ' WHEN NOT pg_is_in_recovery() THEN 0'
+    ' WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0'
+    ' ELSE COALESCE('
+    '  EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 1e9'
+    ' ) END'
+)
+
+_read_only: contextvars.ContextVar = contextvars.ContextVar(
+    'db_read_only', default=False
+)
+_pinned: contextvars.ContextVar = contextvars.ContextVar(
+    'db_pinned', default=False
+)
+# emails written lately, reads of them go to primary
+_sticky = TTLCache(max_size=100000, ttl=DB_REPLICA_STICKY_SECONDS)
+
+
+def set_read_only(read_only: bool):
+    """Mark db sessions of the current context, set by db_executor"""
+    _read_only.set(read_only)
+
+
+def pin_primary():
+    """Send every session of the current request to primary"""
+    _pinned.set(True)
+
+
+def stick(email: str):
+    """
+    Read-your-writes, reads of email use primary for a while
+    Notes:
+        This worker only, see user_cache.invalidate for every worker
+    """
+    _sticky.set(email, True)
+
+
+def is_sticky(email: str) -> bool:
+    """email was written within DB_REPLICA_STICKY_SECONDS"""
+    return _sticky.get(email, False)
+
+
+class Replica:
+    """Pool and health of one replica"""
+
+    def __init__(self, name: str, pool: ManagedPool):
+        self.name = name
+        self.pool = pool
+        self.healthy = False
+        self.lag: typing.Optional[float] = None
+        self.checked_at = 0.0
+        self.failures = Counter()
+
+    def check(self, max_lag: float):
+        """Measure replay lag, a failing replica is unhealthy"""
+        try:
+            connection, _ = self.pool.connect()
+        except Exception:  # pylint: disable=broad-except
+            self.mark_down()
+            return
+        try:
+            cursor = connection.cursor()
+            cursor.execute(LAG_SQL)
+            self.lag = float(cursor.fetchone()[0])
+        except Exception:  # pylint: disable=broad-except
+            self.pool.drop(connection)
+            self.mark_down()
+            return
+        self.pool.release(connection)
+        self.checked_at = time.monotonic()
+        was_healthy = self.healthy
+        self.healthy = self.lag <= max_lag
+        if was_healthy and not self.healthy:
+            logger.warning(f'replica {self.name} lag {self.lag:.1f}s')
+
+    def mark_down(self):
+        """Stop routing to the replica until the next good check"""
+        self.failures.inc()
+        if self.healthy:
+            logger.warning(f'replica {self.name} down')
+        self.healthy = False
+        self.checked_at = time.monotonic()
+
+
+class RoutingPool:
+    """
+    Pony pool sending read-only sessions to a healthy replica
+    and everything else to primary
+    """
+
+    def __init__(
+            self,
+            primary: ManagedPool,
+            replicas: typing.List[Replica],
+            max_lag: float,
+    ):
+        self.primary = primary
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self._round_robin = itertools.cycle(replicas)
+        self._lock = threading.Lock()
+        # connection -> pool it came from
+        self._owners: typing.Dict[typing.Any, ManagedPool] = {}
+        self.replica_reads = Counter()
+        self.fallbacks = Counter()
+
+    def pick(self) -> typing.Optional[Replica]:
+        """Next healthy replica or None"""
+        with self._lock:
+            for _ in self.replicas:
+                replica = next(self._round_robin)
+                if replica.healthy:
+                    return replica
+        return None
+
+    def connect(self) -> typing.Tuple[typing.Any, bool]:
+        """
+        Replica connection for read-only sessions when one is healthy
+        Returns:
+            (connection, is new connection)
+        """
+        if _read_only.get() and not _pinned.get():
+            replica = self.pick()
+            if replica is None:
+                self.fallbacks.inc()
+            else:
+                try:
+                    connection, is_new = replica.pool.connect()
+                except PoolTimeout:
+                    self.fallbacks.inc()
+                except Exception:  # pylint: disable=broad-except
+                    replica.mark_down()
+                    self.fallbacks.inc()
+                else:
+                    self.replica_reads.inc()
+                    with self._lock:
+                        self._owners[connection] = replica.pool
+                    return connection, is_new
+        return self.primary.connect()
+
+    def _owner(self, connection) -> ManagedPool:
+        """Pool of connection, forgotten once it is back"""
+        with self._lock:
+            return self._owners.pop(connection, self.primary)
+
+    def release(self, connection):
+        """Put back into the pool it came from"""
+        self._owner(connection).release(connection)
+
+    def drop(self, connection):
+        """Close in the pool it came from"""
+        self._owner(connection).drop(connection)
+
+    def disconnect(self):
+        """Close idle connections of every pool"""
+        self.primary.disconnect()
+        for replica in self.replicas:
+            replica.pool.disconnect()
+
+    def check(self):
+        """Health check every replica, blocking"""
+        for replica in self.replicas:
+            replica.check(self.max_lag)
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            primary pool stats plus replica health and routing counters
+        """
+        return {
+            **self.primary.stats(),
+            'replicas_healthy': sum(
+                replica.healthy for replica in self.replicas
+            ),
+            'replica_reads': self.replica_reads.value,
+            'replica_fallbacks': self.fallbacks.value,
+            'replicas': [
+                {
+                    'name': replica.name,
+                    'healthy': replica.healthy,
+                    'lag': replica.lag,
+                    'failures': replica.failures.value,
+                    'in_use': replica.pool.stats()['in_use'],
+                }
+                for replica in self.replicas
+            ],
+        }
+
+
+def replica_params(connect_kwargs: dict, host: str) -> dict:
+    """
+    Args:
+        connect_kwargs: DB_PARAMS of primary
+        host: host or host:port
+    Returns:
+        connect kwargs of the replica
+    """
+    name, _, port = host.partition(':')
+    # a replica that does not answer must not hold a checkout for long
+    return {
+        **connect_kwargs,
+        'host': name,
+        'port': port or connect_kwargs.get('port'),
+        'connect_timeout': 2,
+    }
+
+
+def install_replicas(provider, connect_kwargs: dict):
+    """
+    Wrap the pool installed by db.pool.install_pool when replicas are set
+    Args:
+        provider: db.provider after install_pool
+        connect_kwargs: DB_PARAMS
+    """
+    if not DB_REPLICA_HOSTS or isinstance(provider.pool, RoutingPool):
+        return
+    provider.pool = RoutingPool(
+        primary=provider.pool,
+        replicas=[
+            Replica(host, create_pool(replica_params(connect_kwargs, host)))
+            for host in DB_REPLICA_HOSTS
+        ],
+        max_lag=DB_REPLICA_MAX_LAG_SECONDS,
+    )
+
+
+class ReplicaMonitor:
+    """Health check replicas every interval in background"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task = None
+
+    async def _run(self, pool: RoutingPool):
+        """Background loop, checks run in the default thread pool"""
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, pool.check)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('replica check fail')
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """Start background task when replicas are configured"""
+        # pylint: disable=import-outside-toplevel
+        from db.models import db
+        pool = db.provider.pool if db.provider else None
+        if self._task is None and isinstance(pool, RoutingPool):
+            if not REDIS_URL:
+                logger.warning(
+                    'replicas without REDIS_URL, read-your-writes only '
+                    'holds on the worker which served the write'
+                )
+            self._task = asyncio.ensure_future(self._run(pool))
+
+    async def stop(self):
+        """Stop background task"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+replica_monitor = ReplicaMonitor(interval=DB_REPLICA_CHECK_SECONDS)
@@ -1,9 +1,11 @@
 """schemas package"""
 from .settings import Settings
+from .user_batch import UserBatch, UserBatchItem, UserBatchResponse
 from .user_login import UserLogin
 from .user_reset_password import UserResetPassword
 from .user_response import UserResponse
 from .user_signup import UserSignup
+from .user_snapshot import UserSnapshot
 from .user_update import UserUpdate
 from .msg_resp import MessageResponse
 from .user_statistics_resp import StatisticsResponse
@@ -13,8 +15,12 @@ __all__ = [
     'UserLogin',
     'UserSignup',
     'UserResponse',
+    'UserSnapshot',
     'UserResetPassword',
     'UserUpdate',
     'MessageResponse',
-    'StatisticsResponse'
+    'StatisticsResponse',
+    'UserBatch',
+    'UserBatchItem',
+    'UserBatchResponse',
 ]
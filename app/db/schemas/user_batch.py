@@ -0,0 +1,61 @@
+"""User batch schemas"""
+import typing
+
+from config import config
+from pydantic import BaseModel, Field, root_validator
+
+from .user_response import UserResponse
+
+USER_BATCH_MAX_ITEMS = config.get(
+    'USER_BATCH_MAX_ITEMS', cast=int, default=1000
+)
+
+
+class UserBatch(BaseModel):
+    """
+    Users of a batch operation by email and/or id
+    """
+    emails: typing.List[str] = Field(
+        [], max_items=USER_BATCH_MAX_ITEMS, description='emails'
+    )
+    ids: typing.List[int] = Field(
+        [], max_items=USER_BATCH_MAX_ITEMS, description='ids'
+    )
+
+    # noinspection PyMethodParameters
+    # pylint: disable=E0213 It is pydantic syntax
+    @root_validator
+    def size_validate(cls, values):
+        """Between 1 and USER_BATCH_MAX_ITEMS users in total"""
+        size = len(values.get('emails', [])) + len(values.get('ids', []))
+        if not size:
+            raise ValueError('Please input emails or ids')
+        if size > USER_BATCH_MAX_ITEMS:
+            raise ValueError(
+                f'At most {USER_BATCH_MAX_ITEMS} emails and ids in total'
+            )
+        return values
+
+
+class UserBatchItem(BaseModel):
+    """
+    Result of one email or id
+    status:
+        lookup: found|deleted|not_found
+        verify: verified|unchanged|deleted|not_found
+        delete: deleted|unchanged|not_found
+    """
+    key: typing.Union[int, str] = Field(..., description='email or id')
+    status: str = Field(..., description='result of the item')
+    user: typing.Optional[UserResponse] = Field(
+        None, description='user, lookup only'
+    )
+
+
+class UserBatchResponse(BaseModel):
+    """
+    UserBatchResponse
+    """
+    results: typing.List[UserBatchItem] = Field(
+        ..., description='one result per distinct email and id, input order'
+    )
@@ -2,7 +2,6 @@
 
 import re
 
-from db import models
 from db.schemas.utils import validate
 from pydantic import BaseModel, Field, validator
 
@@ -24,15 +23,14 @@ class UserSignup(BaseModel):
     # noinspection PyMethodParameters
     @validator('email')
     def email_validate(cls, v):  # pylint: disable=E0213 It is pydantic syntax
-        """Email formtat validate and user register"""
+        """
+        Email formtat validate
+        register check is in signup api because it needs db
+        """
         pattern = re.compile(
             r'^\w+((-\w+)|(\.\w+))*\@[A-Za-z0-9]+'
             r'((\.|-)[A-Za-z0-9]+)*\.[A-Za-z]+$'
         )
         if not pattern.match(v):
             raise ValueError('Please input email format')
-
-        user = models.User.get(email=v)
-        if user:
-            raise ValueError('Email is register')
         return v
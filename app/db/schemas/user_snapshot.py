@@ -0,0 +1,13 @@
+"""UserSnapshot schema"""
+
+from pydantic import Field
+
+from .user_response import UserResponse
+
+
+class UserSnapshot(UserResponse):
+    """
+    Cached user of db.user_cache
+    password and salt are never cached
+    """
+    id: int = Field(..., description='id')
@@ -12,7 +12,7 @@ class StatisticsResponse(BaseModel):
         description='Total number of users who have signed up')
     today_active_count: int = Field(
         ...,
-        description='Total number of users with active sessions today')
+        description='Number of distinct users with active sessions today')
     last_7days_active_avg: float = Field(
         ...,
         # pylint: disable-next=line-too-long
@@ -0,0 +1,60 @@
+"""
+User search over email and name
+Examples:
+    query = search.match_users('alice', 'prefix')
+    count = search.capped_count(query)
+
+Case-insensitive LIKE on lower(email) and lower(name), served by the
+pg_trgm GIN indexes of migrations/0002_user_search_indexes.sql for both
+prefix and substring terms of at least USER_SEARCH_MIN_LENGTH characters
+(shorter terms have no trigram to look up)
+"""
+from config import config
+from db import models
+from pony.orm import select
+from pony.orm.core import Query
+
+USER_SEARCH_MAX_COUNT = config.get(
+    'USER_SEARCH_MAX_COUNT', cast=int, default=1000
+)
+USER_SEARCH_MIN_LENGTH = 3
+
+
+def match_users(
+        term: str,
+        mode: str = 'contains',
+        include_deleted: bool = False,
+) -> Query:
+    """
+    Users whose email or name matches term
+    Args:
+        term: lowercase search term, LIKE wildcards are matched literally
+        mode: prefix or contains
+        include_deleted: also match soft deleted users
+    Returns:
+        Pony query, not ordered
+    """
+    if mode == 'prefix':
+        query = models.User.select(
+            lambda x:
+            x.email.lower().startswith(term) or
+            x.name.lower().startswith(term)
+        )
+    else:
+        query = models.User.select(
+            lambda x: term in x.email.lower() or term in x.name.lower()
+        )
+    if not include_deleted:
+        query = query.filter(lambda x: not x.deleted)
+    return query
+
+
+def capped_count(query: Query, cap: int = USER_SEARCH_MAX_COUNT) -> int:
+    """
+    Count matches without counting every row of a common term
+    Notes:
+        Must run inside db_session
+    Returns:
+        number of matches, at most cap
+    """
+    return len(select(x.id for x in query)[:cap])
@@ -0,0 +1,175 @@
+"""
+Statistics from the daily rollup tables
+Examples:
+    data = await statistics_cache.get()
+
+Backfill rollups from UserActivieRecord:
+    python -m db.statistics backfill --days 30
+"""
+import argparse
+import asyncio
+import datetime
+import time
+
+from config import config
+from db import models
+from db.executor import db_executor
+from pony.orm import db_session, select
+
+# rows of days [since, until) left without raw rows (users deleted), the
+# caller keeps days of dropped partitions out of the range
+PRUNE_ACTIVE_USERS_SQL = (
+    'DELETE FROM "DailyActiveUser" AS d '
+    'WHERE d.day >= %(since)s AND d.day < %(until)s AND NOT EXISTS ('
+    ' SELECT 1 FROM "UserActivieRecord" AS r'
+    ' WHERE r.user_id = d.user_id AND r.created_at >= d.day'
+    ' AND r.created_at < d.day + 1'
+    ')'
+)
+PRUNE_STATISTICS_SQL = (
+    'DELETE FROM "DailyStatistics" '
+    'WHERE day >= %(since)s AND day < %(until)s AND day NOT IN ('
+    ' SELECT DISTINCT created_at::date FROM "UserActivieRecord"'
+    ' WHERE created_at >= %(since)s AND created_at < %(until)s'
+    ')'
+)
+ROLLUP_ACTIVE_USERS_SQL = (
+    'INSERT INTO "DailyActiveUser" (day, user_id) '
+    'SELECT DISTINCT created_at::date, user_id FROM "UserActivieRecord" '
+    'WHERE created_at >= %(since)s AND created_at < %(until)s '
+    'ON CONFLICT DO NOTHING'
+)
+ROLLUP_STATISTICS_SQL = (
+    'INSERT INTO "DailyStatistics" (day, active_users, activity_count) '
+    'SELECT r.day, COALESCE(d.active_users, 0), r.activity_count '
+    'FROM ('
+    ' SELECT created_at::date AS day, count(*) AS activity_count'
+    ' FROM "UserActivieRecord"'
+    ' WHERE created_at >= %(since)s AND created_at < %(until)s GROUP BY 1'
+    ') AS r LEFT JOIN ('
+    ' SELECT day, count(*) AS active_users FROM "DailyActiveUser"'
+    ' WHERE day >= %(since)s AND day < %(until)s GROUP BY day'
+    ') AS d ON d.day = r.day '
+    'ON CONFLICT (day) DO UPDATE SET '
+    'active_users = EXCLUDED.active_users, '
+    'activity_count = EXCLUDED.activity_count'
+)
+
+
+def load_statistics() -> dict:
+    """
+    Read StatisticsResponse data
+    Notes:
+        Must run inside db_session
+    Returns:
+        dict for StatisticsResponse
+    """
+    today = datetime.date.today()
+    first_day = today - datetime.timedelta(days=6)
+    active_users = dict(select(
+        (x.day, x.active_users) for x in models.DailyStatistics
+        if x.day >= first_day
+    )[:])
+    counter = models.StatisticsCounter.get(name='sign_up_count')
+    if counter is not None:
+        sign_up_count = counter.value
+    else:
+        # before migrations/0003_user_count_trigger.sql
+        sign_up_count = models.User.select(lambda x: not x.deleted).count()
+    return {
+        'sign_up_count': sign_up_count,
+        'today_active_count': active_users.get(today, 0),
+        # Average number of distinct active users in the last 7 days rolling.
+        'last_7days_active_avg': round(sum(active_users.values()) / 7, 2),
+    }
+
+
+def rollup(cursor, since: datetime.date, until: datetime.date):
+    """
+    Rebuild rollups of days [since, until) from UserActivieRecord, idempotent
+    Args:
+        cursor: Pony or psycopg2 cursor, committed by the caller
+    Notes:
+        Every raw row of the days must still exist, rollups of days
+        without raw rows are removed
+    """
+    params = {'since': since, 'until': until}
+    cursor.execute(PRUNE_ACTIVE_USERS_SQL, params)
+    cursor.execute(ROLLUP_ACTIVE_USERS_SQL, params)
+    cursor.execute(PRUNE_STATISTICS_SQL, params)
+    cursor.execute(ROLLUP_STATISTICS_SQL, params)
+
+
+def backfill(days: int):
+    """
+    Rebuild rollups of the last days from UserActivieRecord, idempotent
+    Days of dropped month partitions keep their rollup
+    Notes:
+        Must run inside db_session
+    """
+    # pylint: disable=import-outside-toplevel
+    from db.partitions import month_partitions
+    today = datetime.date.today()
+    since = today - datetime.timedelta(days=days - 1)
+    cursor = models.db.get_connection().cursor()
+    months = month_partitions(cursor)
+    if months:
+        since = max(since, min(months))
+    rollup(cursor, since=since, until=today + datetime.timedelta(days=1))
+
+
+class StatisticsCache:
+    """Keep load_statistics result for ttl seconds"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._data = None
+        self._loaded_at = 0.0
+        self._lock = None
+
+    def _fresh(self) -> bool:
+        """Cached data is not expired"""
+        return (
+            self._data is not None and
+            time.monotonic() - self._loaded_at < self.ttl
+        )
+
+    async def get(self) -> dict:
+        """
+        Returns:
+            cached dict for StatisticsResponse
+        """
+        if self._fresh():
+            return self._data
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            # another request may have refreshed it
+            if not self._fresh():
+                self._data = await db_executor.read(load_statistics)
+                self._loaded_at = time.monotonic()
+        return self._data
+
+
+statistics_cache = StatisticsCache(
+    ttl=config.get('STATISTICS_CACHE_SECONDS', cast=float, default=30.0),
+)
+
+
+def main():
+    """Command line entry"""
+    parser = argparse.ArgumentParser(description='Statistics rollups')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    backfill_parser = subparsers.add_parser(
+        'backfill', help='rebuild rollups from UserActivieRecord'
+    )
+    backfill_parser.add_argument('--days', type=int, default=7)
+    args = parser.parse_args()
+    models.init_db()
+    if args.command == 'backfill':
+        with db_session:
+            backfill(args.days)
+
+
+if __name__ == '__main__':
+    main()
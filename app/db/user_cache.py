@@ -0,0 +1,229 @@
+"""
+User snapshots keyed by email (the JWT subject)
+Examples:
+    user = await user_cache.get(email)
+    # after the write is committed
+    await user_cache.invalidate(email)
+
+Snapshots live in a per-process TTLCache, with REDIS_URL set they are
+also shared through redis and invalidations are published to every worker
+last_login_time updated by the activity buffer shows up after the ttl
+Unknown and deleted emails are cached as NOT_FOUND for USER_CACHE_MISS_SECONDS,
+a stale token does not cost a db round trip per request
+"""
+import asyncio
+import typing
+
+from config import config
+from db import models, replica, schemas
+from db.executor import db_executor
+from utils.cache import MISSING, TTLCache
+from utils.log import logger
+from utils.stats import Counter
+
+REDIS_URL = config.get('REDIS_URL', default=None)
+KEY_PREFIX = 'user:'
+INVALIDATE_CHANNEL = 'user-cache-invalidate'
+# cached for emails without a live user, redis keeps NOT_FOUND_VALUE
+NOT_FOUND = object()
+NOT_FOUND_VALUE = b'-'
+
+
+def load_user(email: str) -> typing.Optional[schemas.UserSnapshot]:
+    """
+    Read user snapshot from db
+    Notes:
+        Must run inside db_executor.run
+    """
+    user = models.User.get(email=email, deleted=False)
+    if user is None:
+        return None
+    return schemas.UserSnapshot.from_orm(user)
+
+
+class UserCache:
+    """Local LRU/TTL cache of UserSnapshot with optional redis behind it"""
+
+    def __init__(
+            self,
+            max_size: int,
+            ttl: float,
+            miss_ttl: float,
+            redis_url: str = None,
+    ):
+        """
+        Args:
+            max_size: local entries, least recently used ones are evicted
+            ttl: seconds a snapshot is cached
+            miss_ttl: seconds NOT_FOUND of an unknown email is cached
+            redis_url: share snapshots and invalidations through redis
+        """
+        self.local = TTLCache(max_size=max_size, ttl=ttl)
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.redis_url = redis_url
+        self.not_found_hits = Counter()
+        self.redis_hits = Counter()
+        self.redis_errors = Counter()
+        self._redis = None
+        self._subscriber = None
+        self._task = None
+        # email -> [loads in flight, generation], bumped by invalidate of
+        # the email, a load started before it is not cached
+        self._loading: typing.Dict[str, typing.List[int]] = {}
+
+    async def get(self, email: str) -> typing.Optional[schemas.UserSnapshot]:
+        """
+        Returns:
+            UserSnapshot or None if user is not found
+        """
+        snapshot = self.local.get(email)
+        if snapshot is NOT_FOUND:
+            self.not_found_hits.inc()
+            return None
+        if snapshot is MISSING:
+            snapshot = await self._load(email)
+        return None if snapshot is NOT_FOUND else snapshot
+
+    def _ttl_of(self, snapshot) -> float:
+        """Cache seconds of a snapshot or NOT_FOUND"""
+        return self.miss_ttl if snapshot is NOT_FOUND else self.ttl
+
+    async def _load(self, email: str):
+        """
+        Snapshot from redis or db, cached unless invalidated meanwhile
+        Returns:
+            UserSnapshot or NOT_FOUND
+        """
+        state = self._loading.setdefault(email, [0, 0])
+        state[0] += 1
+        generation = state[1]
+        try:
+            snapshot = await self._redis_get(email)
+            if snapshot is None:
+                snapshot = await db_executor.read(load_user, email)
+                if snapshot is None:
+                    snapshot = NOT_FOUND
+                if generation == state[1]:
+                    await self._redis_set(email, snapshot)
+            if generation == state[1]:
+                self.local.set(email, snapshot, ttl=self._ttl_of(snapshot))
+        finally:
+            state[0] -= 1
+            if not state[0]:
+                del self._loading[email]
+        return snapshot
+
+    def _drop(self, email: str):
+        """Drop the local entry and the loads in flight of email"""
+        state = self._loading.get(email)
+        if state is not None:
+            state[1] += 1
+        self.local.delete(email)
+        replica.stick(email)
+
+    async def invalidate(self, email: str):
+        """
+        Drop email from every worker, call after the write is committed
+        Reads of email stay on primary for DB_REPLICA_STICKY_SECONDS, on
+        every worker with REDIS_URL, else on this worker only
+        """
+        self._drop(email)
+        if self._redis is None:
+            return
+        try:
+            await self._redis.delete(KEY_PREFIX + email)
+            await self._redis.publish(INVALIDATE_CHANNEL, email)
+        except Exception:  # pylint: disable=broad-except
+            self.redis_errors.inc()
+            logger.exception(f'user cache invalidate fail: {email}')
+
+    async def _redis_get(self, email: str):
+        """
+        Snapshot cached by any worker
+        Returns:
+            UserSnapshot, NOT_FOUND or None when redis has nothing
+        """
+        if self._redis is None:
+            return None
+        try:
+            data = await self._redis.get(KEY_PREFIX + email)
+        except Exception:  # pylint: disable=broad-except
+            self.redis_errors.inc()
+            return None
+        if data is None:
+            return None
+        self.redis_hits.inc()
+        if data == NOT_FOUND_VALUE:
+            return NOT_FOUND
+        return schemas.UserSnapshot.parse_raw(data)
+
+    async def _redis_set(self, email: str, snapshot):
+        """Share snapshot or NOT_FOUND with other workers"""
+        if self._redis is None:
+            return
+        value = (
+            NOT_FOUND_VALUE if snapshot is NOT_FOUND else snapshot.json()
+        )
+        try:
+            await self._redis.set(
+                KEY_PREFIX + email, value,
+                expire=max(1, int(self._ttl_of(snapshot))),
+            )
+        except Exception:  # pylint: disable=broad-except
+            self.redis_errors.inc()
+
+    async def _listen(self):
+        """Drop local entries invalidated by other workers"""
+        channel, = await self._subscriber.subscribe(INVALIDATE_CHANNEL)
+        while await channel.wait_message():
+            email = await channel.get(encoding='utf-8')
+            self._drop(email)
+
+    async def start(self):
+        """Connect redis if REDIS_URL is set"""
+        if not self.redis_url or self._redis is not None:
+            return
+        import aioredis  # pylint: disable=import-outside-toplevel
+        try:
+            self._redis = await aioredis.create_redis_pool(self.redis_url)
+            self._subscriber = await aioredis.create_redis(self.redis_url)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('user cache redis connect fail, use local only')
+            await self.stop()
+            return
+        self._task = asyncio.ensure_future(self._listen())
+
+    async def stop(self):
+        """Close redis connections"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for connection in (self._subscriber, self._redis):
+            if connection is not None:
+                connection.close()
+                await connection.wait_closed()
+        self._redis = None
+        self._subscriber = None
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            local cache stats and redis counters
+        """
+        return {
+            **self.local.stats(),
+            'not_found_hits': self.not_found_hits.value,
+            'redis': self._redis is not None,
+            'redis_hits': self.redis_hits.value,
+            'redis_errors': self.redis_errors.value,
+        }
+
+
+user_cache = UserCache(
+    max_size=config.get('USER_CACHE_SIZE', cast=int, default=10000),
+    ttl=config.get('USER_CACHE_SECONDS', cast=float, default=30.0),
+    miss_ttl=config.get('USER_CACHE_MISS_SECONDS', cast=float, default=5.0),
+    redis_url=REDIS_URL,
+)
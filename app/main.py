@@ -1,26 +1,47 @@
 """
 Fastapi server main program
 """
-import inspect
+import json
 import os
-import re
 
-import uvicorn
+from api.responses import FastJSONResponse
+from api.route_handler import ACCESS_TOKEN, REFRESH_TOKEN
 from api.router import api_router
-from config import DEBUG, config
-from fastapi import FastAPI, Request
+from config import DEBUG
+from db.activity import activity_buffer
+from db.executor import db_executor
+from db.models import db, init_db
+from db.partitions import partition_maintainer
+from db.replica import replica_monitor
+from db.user_cache import user_cache
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.openapi.docs import get_redoc_html, get_swagger_ui_html
 from fastapi.openapi.utils import get_openapi
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi.routing import APIRoute
 from fastapi_jwt_auth.exceptions import AuthJWTException
-from pony.orm import db_session
-from starlette.middleware.sessions import SessionMiddleware
-from utils.log import setup_logging
+from utils import admission, metrics
+from utils.compression import CompressionMiddleware, register_static
+from utils.hasher import password_hasher
+from utils.http import close_client
+from utils.log import file_sink, setup_logging
+from utils.mail import email_dispatcher
+from utils.oauth import metadata_refresher
+from utils.timing import TimingMiddleware
 
 FAST_API_TITLE = 'AVL-Exam'
 VERSION = os.environ.get('TAG', '0.0.1')
-app = FastAPI(title=FAST_API_TITLE, version=VERSION)
+OPENAPI_URL = '/openapi.json'
+# openapi and docs routes are served below from the precomputed schema
+app = FastAPI(
+    title=FAST_API_TITLE,
+    version=VERSION,
+    openapi_url=None,
+    docs_url=None,
+    redoc_url=None,
+    default_response_class=FastJSONResponse,
+)
 origins = [
     'http://localhost:3000',
     'https://avl-exam.tk/',
@@ -93,23 +114,13 @@ def custom_openapi():
 
     for route in api_router_:
         path = getattr(route, 'path')
-        endpoint = getattr(route, 'endpoint')
+        # declared by api.route_handler.jwt_cookie
+        jwt_cookies = getattr(route, 'jwt_cookies', frozenset())
         methods = [method.lower() for method in getattr(route, 'methods')]
 
         for method in methods:
             # access_token
-            if (
-                    re.search('jwt_required', inspect.getsource(endpoint)) or
-                    re.search(
-                        'update_user_from_jwt',
-                        inspect.getsource(endpoint)
-                    ) or
-                    re.search(
-                        'fresh_jwt_required',
-                        inspect.getsource(endpoint)
-                    ) or
-                    re.search('jwt_optional', inspect.getsource(endpoint))
-            ):
+            if ACCESS_TOKEN in jwt_cookies:
                 try:
                     openapi_schema['paths'][path][method]['parameters'].append(
                         access_token_cookie
@@ -126,10 +137,7 @@ def custom_openapi():
                     })
 
             # refresh_token
-            if re.search(
-                    'jwt_refresh_token_required',
-                    inspect.getsource(endpoint)
-            ):
+            if REFRESH_TOKEN in jwt_cookies:
                 try:
                     openapi_schema['paths'][path][method]['parameters'].append(
                         refresh_token_cookie
@@ -150,9 +158,50 @@ def custom_openapi():
 
 
 app.openapi = custom_openapi
+openapi_body = None
+
+
+def build_openapi() -> bytes:
+    """
+    Build openapi schema once and keep it serialized
+    Returns:
+        openapi json bytes
+    """
+    global openapi_body
+    if openapi_body is None:
+        openapi_body = json.dumps(app.openapi()).encode()
+        register_static(OPENAPI_URL, openapi_body, 'application/json')
+    return openapi_body
+
+
+@app.get(OPENAPI_URL, include_in_schema=False)
+async def openapi_json():
+    """openapi schema from build_openapi"""
+    return Response(build_openapi(), media_type='application/json')
+
+
+@app.get('/docs', include_in_schema=False)
+async def swagger_ui_html():
+    """Swagger UI"""
+    return get_swagger_ui_html(
+        openapi_url=OPENAPI_URL,
+        title=f'{FAST_API_TITLE} - Swagger UI',
+    )
+
+
+@app.get('/redoc', include_in_schema=False)
+async def redoc_html():
+    """ReDoc"""
+    return get_redoc_html(
+        openapi_url=OPENAPI_URL,
+        title=f'{FAST_API_TITLE} - ReDoc',
+    )
 
-secret_key = config.get('session_secret_key')
-app.add_middleware(SessionMiddleware, secret_key=secret_key)
+
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+# outermost, so total includes compression
+app.add_middleware(TimingMiddleware)
 app.include_router(api_router, prefix='/api')
 
 
@@ -166,6 +215,23 @@ def get_version():
     }
 
 
+@app.get('/metrics', include_in_schema=False)
+def get_metrics(request: Request):
+    """
+    Prometheus metrics of every worker, for the METRICS_TOKEN bearer only
+    """
+    if not metrics.METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail='Not Found')
+    if not metrics.authorized(request.headers.get('authorization')):
+        raise HTTPException(
+            status_code=401,
+            detail='Invalid metrics token',
+            headers={'WWW-Authenticate': 'Bearer'},
+        )
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
+
+
 # noinspection PyUnresolvedReferences,PyUnusedLocal
 @app.exception_handler(AuthJWTException)
 def authjwt_exception_handler(
@@ -187,23 +253,47 @@ def authjwt_exception_handler(
     )
 
 
-@app.middleware('http')
-async def add_pony(request: Request, call_next):
-    """Add db session with each api"""
-    with db_session:
-        response = await call_next(request)
-        return response
-
-
 @app.on_event('startup')
 async def startup():
     """
     intitial log before start server
+    tables are created by `python -m db.migrate`, not here
     """
     setup_logging()
+    init_db()
+    replica_monitor.start()
+    build_openapi()
+    activity_buffer.start()
+    await user_cache.start()
+    await admission.buckets.start()
+    email_dispatcher.start()
+    metadata_refresher.start()
+    metrics.stats_sync.start()
+    partition_maintainer.start()
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    """
+    flush activity and wait for running db queries before exit
+    """
+    await metrics.stats_sync.stop()
+    await partition_maintainer.stop()
+    await email_dispatcher.stop()
+    await metadata_refresher.stop()
+    await activity_buffer.stop()
+    await user_cache.stop()
+    await admission.buckets.stop()
+    await replica_monitor.stop()
+    db_executor.shutdown()
+    db.disconnect()
+    password_hasher.shutdown()
+    await close_client()
+    file_sink.stop()
 
 
 if __name__ == '__main__':
+    import uvicorn  # pylint: disable=import-outside-toplevel
     if DEBUG:
         uvicorn.run(
             'main:app',
@@ -0,0 +1,10 @@
+#! /usr/bin/env bash
+# run once by tiangolo/uvicorn-gunicorn-fastapi before the workers start
+python -m db.migrate
+# next activity partitions, old ones rolled up and dropped, see db/partitions.py
+python -m db.partitions maintain
+# metrics files of the previous run, see utils/metrics.py
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]; then
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+fi
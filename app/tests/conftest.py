@@ -0,0 +1,53 @@
+"""
+Shared fixtures, run from app/:
+    python -m pytest tests
+
+Database tests use the DB_* settings and are skipped when the database
+is unreachable, each test runs in a db_session that is rolled back
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# required settings, app/.env or the environment wins
+for key, value in {
+        'ENV': 'dev',
+        'session_secret_key': 'test',
+        'DB_USER': 'postgres',
+        'DB_PASSWORD': 'postgres',
+        'DB_HOST': '127.0.0.1',
+        'DB_PORT': '5432',
+        'DB_DATABASE_NAME': 'exam',
+        'BACKEND_BASE_URL': 'http://testserver',
+        'FRONTEND_BASE_URL': 'http://testserver',
+        'SENDGRID_FROM_MAIL': 'test@example.com',
+        'SENDGRID_API_KEY': 'test',
+}.items():
+    os.environ.setdefault(key, value)
+
+
+@pytest.fixture(scope='session')
+def database():
+    """Bound Pony database, tables created when missing"""
+    # pylint: disable=import-outside-toplevel
+    import psycopg2
+    from db.models import DB_PARAMS, db, init_db
+    try:
+        psycopg2.connect(connect_timeout=2, **DB_PARAMS).close()
+    except psycopg2.OperationalError:
+        pytest.skip('database is not reachable')
+    init_db(create_tables=True)
+    return db
+
+
+@pytest.fixture
+def session(database):  # pylint: disable=redefined-outer-name
+    """db_session rolled back after the test"""
+    # pylint: disable=import-outside-toplevel
+    from pony.orm import db_session, rollback
+    with db_session:
+        yield database
+        rollback()
@@ -0,0 +1,94 @@
+"""db.activity.ActivityBuffer write-behind flush"""
+# pytest fixtures are arguments of the same name
+# pylint: disable=redefined-outer-name,unused-argument
+import asyncio
+import datetime
+
+import pytest
+from db import models
+from db.activity import ActivityBuffer
+from pony.orm import commit, db_session
+
+EMAIL = 'activity-flush@example.com'
+LONG_AGO = datetime.datetime(2000, 1, 1)
+
+
+def delete_users():
+    """Remove the test user and its records"""
+    with db_session:
+        models.User.select(lambda x: x.email == EMAIL).delete()
+
+
+@pytest.fixture
+def user_id(database):
+    """User last seen long ago, committed for the flush's own db_session"""
+    delete_users()
+    with db_session:
+        user = models.User(
+            email=EMAIL, name='activity', register_from=1,
+            last_login_time=LONG_AGO,
+        )
+        commit()
+        created_id = user.id
+    yield created_id
+    delete_users()
+
+
+def flush(buffer: ActivityBuffer):
+    """One flush on a fresh loop"""
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(buffer.flush())
+    finally:
+        loop.close()
+
+
+def saved(user_id: int) -> tuple:
+    """(record times, last_login_time) of a fresh read"""
+    with db_session:
+        user = models.User[user_id]
+        times = sorted(record.created_at for record in user.records)
+        return times, user.last_login_time
+
+
+def test_hits_of_one_window_make_one_record(user_id):
+    buffer = ActivityBuffer(window=3600, flush_interval=60, max_size=10)
+    # start of the current window
+    first = datetime.datetime.fromtimestamp(
+        datetime.datetime.now().timestamp() // 3600 * 3600
+    )
+    last = first + datetime.timedelta(minutes=30)
+    for when in (first, last, first):
+        buffer.record(user_id, when)
+    flush(buffer)
+    assert saved(user_id) == ([first], last)
+    assert buffer.stats()['depth'] == 0
+    assert (buffer.recorded.value, buffer.collapsed.value) == (1, 2)
+    assert buffer.flushed.value == 1
+
+
+def test_older_hit_keeps_last_login_time(user_id):
+    later = datetime.datetime.now()
+    with db_session:
+        models.User[user_id].last_login_time = later
+    buffer = ActivityBuffer(window=60, flush_interval=60, max_size=10)
+    buffer.record(user_id, LONG_AGO)
+    flush(buffer)
+    assert saved(user_id) == ([LONG_AGO], later)
+
+
+def test_failed_flush_drops_batch(user_id, monkeypatch):
+    def write(batch):
+        raise RuntimeError('db down')
+
+    monkeypatch.setattr(ActivityBuffer, 'write', staticmethod(write))
+    buffer = ActivityBuffer(window=60, flush_interval=60, max_size=1)
+    buffer.record(user_id)
+    # over max_size, dropped before it reaches the db
+    buffer.record(user_id + 1)
+    flush(buffer)
+    stats = buffer.stats()
+    assert (stats['flush_errors'], stats['dropped'], stats['depth']) == (
+        1, 2, 0
+    )
+    assert saved(user_id) == ([], LONG_AGO)
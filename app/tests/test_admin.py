@@ -0,0 +1,63 @@
+"""Bulk user reads are limited to ADMIN_EMAILS"""
+# pytest fixtures are arguments of the same name
+# pylint: disable=redefined-outer-name,unused-argument
+import pytest
+from api import deps
+from db import models
+from fastapi_jwt_auth import AuthJWT
+from pony.orm import commit, db_session
+from starlette.testclient import TestClient
+
+import main
+
+ADMIN = 'admin-only-admin@example.com'
+MEMBER = 'admin-only-member@example.com'
+PATHS = [
+    '/api/user/search/?q=admin-only',
+    '/api/user/export/',
+    '/api/user/export/?table=records&format=csv',
+]
+
+
+def delete_users():
+    """Remove the test users"""
+    with db_session:
+        models.User.select(lambda x: x.email in (ADMIN, MEMBER)).delete()
+
+
+@pytest.fixture
+def users(database, monkeypatch):
+    """Committed admin and member, ADMIN is the only admin"""
+    delete_users()
+    with db_session:
+        for email in (ADMIN, MEMBER):
+            models.User(email=email, name='admin only', register_from=1)
+        commit()
+    monkeypatch.setattr(deps, 'ADMIN_EMAILS', frozenset([ADMIN]))
+    yield
+    delete_users()
+
+
+def get(path: str, email: str):
+    """GET path as the user of email"""
+    token = AuthJWT().create_access_token(subject=email)
+    return TestClient(main.app).get(
+        f'https://testserver{path}',
+        cookies={'access_token_cookie': token},
+    )
+
+
+@pytest.mark.parametrize('path', PATHS)
+def test_member_is_403(users, path):
+    assert get(path, MEMBER).status_code == 403
+
+
+@pytest.mark.parametrize('path', PATHS)
+def test_admin_is_200(users, path):
+    assert get(path, ADMIN).status_code == 200
+
+
+def test_search_finds_users_for_admin(users):
+    response = get('/api/user/search/?q=admin-only&mode=prefix', ADMIN)
+    emails = {user['email'] for user in response.json()['data']}
+    assert emails == {ADMIN, MEMBER}
@@ -0,0 +1,97 @@
+"""Token buckets and the adaptive concurrency limit of utils.admission"""
+# pylint: disable=protected-access
+import asyncio
+
+import pytest
+from utils.admission import AdaptiveLimit, Buckets, RateLimit
+
+
+def test_rate_limit_parse():
+    limit = RateLimit.parse('30/60')
+    assert limit.burst == 30
+    assert limit.rate == 0.5
+    assert limit.full_after() == 60
+    assert RateLimit.parse('5').rate == 5
+    assert RateLimit.parse('') is None
+    assert RateLimit.parse(None) is None
+
+
+def test_bucket_burst_then_refill():
+    buckets = Buckets(max_keys=10)
+    limit = RateLimit(3, 3)  # one token per second
+    for _ in range(3):
+        assert buckets._take_local('k', limit, 100.0) == 0
+    # empty, one token in a second
+    assert buckets._take_local('k', limit, 100.0) == pytest.approx(1.0)
+    assert buckets._take_local('k', limit, 100.5) == pytest.approx(0.5)
+    assert buckets._take_local('k', limit, 101.0) == 0
+    # refill stops at burst
+    for _ in range(3):
+        assert buckets._take_local('k', limit, 200.0) == 0
+    assert buckets._take_local('k', limit, 200.0) > 0
+
+
+def test_buckets_are_per_key():
+    buckets = Buckets(max_keys=10)
+    limit = RateLimit(1, 60)
+    assert buckets._take_local('a', limit, 0.0) == 0
+    assert buckets._take_local('a', limit, 0.0) == pytest.approx(60)
+    assert buckets._take_local('b', limit, 0.0) == 0
+
+
+def test_take_without_redis_is_local():
+    buckets = Buckets(max_keys=10)
+    limit = RateLimit(1, 60)
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(buckets.take('k', limit)) == 0
+        assert loop.run_until_complete(buckets.take('k', limit)) > 0
+    finally:
+        loop.close()
+    assert buckets.backend == 'local'
+
+
+def test_adaptive_limit_slots():
+    limiter = AdaptiveLimit(max_limit=2, tolerance=2.0)
+    assert limiter.acquire()
+    assert limiter.acquire()
+    assert limiter.full()
+    assert not limiter.acquire()
+    limiter.release(0.01)
+    assert limiter.in_flight == 1
+    assert limiter.acquire()
+
+
+def test_adaptive_limit_backs_off_and_recovers():
+    limiter = AdaptiveLimit(max_limit=10, tolerance=2.0, window=1000)
+    for _ in range(20):
+        limiter.acquire()
+        limiter.release(0.01)
+    assert limiter.no_load == pytest.approx(0.01)
+    assert limiter.limit == 10
+    for _ in range(100):
+        limiter.acquire()
+        limiter.release(0.1)
+    assert limiter.limit < 5
+    # never under min_limit
+    for _ in range(1000):
+        limiter.acquire()
+        limiter.release(0.1)
+    assert limiter.limit == pytest.approx(limiter.min_limit)
+    # additive increase back to the budget, never over it
+    for _ in range(1000):
+        limiter.acquire()
+        limiter.release(0.01)
+    assert limiter.limit == 10
+
+
+def test_adaptive_limit_no_load_grows_slowly():
+    limiter = AdaptiveLimit(max_limit=4, tolerance=2.0, window=10)
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release(0.01)
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release(1.0)
+    # at most 5% per window
+    assert limiter.no_load == pytest.approx(0.0105)
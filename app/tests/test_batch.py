@@ -0,0 +1,64 @@
+"""db.batch set-based user operations"""
+# pytest fixtures are arguments of the same name
+# pylint: disable=redefined-outer-name,unused-argument
+import pytest
+from db import batch, models
+from pony.orm import flush
+
+PREFIX = 'batch-'
+
+
+@pytest.fixture
+def users(session):
+    """(new, verified, deleted) users of the rolled back session"""
+    created = [
+        models.User(
+            email=f'{PREFIX}{name}@example.com', name=name, register_from=1,
+            verify=name == 'verified', deleted=name == 'deleted',
+        )
+        for name in ('new', 'verified', 'deleted')
+    ]
+    flush()
+    return created
+
+
+def statuses(results: list) -> list:
+    """(key, status) of every item"""
+    return [(item['key'], item['status']) for item in results]
+
+
+def test_lookup_keeps_input_order(users):
+    new, _, deleted = users
+    missing = f'{PREFIX}missing@example.com'
+    results, changed = batch.run(
+        'lookup', [deleted.email, missing, deleted.email], [new.id]
+    )
+    assert statuses(results) == [
+        (deleted.email, 'deleted'), (missing, 'not_found'), (new.id, 'found')
+    ]
+    assert results[2]['user']['email'] == new.email
+    assert not changed
+
+
+def test_verify_changes_only_unverified(users):
+    new, verified, deleted = users
+    results, changed = batch.run(
+        'verify', [new.email, verified.email, deleted.email], []
+    )
+    assert statuses(results) == [
+        (new.email, 'verified'),
+        (verified.email, 'unchanged'),
+        (deleted.email, 'deleted'),
+    ]
+    assert changed == [new.email]
+
+
+def test_delete_skips_deleted(users):
+    new, _, deleted = users
+    results, changed = batch.run(
+        'delete', [new.email], [new.id, deleted.id, new.id]
+    )
+    assert statuses(results) == [
+        (new.email, 'deleted'), (new.id, 'deleted'), (deleted.id, 'unchanged')
+    ]
+    assert changed == [new.email]
@@ -0,0 +1,102 @@
+"""utils.compression.CompressionMiddleware"""
+import gzip
+import zlib
+
+import brotli
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse, StreamingResponse
+from starlette.testclient import TestClient
+from utils import compression
+from utils.compression import CompressionMiddleware
+
+BODY = 'compress me ' * 100
+
+
+def create_app() -> Starlette:
+    """Large, small, streaming and already encoded responses"""
+    app = Starlette()
+
+    @app.route('/large')
+    async def large(_):
+        return PlainTextResponse(BODY)
+
+    @app.route('/small')
+    async def small(_):
+        return PlainTextResponse('tiny')
+
+    @app.route('/stream')
+    async def stream(_):
+        async def chunks():
+            for _ in range(3):
+                yield BODY
+
+        return StreamingResponse(chunks(), media_type='text/plain')
+
+    @app.route('/encoded')
+    async def encoded(_):
+        return PlainTextResponse(
+            gzip.compress(BODY.encode()), headers={'Content-Encoding': 'gzip'}
+        )
+
+    app.add_middleware(CompressionMiddleware, minimum_size=500)
+    return app
+
+
+def get(path: str, accept_encoding: str):
+    """Response without the client's own decoding"""
+    response = TestClient(create_app()).get(
+        path, headers={'Accept-Encoding': accept_encoding}, stream=True
+    )
+    return response, response.raw.read(decode_content=False)
+
+
+def test_negotiate():
+    assert compression.negotiate('gzip, br') == 'br'
+    assert compression.negotiate('br;q=0.5, gzip') == 'gzip'
+    assert compression.negotiate('*') == 'br'
+    assert compression.negotiate('br;q=0, gzip;q=0') is None
+    assert compression.negotiate('') is None
+
+
+def test_large_body_is_compressed():
+    response, body = get('/large', 'gzip')
+    assert response.headers['content-encoding'] == 'gzip'
+    assert response.headers['vary'] == 'Accept-Encoding'
+    assert int(response.headers['content-length']) == len(body)
+    assert gzip.decompress(body).decode() == BODY
+    response, body = get('/large', 'br')
+    assert response.headers['content-encoding'] == 'br'
+    assert brotli.decompress(body).decode() == BODY
+
+
+def test_small_and_identity_are_untouched():
+    for path, accept_encoding in (('/small', 'gzip'), ('/large', '')):
+        response, body = get(path, accept_encoding)
+        assert 'content-encoding' not in response.headers
+        assert body.decode() in ('tiny', BODY)
+
+
+def test_encoded_response_is_not_compressed_again():
+    response, body = get('/encoded', 'br')
+    assert response.headers['content-encoding'] == 'gzip'
+    assert gzip.decompress(body).decode() == BODY
+
+
+def test_stream_is_compressed_per_chunk():
+    response, body = get('/stream', 'gzip')
+    assert response.headers['content-encoding'] == 'gzip'
+    assert 'content-length' not in response.headers
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert decompressor.decompress(body).decode() == BODY * 3
+    assert decompressor.eof
+
+
+def test_static_body_is_served_precompressed():
+    compression.register_static('/static', BODY.encode(), 'text/plain')
+    try:
+        response, body = get('/static', 'gzip')
+    finally:
+        del compression._static['/static']  # pylint: disable=protected-access
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'text/plain'
+    assert gzip.decompress(body).decode() == BODY
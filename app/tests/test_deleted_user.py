@@ -0,0 +1,41 @@
+"""Routes which need a live user answer 401 for a deleted one"""
+# pylint: disable=redefined-outer-name,unused-argument
+import pytest
+from db import models
+from fastapi_jwt_auth import AuthJWT
+from pony.orm import commit, db_session
+from starlette.testclient import TestClient
+
+import main
+
+EMAIL = 'deleted-user@example.com'
+
+
+@pytest.fixture
+def deleted_user(database):
+    """Committed, the request reads it from another db_session"""
+    with db_session:
+        models.User.select(lambda x: x.email == EMAIL).delete()
+        models.User(
+            email=EMAIL, name='deleted', register_from=1, deleted=True
+        )
+        commit()
+    yield EMAIL
+    with db_session:
+        models.User.select(lambda x: x.email == EMAIL).delete()
+
+
+@pytest.mark.parametrize('path', [
+    '/api/user/',
+    '/api/user/search/?q=abc',
+    '/api/user/export/',
+    '/api/user/statistics/',
+])
+def test_deleted_user_is_401(deleted_user, path):
+    token = AuthJWT().create_access_token(subject=deleted_user)
+    client = TestClient(main.app)
+    response = client.get(
+        f'https://testserver{path}',
+        cookies={'access_token_cookie': token},
+    )
+    assert response.status_code == 401
@@ -0,0 +1,165 @@
+"""Streaming export of db.export on a pooled connection"""
+# pytest fixtures are arguments of the same name
+# pylint: disable=redefined-outer-name,unused-argument
+import asyncio
+import datetime
+import json
+
+import pytest
+from db import export, models
+from db.activity import ActivityBuffer
+from db.models import db
+from pony.orm import commit, db_session
+from prometheus_client import REGISTRY
+from utils import timing
+
+EMAIL = 'export-since@example.com'
+
+
+@pytest.fixture
+def loop(database):
+    """Event loop of one test"""
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def in_use() -> int:
+    """Checked out connections of the pool"""
+    return db.provider.pool.stats()['in_use']
+
+
+async def collect(chunks) -> bytes:
+    """Every chunk joined"""
+    return b''.join([chunk async for chunk in chunks])
+
+
+def test_csv_header_without_rows(loop):
+    before = in_use()
+    future = datetime.datetime(2999, 1, 1)
+    body = loop.run_until_complete(collect(
+        export.iter_export('users', 'csv', since=future)
+    ))
+    assert body.decode().splitlines() == [
+        'id,email,name,register_from,verify,login_count,last_login_time,'
+        'created_at,updated_at,deleted,deleted_at'
+    ]
+    assert in_use() == before
+
+
+def test_ndjson_chunks(loop):
+    body = loop.run_until_complete(collect(
+        export.iter_export('users', 'ndjson', chunk_size=2)
+    ))
+    lines = body.decode().splitlines()
+    ids = [json.loads(line)['id'] for line in lines]
+    assert ids == sorted(ids)
+
+
+@pytest.fixture
+def old_user(database):
+    """User created and last seen long ago, committed"""
+    long_ago = datetime.datetime(2000, 1, 1)
+    with db_session:
+        models.User.select(lambda x: x.email == EMAIL).delete()
+        user = models.User(
+            email=EMAIL, name='export', register_from=1,
+            created_at=long_ago, last_login_time=long_ago,
+        )
+        commit()
+        user_id = user.id
+    yield user_id
+    with db_session:
+        models.User.select(lambda x: x.email == EMAIL).delete()
+
+
+@pytest.fixture
+def timer():
+    """RequestTimer of a request running the test"""
+    timer = timing.RequestTimer()
+    token = timing._timer.set(timer)  # pylint: disable=protected-access
+    yield timer
+    timing._timer.reset(token)  # pylint: disable=protected-access
+
+
+def queries() -> float:
+    """Value of DB_QUERIES"""
+    return REGISTRY.get_sample_value('db_queries_total')
+
+
+def test_export_sql_is_counted_and_timed(loop, timer):
+    before = queries()
+    loop.run_until_complete(collect(
+        export.iter_export('users', 'ndjson', chunk_size=2)
+    ))
+    # SET and DECLARE in one span, then a span per FETCH
+    statements = queries() - before
+    assert statements >= 3
+    assert timer.spans['db'][1] == statements - 1
+
+
+def test_activity_sql_is_counted_and_timed(old_user, timer):
+    before = queries()
+    now = datetime.datetime.now()
+    with db_session:
+        ActivityBuffer.write({old_user: [now, [now]]})
+    # one INSERT of records and one UPDATE of last login times
+    assert queries() - before == 2
+    assert timer.spans['db'][1] == 2
+
+
+def test_since_includes_activity(loop, old_user):
+    since = datetime.datetime.now() - datetime.timedelta(seconds=1)
+
+    def exported_ids():
+        body = loop.run_until_complete(collect(
+            export.iter_export('users', 'ndjson', since=since)
+        ))
+        return [json.loads(line)['id'] for line in body.decode().splitlines()]
+
+    assert old_user not in exported_ids()
+    with db_session:
+        ActivityBuffer.write({old_user: [datetime.datetime.now(), []]})
+    assert old_user in exported_ids()
+
+
+def test_connection_back_when_stream_is_closed_early(loop):
+    before = in_use()
+
+    async def first_chunk_only():
+        chunks = await export.prefetch(
+            export.iter_export('records', 'csv', chunk_size=1)
+        )
+        await chunks.__anext__()
+        assert in_use() == before + 1
+        # what the server does to a stream of a disconnected client
+        await chunks.aclose()
+
+    loop.run_until_complete(first_chunk_only())
+    assert in_use() == before
+
+
+def test_connection_back_when_stream_is_cancelled(loop):
+    before = in_use()
+
+    async def stream(started: asyncio.Event):
+        async for _ in await export.prefetch(
+                export.iter_export('records', 'csv', chunk_size=1)
+        ):
+            started.set()
+            await asyncio.sleep(10)
+
+    async def cancel():
+        started = asyncio.Event()
+        task = loop.create_task(stream(started))
+        await started.wait()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        # the loop closes the abandoned stream, like a running server
+        for _ in range(200):
+            if in_use() == before:
+                break
+            await asyncio.sleep(0.01)
+
+    loop.run_until_complete(cancel())
+    assert in_use() == before
@@ -0,0 +1,79 @@
+"""utils.encrypt hash versions and utils.hasher.PasswordHasher"""
+# pytest fixtures are arguments of the same name
+# pylint: disable=redefined-outer-name,unused-argument
+import asyncio
+import threading
+
+import pytest
+from fastapi.exceptions import HTTPException
+from utils import encrypt
+from utils.hasher import PasswordHasher
+
+PASSWORD = 'hasher-password'
+
+
+@pytest.fixture
+def version_2(monkeypatch):
+    """HASH_VERSIONS with a newer current version"""
+    monkeypatch.setitem(encrypt.HASH_VERSIONS, 2, ('sha512', 1000))
+    monkeypatch.setattr(encrypt, 'CURRENT_HASH_VERSION', 2)
+
+
+def test_old_version_still_checks(version_2):
+    salt = encrypt.get_salt()
+    old = encrypt.make_password(PASSWORD, salt, version=1)
+    new = encrypt.make_password(PASSWORD, salt)
+    assert new.startswith('v2$')
+    assert encrypt.parse_password(old) == (1, old)
+    for password in (old, new):
+        assert encrypt.check_password(PASSWORD, salt, password)
+        assert not encrypt.check_password('wrong', salt, password)
+    assert encrypt.needs_rehash(old)
+    assert not encrypt.needs_rehash(new)
+
+
+def test_make_and_check_password():
+    hasher = PasswordHasher(max_workers=1, max_queue=0, kind='thread')
+    loop = asyncio.new_event_loop()
+    try:
+        salt, password = loop.run_until_complete(
+            hasher.make_password(PASSWORD)
+        )
+        assert loop.run_until_complete(
+            hasher.check_password(PASSWORD, salt, password)
+        )
+        assert not loop.run_until_complete(
+            hasher.check_password(PASSWORD, None, None)
+        )
+    finally:
+        loop.close()
+        hasher.shutdown()
+    assert hasher.stats()['hash_time']['count'] == 2
+
+
+def test_full_queue_is_503():
+    hasher = PasswordHasher(max_workers=1, max_queue=0, kind='thread')
+    release = threading.Event()
+
+    async def overload():
+        running = asyncio.ensure_future(hasher.run(release.wait))
+        while not hasher.pending:
+            await asyncio.sleep(0)
+        try:
+            with pytest.raises(HTTPException) as exc_info:
+                await hasher.run(release.wait)
+        finally:
+            release.set()
+            await running
+        return exc_info.value
+
+    loop = asyncio.new_event_loop()
+    try:
+        exc = loop.run_until_complete(overload())
+    finally:
+        loop.close()
+        hasher.shutdown()
+    assert exc.status_code == 503
+    assert exc.headers == {'Retry-After': '1'}
+    assert hasher.stats()['rejected'] == 1
+    assert hasher.pending == 0
@@ -0,0 +1,72 @@
+"""CachedAuthJWT verifies a token once, api.deps.jwt_cache"""
+# pytest fixtures are arguments of the same name
+# pylint: disable=redefined-outer-name,unused-argument
+import pytest
+from api import deps
+from fastapi_jwt_auth import AuthJWT
+from starlette.testclient import TestClient
+
+import main
+
+EMAIL = 'jwt-cache@example.com'
+
+
+@pytest.fixture
+def verified(monkeypatch):
+    """Tokens verified by AuthJWT, jwt_cache starts empty"""
+    tokens = []
+    verify = AuthJWT._verified_token  # pylint: disable=protected-access
+
+    def counted(self, encoded_token, issuer=None):
+        tokens.append(encoded_token)
+        return verify(self, encoded_token, issuer)
+
+    monkeypatch.setattr(AuthJWT, '_verified_token', counted)
+    deps.jwt_cache.clear()
+    yield tokens
+    deps.jwt_cache.clear()
+
+
+def profile(token: str, csrf: str = None) -> int:
+    """Status code of GET /api/user/profile/ with token"""
+    headers = {'X-CSRF-Token': csrf} if csrf else {}
+    return TestClient(main.app).get(
+        'https://testserver/api/user/profile/',
+        cookies={'access_token_cookie': token},
+        headers=headers,
+    ).status_code
+
+
+def test_token_verified_once(database, verified):
+    token = AuthJWT().create_access_token(subject=EMAIL)
+    hits = deps.jwt_cache.hits.value
+    # no such user, the token itself is fine
+    assert profile(token) == 404
+    assert profile(token) == 404
+    assert verified == [token]
+    stats = deps.jwt_cache_stats()
+    assert stats['hits'] > hits
+    assert stats['size'] == 1
+
+
+def test_bad_signature_is_not_cached(database, verified):
+    token = AuthJWT().create_access_token(subject=EMAIL)
+    header, payload, signature = token.split('.')
+    forged = '.'.join([header, payload, signature[::-1]])
+    for _ in range(2):
+        # signature fail, see main.authjwt_exception_handler
+        assert profile(forged) == 403
+    assert verified == [forged, forged]
+    assert deps.jwt_cache.stats()['size'] == 0
+
+
+def test_csrf_checked_on_cached_token(database, verified):
+    token = AuthJWT().create_access_token(subject=EMAIL)
+    assert profile(token) == 404
+    response = TestClient(main.app).put(
+        'https://testserver/api/user/',
+        json={'name': 'no csrf'},
+        cookies={'access_token_cookie': token},
+    )
+    assert response.status_code == 401
+    assert verified == [token]
@@ -0,0 +1,58 @@
+"""Writer thread of utils.log.QueuedFileSink"""
+import os
+import time
+
+from utils import log
+from utils.log import QueuedFileSink
+
+
+def wait_for(condition, timeout: float = 2.0):
+    """Poll until the writer thread did its part"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_writes_daily_file_and_removes_old(tmp_path):
+    (tmp_path / '20000101.log').write_text('old\n')
+    sink = QueuedFileSink(str(tmp_path), max_queue=10, retention_days=7)
+    sink.start()
+    sink.write('a\n')
+    sink.write('b\n')
+    sink.stop()
+    files = os.listdir(tmp_path)
+    assert len(files) == 1
+    assert (tmp_path / files[0]).read_text() == 'a\nb\n'
+    assert sink.stats()['written'] == 2
+
+
+def test_old_file_removed_by_another_worker(tmp_path, monkeypatch):
+    (tmp_path / '20000101.log').write_text('old\n')
+
+    def remove(path):
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(log.os, 'remove', remove)
+    sink = QueuedFileSink(str(tmp_path), max_queue=10, retention_days=7)
+    sink.start()
+    sink.write('a\n')
+    sink.stop()
+    assert sink.stats()['written'] == 1
+    assert sink.stats()['failed'] == 0
+
+
+def test_write_failure_keeps_thread_alive(tmp_path, capsys):
+    directory = tmp_path / 'logs'
+    sink = QueuedFileSink(str(directory), max_queue=10, retention_days=7)
+    sink.start()
+    # no directory yet, the batch goes to stderr
+    sink.write('lost\n')
+    wait_for(lambda: sink.stats()['failed'] == 1)
+    directory.mkdir()
+    sink.write('kept\n')
+    sink.stop()
+    assert capsys.readouterr().err == 'lost\n'
+    assert sink.stats()['written'] == 1
+    (file,) = directory.iterdir()
+    assert file.read_text() == 'kept\n'
@@ -0,0 +1,80 @@
+"""POST /api/auth/login/"""
+# pytest fixtures are arguments of the same name
+# pylint: disable=redefined-outer-name,unused-argument
+import pytest
+from db import models
+from pony.orm import commit, db_session
+from starlette.testclient import TestClient
+from utils import encrypt
+from utils.hasher import password_hasher
+
+import main
+
+EMAIL = 'login-race@example.com'
+PASSWORD = 'login-password'
+
+
+def delete_users():
+    """Remove the test user"""
+    with db_session:
+        models.User.select(lambda x: x.email == EMAIL).delete()
+
+
+@pytest.fixture
+def web_user(database):
+    """Verified web user, committed for the request's own db_session"""
+    delete_users()
+    salt = encrypt.get_salt()
+    with db_session:
+        models.User(
+            email=EMAIL,
+            name='login',
+            register_from=1,
+            verify=True,
+            salt=encrypt.transfter_salt_to_str(salt),
+            password=encrypt.make_password(PASSWORD, salt),
+        )
+        commit()
+    yield EMAIL
+    delete_users()
+
+
+def login() -> int:
+    """Status code of a login of the test user"""
+    client = TestClient(main.app)
+    response = client.post(
+        'https://testserver/api/auth/login/',
+        json={'email': EMAIL, 'password': PASSWORD},
+    )
+    return response.status_code
+
+
+def test_login(web_user):
+    assert login() == 200
+
+
+def test_user_deleted_during_password_check(web_user, monkeypatch):
+    check_password = password_hasher.check_password
+
+    async def delete_then_check(*args):
+        with db_session:
+            models.User.get(email=EMAIL).deleted = True
+        return await check_password(*args)
+
+    monkeypatch.setattr(password_hasher, 'check_password', delete_then_check)
+    assert login() == 401
+
+
+def test_login_rehashes_old_version(web_user, monkeypatch):
+    monkeypatch.setitem(encrypt.HASH_VERSIONS, 2, ('sha512', 1000))
+    monkeypatch.setattr(encrypt, 'CURRENT_HASH_VERSION', 2)
+    assert login() == 200
+    with db_session:
+        user = models.User.get(email=EMAIL)
+        salt, password = user.salt, user.password
+    assert password.startswith('v2$')
+    assert encrypt.check_password(
+        PASSWORD, encrypt.transfer_salt_str_to_bytes(salt), password
+    )
+    # the new hash is used from now on
+    assert login() == 200
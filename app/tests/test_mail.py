@@ -0,0 +1,174 @@
+"""utils.mail outbox against benchmarks.fake_sendgrid"""
+# pytest fixtures are arguments of the same name
+# pylint: disable=redefined-outer-name,unused-argument
+import asyncio
+import datetime
+
+import httpx
+import pytest
+from benchmarks.fake_sendgrid import FakeSendGrid, create_app
+from db import models
+from pony.orm import commit, db_session
+from starlette.testclient import TestClient
+from utils import http, mail
+
+import main
+
+# every row of these tests, other pending rows are sent to the fake as well
+PREFIX = 'outbox-'
+RETRY_BASE = 60
+
+
+def delete_rows():
+    """Remove the test users and their mails"""
+    with db_session:
+        models.EmailOutbox.select(lambda x: x.to.startswith(PREFIX)).delete()
+        models.User.select(lambda x: x.email.startswith(PREFIX)).delete()
+
+
+@pytest.fixture
+def outbox(database):
+    """Clean outbox rows of the tests"""
+    delete_rows()
+    yield
+    delete_rows()
+
+
+def run(coroutine):
+    """Run coroutine on a fresh loop"""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def drain(email_dispatcher: mail.EmailDispatcher):
+    """One drain, every due row is sent"""
+    run(email_dispatcher.drain())
+
+
+@pytest.fixture
+def sendgrid(monkeypatch):
+    """FakeSendGrid behind the shared http client"""
+    fake = FakeSendGrid(latency=0)
+    client = httpx.AsyncClient(app=create_app(fake))
+    monkeypatch.setattr(http, '_client', client)
+    monkeypatch.setattr(http, '_breakers', {})
+    yield fake
+    run(client.aclose())
+
+
+def dispatcher(max_attempts: int = 3) -> mail.EmailDispatcher:
+    """Dispatcher without background workers, drained by the test"""
+    return mail.EmailDispatcher(
+        workers=1, batch_size=2, poll_interval=1,
+        max_attempts=max_attempts, retry_base=RETRY_BASE,
+    )
+
+
+def add_mail(index: int = 0) -> int:
+    """Committed pending row, returns its id"""
+    with db_session:
+        row = models.EmailOutbox(
+            to=f'{PREFIX}{index}@example.com', subject='Hi', message='Hello'
+        )
+        commit()
+        return row.id
+
+
+def get_row(row_id: int) -> tuple:
+    """(status, attempts, next_attempt_at, last_error) of a fresh read"""
+    with db_session:
+        return models.db.select(
+            'SELECT status, attempts, next_attempt_at, last_error '
+            'FROM "EmailOutbox" WHERE id = $row_id'
+        )[0]
+
+
+def make_due(row_id: int):
+    """Let a scheduled retry run now"""
+    with db_session:
+        models.db.execute(
+            'UPDATE "EmailOutbox" SET next_attempt_at = now() '
+            'WHERE id = $row_id'
+        )
+
+
+def test_signup_commits_row_without_sending(outbox, monkeypatch):
+    calls = []
+
+    async def request(*args, **kwargs):
+        calls.append(args)
+
+    monkeypatch.setattr(mail, 'request', request)
+    email = f'{PREFIX}signup@example.com'
+    response = TestClient(main.app).post(
+        'https://testserver/api/user/signup/',
+        json={'email': email, 'name': 'outbox', 'password': 'Password1!'},
+    )
+    assert response.status_code == 200
+    assert not calls
+    with db_session:
+        rows = models.db.select(
+            'SELECT status, attempts FROM "EmailOutbox" WHERE "to" = $email'
+        )
+    assert rows == [(models.EmailOutbox.PENDING, 0)]
+
+
+def test_drain_sends_every_batch(outbox, sendgrid):
+    row_ids = [add_mail(index) for index in range(3)]
+    email_dispatcher = dispatcher()
+    drain(email_dispatcher)
+    assert sorted(sendgrid.recipients()) == [
+        f'{PREFIX}{index}@example.com' for index in range(3)
+    ]
+    for row_id in row_ids:
+        status, attempts, _, last_error = get_row(row_id)
+        assert (status, attempts, last_error) == (
+            models.EmailOutbox.SENT, 1, None
+        )
+    stats = email_dispatcher.stats()
+    assert (stats['sent'], stats['send_time']['count']) == (3, 3)
+
+
+def test_retry_backs_off(outbox, sendgrid):
+    row_id = add_mail()
+    delays = []
+    for status in (503, 429):
+        sendgrid.statuses.append(status)
+        started_at = datetime.datetime.now()
+        drain(dispatcher())
+        row_status, _, next_attempt_at, last_error = get_row(row_id)
+        assert row_status == models.EmailOutbox.PENDING
+        assert last_error.startswith(str(status))
+        delays.append((next_attempt_at - started_at).total_seconds())
+        make_due(row_id)
+    assert RETRY_BASE <= delays[0] < 2 * RETRY_BASE <= delays[1]
+    assert not sendgrid.sent
+
+
+def test_failed_after_max_attempts(outbox, sendgrid):
+    row_id = add_mail()
+    sendgrid.statuses.extend([503, 503])
+    email_dispatcher = dispatcher(max_attempts=2)
+    drain(email_dispatcher)
+    make_due(row_id)
+    drain(email_dispatcher)
+    status, attempts, _, last_error = get_row(row_id)
+    assert (status, attempts) == (models.EmailOutbox.FAILED, 2)
+    assert last_error.startswith('503')
+    stats = email_dispatcher.stats()
+    assert (stats['retried'], stats['failed']) == (1, 1)
+    # failed rows are not claimed again
+    make_due(row_id)
+    drain(email_dispatcher)
+    assert get_row(row_id)[1] == 2
+    assert not sendgrid.sent
+
+
+def test_bad_request_is_not_retried(outbox, sendgrid):
+    row_id = add_mail()
+    sendgrid.statuses.append(400)
+    drain(dispatcher())
+    assert get_row(row_id)[:2] == (models.EmailOutbox.FAILED, 1)
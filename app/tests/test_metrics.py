@@ -0,0 +1,35 @@
+"""Token check and content of GET /metrics"""
+import pytest
+from prometheus_client import REGISTRY
+from utils import metrics
+from utils.mail import email_dispatcher
+from utils.stats import Histogram
+
+
+@pytest.mark.parametrize('authorization, expected', [
+    ('Bearer secret', True),
+    ('bearer secret', True),
+    ('Bearer other', False),
+    ('Basic secret', False),
+    ('secret', False),
+    ('', False),
+    (None, False),
+])
+def test_authorized(monkeypatch, authorization, expected):
+    monkeypatch.setattr(metrics, 'METRICS_TOKEN', 'secret')
+    assert metrics.authorized(authorization) is expected
+
+
+def test_no_token_never_authorized(monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_TOKEN', '')
+    assert not metrics.authorized('Bearer ')
+
+
+def test_sync_copies_email_send_time(monkeypatch):
+    send_time = Histogram()
+    send_time.observe(0.25)
+    monkeypatch.setattr(email_dispatcher, 'send_time', send_time)
+    before = REGISTRY.get_sample_value('email_send_seconds_total') or 0
+    metrics.StatsSync(interval=1).sync()
+    after = REGISTRY.get_sample_value('email_send_seconds_total')
+    assert after - before == pytest.approx(0.25)
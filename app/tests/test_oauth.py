@@ -0,0 +1,66 @@
+"""Provider responses of utils.oauth"""
+import asyncio
+import types
+
+import pytest
+from utils import oauth
+
+
+class FakeResponse:
+    """status_code and json() of an httpx response"""
+
+    def __init__(self, status_code: int, body):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        if isinstance(self.body, Exception):
+            raise self.body
+        return self.body
+
+
+def callback(state: str = 'state'):
+    """Request of the provider redirect, state saved by authorization_url"""
+    return types.SimpleNamespace(
+        session={'oauth_facebook_state': state},
+        query_params={'state': state, 'code': 'code'},
+    )
+
+
+def exchange(monkeypatch, response: FakeResponse) -> dict:
+    """Run facebook.exchange against response"""
+
+    async def request(*args, **kwargs):  # pylint: disable=unused-argument
+        return response
+
+    monkeypatch.setattr(oauth, 'request', request)
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            oauth.facebook.exchange(callback(), 'http://testserver/cb')
+        )
+    finally:
+        loop.close()
+
+
+def test_provider_is_abstract():
+    with pytest.raises(TypeError):
+        oauth.OAuthProvider(  # pylint: disable=abstract-class-instantiated
+            name='x', client_id='', client_secret='', scope=''
+        )
+
+
+def test_exchange_returns_token(monkeypatch):
+    token = {'access_token': 'a'}
+    assert exchange(monkeypatch, FakeResponse(200, token)) == token
+
+
+@pytest.mark.parametrize('body', [ValueError('html page'), ['a'], None])
+def test_exchange_bad_body_is_oauth_error(monkeypatch, body):
+    with pytest.raises(oauth.OAuthError):
+        exchange(monkeypatch, FakeResponse(200, body))
+
+
+def test_exchange_refused(monkeypatch):
+    with pytest.raises(oauth.OAuthError, match='400'):
+        exchange(monkeypatch, FakeResponse(400, {}))
@@ -0,0 +1,8 @@
+"""openapi schema built on startup"""
+import main
+
+
+def test_openapi_builds():
+    schema = main.app.openapi()
+    assert '/api/user/' in schema['paths']
+    assert 'UserResponsePage' in schema['components']['schemas']
@@ -0,0 +1,160 @@
+"""Keyset cursor mode of api.deps.Pagination"""
+# pytest fixtures are arguments of the same name
+# pylint: disable=redefined-outer-name,unused-argument
+import datetime
+import types
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+from api.deps import Pagination
+from db import models, schemas
+from fastapi.exceptions import HTTPException
+from pony.orm import flush
+from starlette.requests import Request
+
+BASE = datetime.datetime(2021, 1, 1)
+FIELDS = tuple(schemas.UserResponse.__fields__)
+
+
+def make_request(query: str = '') -> Request:
+    """Request of GET /api/user/?query"""
+    return Request({
+        'type': 'http',
+        'method': 'GET',
+        'scheme': 'http',
+        'server': ('testserver', 80),
+        'path': '/api/user/',
+        'query_string': query.encode(),
+        'headers': [],
+    })
+
+
+def make_page(limit: int, cursor: str = '') -> Pagination:
+    """Pagination in cursor mode"""
+    return Pagination(
+        make_request(), offset=0, limit=limit, cursor=cursor,
+        with_count=False,
+    )
+
+
+def cursor_of(url: str) -> str:
+    """cursor query param of a next/previous url"""
+    return parse_qs(urlsplit(url).query, keep_blank_values=True)['cursor'][0]
+
+
+def test_cursor_round_trip():
+    row = types.SimpleNamespace(
+        created_at=datetime.datetime(2021, 2, 3, 4, 5, 6, 789), id=42
+    )
+    for forward in (True, False):
+        cursor = Pagination.encode_cursor(row, forward)
+        assert '=' not in cursor
+        assert Pagination.decode_cursor(cursor) == (
+            (row.created_at, row.id), forward
+        )
+
+
+def test_empty_cursor_is_first_page():
+    assert Pagination.decode_cursor('') == (None, True)
+
+
+@pytest.mark.parametrize('cursor', ['x', '!!!', 'WzFd', 'bnVsbA'])
+def test_invalid_cursor(cursor):
+    with pytest.raises(HTTPException) as info:
+        Pagination.decode_cursor(cursor)
+    assert info.value.status_code == 422
+
+
+@pytest.fixture
+def users(session):
+    """7 users, the first 3 share created_at so id breaks the tie"""
+    rows = []
+    for index in range(7):
+        created_at = BASE if index < 3 else BASE + datetime.timedelta(
+            seconds=index
+        )
+        rows.append(models.User(
+            email=f'page{index}@example.com',
+            name=f'page {index}',
+            register_from=1,
+            created_at=created_at,
+        ))
+    flush()
+    return rows
+
+
+def query_of(users):
+    """Only the fixture users"""
+    ids = tuple(user.id for user in users)
+    return models.User.select(lambda x: x.id in ids)
+
+
+def test_pages_forward_and_back(users):
+    query = query_of(users)
+    expected = [user.id for user in users]
+
+    first = make_page(3).paginate(query)
+    assert [row.id for row in first['data']] == expected[:3]
+    assert first['previous'] is None
+    assert first['count'] is None
+
+    second = make_page(3, cursor_of(first['next'])).paginate(query)
+    assert [row.id for row in second['data']] == expected[3:6]
+
+    last = make_page(3, cursor_of(second['next'])).paginate(query)
+    assert [row.id for row in last['data']] == expected[6:]
+    assert last['next'] is None
+
+    back = make_page(3, cursor_of(last['previous'])).paginate(query)
+    assert [row.id for row in back['data']] == expected[3:6]
+    back = make_page(3, cursor_of(back['previous'])).paginate(query)
+    assert [row.id for row in back['data']] == expected[:3]
+    assert back['previous'] is None
+
+
+def test_exact_page_has_no_next(users):
+    page = make_page(7).paginate(query_of(users))
+    assert len(page['data']) == 7
+    assert page['next'] is None
+
+
+def test_sql_uses_row_comparison(session, users):
+    first = make_page(3).paginate(query_of(users))
+    make_page(3, cursor_of(first['next'])).paginate(query_of(users))
+    # an index range condition, not created_at > c OR (... AND id > i)
+    assert '"created_at", "x"."id") >' in session.last_sql
+
+
+def test_fields_pages_forward_and_back(users):
+    query = query_of(users)
+    emails = [user.email for user in users]
+
+    first = make_page(3).paginate(query, fields=FIELDS)
+    assert [row['email'] for row in first['data']] == emails[:3]
+    assert set(first['data'][0]) == set(FIELDS)
+
+    second = make_page(3, cursor_of(first['next'])).paginate(
+        query, fields=FIELDS
+    )
+    assert [row['email'] for row in second['data']] == emails[3:6]
+
+    back = make_page(3, cursor_of(second['previous'])).paginate(
+        query, fields=FIELDS
+    )
+    assert [row['email'] for row in back['data']] == emails[:3]
+
+
+def test_fields_offset_reads_columns_only(session, users):
+    page = Pagination(
+        make_request(), offset=2, limit=3, cursor=None, with_count=False
+    )
+    query = query_of(users).order_by(lambda x: x.id)
+    data = page.paginate(query, fields=FIELDS)
+    assert data['count'] == 7
+    assert [row['email'] for row in data['data']] == [
+        user.email for user in users[2:5]
+    ]
+    assert data['data'][0]['created_at'] == users[2].created_at
+    # a tuple select of the fields, not the entity columns
+    assert '"password"' not in session.last_sql
+    assert '"email", "x"."name"' in session.last_sql
@@ -0,0 +1,47 @@
+"""Month math and the background run of db.partitions"""
+import asyncio
+import datetime
+
+from db import partitions
+
+
+def test_add_months():
+    day = datetime.date(2021, 11, 15)
+    assert partitions.add_months(day, 0) == datetime.date(2021, 11, 1)
+    assert partitions.add_months(day, 2) == datetime.date(2022, 1, 1)
+    assert partitions.add_months(day, -11) == datetime.date(2020, 12, 1)
+    assert partitions.partition_name(datetime.date(2021, 1, 1)) == (
+        'UserActivieRecord_p202101'
+    )
+
+
+def test_maintainer_keeps_running_after_a_failure(monkeypatch):
+    calls = []
+
+    def maintain():
+        calls.append(None)
+        if len(calls) == 1:
+            raise partitions.NotPartitioned('not yet')
+        return ['create UserActivieRecord_p202101']
+
+    monkeypatch.setattr(partitions, 'maintain', maintain)
+    maintainer = partitions.PartitionMaintainer(interval=0.01)
+
+    async def run():
+        maintainer.start()
+        while len(calls) < 3:
+            await asyncio.sleep(0.01)
+        await maintainer.stop()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(asyncio.wait_for(run(), 2))
+    finally:
+        loop.close()
+    assert len(calls) >= 3
+
+
+def test_maintainer_disabled_by_zero_interval():
+    maintainer = partitions.PartitionMaintainer(interval=0)
+    maintainer.start()
+    assert maintainer._task is None  # pylint: disable=protected-access
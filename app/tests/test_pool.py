@@ -0,0 +1,90 @@
+"""db.pool.ManagedPool against the test database"""
+# pytest fixtures are arguments of the same name
+# pylint: disable=redefined-outer-name,unused-argument
+import psycopg2
+import pytest
+from db.models import DB_PARAMS
+from db.pool import ManagedPool, PoolTimeout, connect_options
+
+
+@pytest.fixture
+def pool(database):
+    """2 connections, short timeouts"""
+    pool = ManagedPool(
+        psycopg2,
+        max_size=2,
+        acquire_timeout=0.2,
+        idle_timeout=300,
+        ping_after=0,
+        options=connect_options(200),
+        **DB_PARAMS,
+    )
+    yield pool
+    pool.disconnect()
+
+
+def test_checkout_over_max_size_times_out(pool):
+    first, is_new = pool.connect()
+    assert is_new
+    second, _ = pool.connect()
+    with pytest.raises(PoolTimeout):
+        pool.connect()
+    assert pool.stats()['timeouts'] == 1
+    pool.release(first)
+    pool.release(second)
+
+
+def test_released_connection_is_reused(pool):
+    first, _ = pool.connect()
+    pool.release(first)
+    again, is_new = pool.connect()
+    assert again is first
+    assert not is_new
+    pool.release(again)
+    assert pool.stats()['created'] == 1
+
+
+def test_statement_timeout(pool):
+    connection, _ = pool.connect()
+    cursor = connection.cursor()
+    cursor.execute('SHOW statement_timeout')
+    assert cursor.fetchone()[0] == '200ms'
+    # pylint: disable=no-member
+    with pytest.raises(psycopg2.errors.QueryCanceled):
+        cursor.execute('SELECT pg_sleep(1)')
+    pool.release(connection)
+
+
+def test_release_resets_session(pool):
+    connection, _ = pool.connect()
+    cursor = connection.cursor()
+    cursor.execute("SET application_name = 'dirty'")
+    pool.release(connection)
+    connection, _ = pool.connect()
+    cursor = connection.cursor()
+    cursor.execute('SHOW application_name')
+    assert cursor.fetchone()[0] != 'dirty'
+    pool.release(connection)
+
+
+def test_broken_connection_is_replaced(pool):
+    connection, _ = pool.connect()
+    pool.release(connection)
+    connection.close()
+    # ping_after=0, the closed connection fails its ping
+    again, is_new = pool.connect()
+    assert again is not connection
+    assert is_new
+    assert pool.stats()['ping_failures'] == 1
+    pool.release(again)
+
+
+def test_drop_frees_the_slot(pool):
+    first, _ = pool.connect()
+    second, _ = pool.connect()
+    pool.drop(first)
+    third, is_new = pool.connect()
+    assert is_new
+    assert pool.stats()['size'] == 2
+    pool.release(second)
+    pool.release(third)
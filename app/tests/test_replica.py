@@ -0,0 +1,124 @@
+"""db.replica routing, the test database stands in for the replica"""
+# pytest fixtures are arguments of the same name
+# pylint: disable=redefined-outer-name,unused-argument
+import asyncio
+import contextvars
+
+import psycopg2
+import pytest
+from api import deps
+from db import replica
+from db.models import DB_PARAMS
+from db.pool import ManagedPool
+from db.replica import Replica, RoutingPool
+
+EMAIL = 'replica-sticky@example.com'
+
+
+def create_pool(**connect_kwargs) -> ManagedPool:
+    """Small pool of the test database"""
+    return ManagedPool(
+        psycopg2, max_size=2, acquire_timeout=0.2, idle_timeout=300,
+        ping_after=0, **{**DB_PARAMS, **connect_kwargs},
+    )
+
+
+@pytest.fixture
+def routing(database):
+    """RoutingPool of a primary and one checked replica"""
+    pool = RoutingPool(
+        primary=create_pool(),
+        replicas=[Replica('replica', create_pool())],
+        max_lag=5,
+    )
+    pool.check()
+    yield pool
+    pool.disconnect()
+
+
+def in_use(pool: ManagedPool) -> int:
+    """Checked out connections of pool"""
+    return pool.stats()['in_use']
+
+
+def checkout(pool: RoutingPool, read_only: bool, pinned: bool = False):
+    """
+    Connect and release in a fresh context, like one db_executor call
+    Returns:
+        (primary in use, replica in use) while the connection was out
+    """
+
+    def session():
+        replica.set_read_only(read_only)
+        if pinned:
+            replica.pin_primary()
+        connection, _ = pool.connect()
+        used = in_use(pool.primary), in_use(pool.replicas[0].pool)
+        pool.release(connection)
+        return used
+
+    return contextvars.copy_context().run(session)
+
+
+def test_read_only_goes_to_healthy_replica(routing):
+    assert routing.replicas[0].healthy
+    assert routing.replicas[0].lag == 0
+    assert checkout(routing, read_only=True) == (0, 1)
+    assert checkout(routing, read_only=False) == (1, 0)
+    # back in the pool it came from
+    assert (in_use(routing.primary), in_use(routing.replicas[0].pool)) == (0, 0)
+    assert routing.stats()['replica_reads'] == 1
+
+
+def test_pinned_read_goes_to_primary(routing):
+    assert checkout(routing, read_only=True, pinned=True) == (1, 0)
+    assert routing.stats()['replica_reads'] == 0
+
+
+def test_lagging_replica_falls_back(routing):
+    routing.max_lag = -1
+    routing.check()
+    assert not routing.replicas[0].healthy
+    assert checkout(routing, read_only=True) == (1, 0)
+    assert routing.stats()['replica_fallbacks'] == 1
+
+
+def test_unreachable_replica_is_down(database):
+    down = Replica('down', create_pool(port=1, connect_timeout=1))
+    down.healthy = True
+    down.check(max_lag=5)
+    assert not down.healthy
+    assert down.failures.value == 1
+
+
+def test_sticky_email_pins_primary(monkeypatch):
+    pinned = []
+
+    class Authorize:
+        """AuthJWT of a valid token of EMAIL"""
+
+        @staticmethod
+        def jwt_required():
+            pass
+
+        @staticmethod
+        def get_jwt_subject():
+            return EMAIL
+
+    async def get(email):
+        pinned.append(replica._pinned.get())  # pylint: disable=protected-access
+
+    monkeypatch.setattr(deps.user_cache, 'get', get)
+
+    def current_user():
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(deps.get_current_user(Authorize()))
+        finally:
+            loop.close()
+
+    contextvars.copy_context().run(current_user)
+    replica.stick(EMAIL)
+    assert replica.is_sticky(EMAIL)
+    contextvars.copy_context().run(current_user)
+    assert pinned == [False, True]
@@ -0,0 +1,57 @@
+"""Compressed request bodies of api.route_handler.GzipRequest"""
+# pytest fixtures are arguments of the same name
+# pylint: disable=redefined-outer-name,unused-argument
+import gzip
+import json
+import zlib
+
+import pytest
+from api import route_handler
+from starlette.testclient import TestClient
+
+import main
+
+BODY = json.dumps({
+    'email': 'encoding-nobody@example.com', 'password': 'Password1!'
+}).encode()
+
+
+def login(body: bytes, encoding: str) -> int:
+    """Status code of a login with body sent as Content-Encoding"""
+    response = TestClient(main.app).post(
+        'https://testserver/api/auth/login/',
+        data=body,
+        headers={
+            'Content-Type': 'application/json',
+            'Content-Encoding': encoding,
+        },
+    )
+    return response.status_code
+
+
+@pytest.mark.parametrize('encoding, body', [
+    ('identity', BODY),
+    ('gzip', gzip.compress(BODY)),
+    ('deflate', zlib.compress(BODY)),
+])
+def test_decoded_body_reaches_endpoint(database, encoding, body):
+    # unknown email, so the body was decoded and validated
+    assert login(body, encoding) == 401
+
+
+def test_unknown_encoding_is_415():
+    assert login(BODY, 'br') == 415
+
+
+def test_broken_data_is_400():
+    assert login(b'not gzip at all', 'gzip') == 400
+    # the whole body without the checksum at the end
+    assert login(gzip.compress(BODY)[:-8], 'gzip') == 400
+
+
+def test_decoded_over_limit_is_413(monkeypatch):
+    monkeypatch.setattr(route_handler, 'REQUEST_MAX_BODY_BYTES', 4096)
+    # small on the wire, far over the limit once decoded
+    bomb = gzip.compress(b' ' * 1024 * 1024)
+    assert len(bomb) < 4096
+    assert login(bomb, 'gzip') == 413
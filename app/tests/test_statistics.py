@@ -0,0 +1,106 @@
+"""sign_up_count counter and rollup rebuild of db.statistics"""
+# pytest fixtures are arguments of the same name
+# pylint: disable=redefined-outer-name,unused-argument
+import datetime
+import os
+
+import pytest
+from db import batch, models, statistics
+from pony.orm import flush
+
+MIGRATION = os.path.join(
+    os.path.dirname(statistics.__file__),
+    'migrations', '0003_user_count_trigger.sql'
+)
+
+
+@pytest.fixture
+def cursor(session):
+    """Raw cursor of the test transaction, rolled back with it"""
+    return session.get_connection().cursor()
+
+
+@pytest.fixture
+def counted(cursor):
+    """Triggers of the migration, installed inside the test transaction"""
+    with open(MIGRATION, encoding='utf-8') as file:
+        cursor.execute(file.read())
+
+
+def sign_up_count(cursor) -> int:
+    """Counter row, read past the Pony cache of the session"""
+    cursor.execute(
+        'SELECT value FROM "StatisticsCounter" WHERE name = %s',
+        ('sign_up_count',)
+    )
+    return cursor.fetchone()[0]
+
+
+def active_days(cursor, user: models.User) -> list:
+    """DailyActiveUser days of user"""
+    cursor.execute(
+        'SELECT day FROM "DailyActiveUser" WHERE user_id = %s ORDER BY day',
+        (user.id,)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def make_user(index: int) -> models.User:
+    """Web user"""
+    return models.User(
+        email=f'count{index}@example.com', name='count', register_from=1
+    )
+
+
+def test_sign_up_count_follows_writes(session, cursor, counted):
+    live = models.User.select(lambda x: not x.deleted).count()
+    assert statistics.load_statistics()['sign_up_count'] == live
+
+    users = [make_user(index) for index in range(3)]
+    flush()
+    assert sign_up_count(cursor) == live + 3
+
+    # raw SQL of the admin batch delete
+    batch.run('delete', [], [users[0].id])
+    assert sign_up_count(cursor) == live + 2
+    # already deleted, unchanged
+    batch.run('delete', [], [users[0].id])
+    assert sign_up_count(cursor) == live + 2
+
+    users[1].delete()
+    flush()
+    assert sign_up_count(cursor) == live + 1
+
+
+def test_rollup_removes_days_without_raw_rows(session, cursor):
+    user = make_user(10)
+    flush()
+    today = datetime.date.today()
+    yesterday = today - datetime.timedelta(days=1)
+    for day in (yesterday, today):
+        models.UserActivieRecord(
+            user=user,
+            created_at=datetime.datetime.combine(day, datetime.time(12)),
+        )
+    flush()
+    statistics.backfill(2)
+    assert active_days(cursor, user) == [yesterday, today]
+    cursor.execute(
+        'SELECT activity_count FROM "DailyStatistics" WHERE day = %s',
+        (yesterday,)
+    )
+    before = cursor.fetchone()[0]
+
+    cursor.execute(
+        'DELETE FROM "UserActivieRecord" '
+        'WHERE user_id = %s AND created_at < %s',
+        (user.id, today)
+    )
+    statistics.backfill(2)
+    assert active_days(cursor, user) == [today]
+    cursor.execute(
+        'SELECT activity_count FROM "DailyStatistics" WHERE day = %s',
+        (yesterday,)
+    )
+    after = cursor.fetchone()
+    assert after is None or after[0] == before - 1
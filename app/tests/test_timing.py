@@ -0,0 +1,33 @@
+"""Server-Timing header of utils.timing.RequestTimer"""
+from starlette.testclient import TestClient
+from utils import timing
+
+
+def test_header_hides_hash_spans():
+    timer = timing.RequestTimer()
+    timer.add('db', 0.002)
+    timer.add('db', 0.001)
+    timer.add('hash', 0.2)
+    timer.add('hash_queue', 0.01)
+    header = timer.header()
+    assert header.startswith('db;dur=3.00;desc="2", total;dur=')
+    assert 'hash' not in header
+    # still logged
+    assert set(timer.as_dict()) == {'db', 'hash', 'hash_queue'}
+
+
+
+def test_middleware_sends_header_by_default():
+    async def app(scope, receive, send):  # pylint: disable=unused-argument
+        timing.add('db', 0.001)
+        timing.add('hash', 0.2)
+        await send({
+            'type': 'http.response.start', 'status': 200, 'headers': [],
+        })
+        await send({'type': 'http.response.body', 'body': b'ok'})
+
+    assert timing.TIMING_HEADER
+    response = TestClient(timing.TimingMiddleware(app)).get('/')
+    header = response.headers['server-timing']
+    assert header.startswith('db;dur=1.00;desc="1", total;dur=')
+    assert 'hash' not in header
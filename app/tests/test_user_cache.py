@@ -0,0 +1,232 @@
+"""db.user_cache snapshots of JWT subjects"""
+# pytest fixtures are arguments of the same name
+# pylint: disable=redefined-outer-name,unused-argument
+import asyncio
+import time
+import types
+
+import pytest
+from api.endpoints import auth
+from db import models, user_cache as user_cache_module
+from db.user_cache import MISSING, UserCache, user_cache
+from fastapi_jwt_auth import AuthJWT
+from pony.orm import commit, db_session
+from starlette.testclient import TestClient
+from utils import encrypt
+
+import main
+
+EMAIL = 'user-cache@example.com'
+PASSWORD = 'Cache-password1'
+VERIFY_ID = 'user-cache-verify-id'
+
+
+def delete_users():
+    """Remove the test user"""
+    with db_session:
+        models.User.select(lambda x: x.email == EMAIL).delete()
+
+
+@pytest.fixture
+def loop(database):
+    """Event loop of one test, the test user is removed around it"""
+    delete_users()
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+    delete_users()
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    """Emails read from db by load_user"""
+    emails = []
+    load_user = user_cache_module.load_user
+
+    def counted(email):
+        emails.append(email)
+        return load_user(email)
+
+    monkeypatch.setattr(user_cache_module, 'load_user', counted)
+    return emails
+
+
+def add_user() -> int:
+    """Committed unverified web user, returns its id"""
+    salt = encrypt.get_salt()
+    with db_session:
+        user = models.User(
+            email=EMAIL,
+            name='cache',
+            register_from=1,
+            salt=encrypt.transfter_salt_to_str(salt),
+            password=encrypt.make_password(PASSWORD, salt),
+            verify_id=VERIFY_ID,
+        )
+        commit()
+        return user.id
+
+
+@pytest.fixture
+def client(loop):
+    """TestClient of the app, the test user is not in user_cache"""
+    user_cache.local.delete(EMAIL)
+    yield TestClient(main.app)
+    user_cache.local.delete(EMAIL)
+
+
+def call(client, method: str, path: str, **kwargs):
+    """Request with the access token (and its CSRF header) of EMAIL"""
+    token = AuthJWT().create_access_token(subject=EMAIL)
+    csrf = AuthJWT().get_raw_jwt(token)['csrf']
+    return client.request(
+        method,
+        f'https://testserver{path}',
+        cookies={'access_token_cookie': token},
+        headers={'X-CSRF-Token': csrf},
+        allow_redirects=False,
+        **kwargs,
+    )
+
+
+def profile(client) -> dict:
+    """GET /api/user/profile/ body, None for 404"""
+    response = call(client, 'GET', '/api/user/profile/')
+    if response.status_code == 404:
+        return None
+    assert response.status_code == 200
+    return response.json()
+
+
+def make_cache(**kwargs) -> UserCache:
+    """Local only cache"""
+    return UserCache(**{'max_size': 10, 'ttl': 30, 'miss_ttl': 30, **kwargs})
+
+
+def test_unknown_email_is_cached(loop, loads):
+    cache = make_cache()
+    for _ in range(3):
+        assert loop.run_until_complete(cache.get(EMAIL)) is None
+    assert loads == [EMAIL]
+    assert cache.stats()['not_found_hits'] == 2
+
+
+def test_unknown_email_expires_after_miss_ttl(loop, loads):
+    cache = make_cache(miss_ttl=0.05)
+    loop.run_until_complete(cache.get(EMAIL))
+    user_id = add_user()
+    time.sleep(0.1)
+    assert loop.run_until_complete(cache.get(EMAIL)).id == user_id
+    assert loads == [EMAIL, EMAIL]
+
+
+def test_invalidate_drops_not_found(loop, loads):
+    cache = make_cache()
+    loop.run_until_complete(cache.get(EMAIL))
+    user_id = add_user()
+    loop.run_until_complete(cache.invalidate(EMAIL))
+    assert loop.run_until_complete(cache.get(EMAIL)).id == user_id
+
+
+def test_invalidate_skips_only_its_own_load(monkeypatch):
+    gates = []
+
+    async def read(func, email):
+        await gates[0].wait()
+        return types.SimpleNamespace(email=email)
+
+    monkeypatch.setattr(
+        user_cache_module, 'db_executor', types.SimpleNamespace(read=read)
+    )
+    cache = make_cache()
+
+    async def race():
+        # an Event of the running loop
+        gates.append(asyncio.Event())
+        loads = [
+            asyncio.ensure_future(cache.get(email))
+            for email in ('race-a@example.com', 'race-b@example.com')
+        ]
+        await asyncio.sleep(0)
+        # written while both loads read the old row
+        await cache.invalidate('race-a@example.com')
+        gates[0].set()
+        return await asyncio.gather(*loads)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loaded = loop.run_until_complete(race())
+    finally:
+        loop.close()
+    assert [user.email for user in loaded] == [
+        'race-a@example.com', 'race-b@example.com'
+    ]
+    assert cache.local.get('race-a@example.com') is MISSING
+    assert cache.local.get('race-b@example.com').email == 'race-b@example.com'
+    assert not cache._loading  # pylint: disable=protected-access
+
+
+def test_lru_stats(monkeypatch):
+    async def read(func, email):
+        return types.SimpleNamespace(email=email)
+
+    monkeypatch.setattr(
+        user_cache_module, 'db_executor', types.SimpleNamespace(read=read)
+    )
+    cache = make_cache(max_size=2)
+    loop = asyncio.new_event_loop()
+    try:
+        for email in ('a', 'b', 'a', 'c', 'b'):
+            loop.run_until_complete(cache.get(email))
+    finally:
+        loop.close()
+    stats = cache.stats()
+    # c evicts b, the least recently used
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (1, 4, 2)
+    assert stats['size'] == 2
+
+
+def test_profile_is_cached(client, loads):
+    add_user()
+    assert profile(client)['name'] == 'cache'
+    assert profile(client)['name'] == 'cache'
+    assert loads == [EMAIL]
+
+
+def test_update_self_user_invalidates(client):
+    add_user()
+    assert profile(client)['name'] == 'cache'
+    response = call(client, 'PUT', '/api/user/', json={'name': 'renamed'})
+    assert response.status_code == 200
+    assert profile(client)['name'] == 'renamed'
+
+
+def test_reset_password_invalidates(client):
+    add_user()
+    profile(client)
+    response = call(client, 'POST', '/api/user/reset-password/', json={
+        'old_password': PASSWORD, 'new_password': 'Cache-password2',
+    })
+    assert response.status_code == 200
+    assert user_cache.local.get(EMAIL) is MISSING
+
+
+def test_verify_invalidates(client):
+    add_user()
+    assert profile(client)['verify'] is False
+    response = call(client, 'GET', f'/api/user/verify/{VERIFY_ID}/')
+    assert response.status_code == 200
+    assert profile(client)['verify'] is True
+
+
+def test_oauth_signup_invalidates(client, monkeypatch):
+    # a token of the email was seen before the user existed
+    assert profile(client) is None
+
+    async def oauth_user_data(*args):
+        return {'email': EMAIL, 'name': 'google'}
+
+    monkeypatch.setattr(auth, 'oauth_user_data', oauth_user_data)
+    response = call(client, 'GET', '/api/auth/login/google/authorized/')
+    assert response.status_code == 307
+    assert profile(client)['name'] == 'google'
@@ -0,0 +1,422 @@
+"""
+Admission control for expensive routes (password hashing, mail)
+Examples:
+    @router.post('/login/')
+    @admission(AUTH_CONCURRENCY, per_ip=AUTH_RATE_PER_IP,
+               per_email=AUTH_RATE_PER_EMAIL)
+    async def login():
+        pass
+
+ErrorLoggingRoute checks a request before the endpoint runs:
+    * token bucket per client ip and per body email -> 429 + Retry-After
+    * concurrency of the route in this worker over its adaptive limit
+      -> 503 + Retry-After
+The limit starts at the route budget, drops when latency grows over
+ADMISSION_LATENCY_TOLERANCE times the no-load latency and creeps back up
+when it recovers. With ADMISSION_BACKEND=redis buckets are shared by every
+worker through REDIS_URL, redis errors fall back to local buckets
+"""
+import hashlib
+import json
+import math
+import time
+import typing
+
+from config import config
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from utils.cache import MISSING, TTLCache
+from utils.log import logger
+from utils.stats import Counter
+
+ADMISSION_ENABLED = config.get('ADMISSION_ENABLED', cast=bool, default=True)
+ADMISSION_BACKEND = config.get('ADMISSION_BACKEND', default='local')
+ADMISSION_TRUST_FORWARDED = config.get(
+    'ADMISSION_TRUST_FORWARDED', cast=bool, default=False
+)
+ADMISSION_LATENCY_TOLERANCE = config.get(
+    'ADMISSION_LATENCY_TOLERANCE', cast=float, default=2.0
+)
+ADMISSION_MAX_KEYS = config.get(
+    'ADMISSION_MAX_KEYS', cast=int, default=100000
+)
+AUTH_CONCURRENCY = config.get('AUTH_CONCURRENCY', cast=int, default=4)
+AUTH_RATE_PER_IP = config.get('AUTH_RATE_PER_IP', default='30/60')
+AUTH_RATE_PER_EMAIL = config.get('AUTH_RATE_PER_EMAIL', default='5/60')
+REDIS_URL = config.get('REDIS_URL', default=None)
+
+# KEYS[1] bucket, ARGV rate, burst, now; returns seconds to wait
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RateLimit:
+    """
+    Token bucket size and refill
+    Examples:
+        RateLimit.parse('30/60')  # burst of 30, 30 per 60 seconds
+    """
+    __slots__ = ('burst', 'rate')
+
+    def __init__(self, count: int, seconds: float):
+        self.burst = count
+        self.rate = count / seconds
+
+    @classmethod
+    def parse(
+            cls, value: typing.Optional[str]
+    ) -> typing.Optional['RateLimit']:
+        """'count/seconds' or None"""
+        if not value:
+            return None
+        count, _, seconds = value.partition('/')
+        return cls(int(count), float(seconds or 1))
+
+    def full_after(self) -> float:
+        """Seconds an empty bucket needs to refill"""
+        return self.burst / self.rate
+
+
+class Buckets:
+    """Token buckets in this worker, or in redis for every worker"""
+
+    def __init__(self, max_keys: int, redis_url: str = None):
+        self.local = TTLCache(max_size=max_keys, ttl=3600)
+        self.redis_url = redis_url
+        self.redis_errors = Counter()
+        self._redis = None
+
+    @property
+    def backend(self) -> str:
+        """redis when connected, else local"""
+        return 'local' if self._redis is None else 'redis'
+
+    def _take_local(self, key: str, limit: RateLimit, now: float) -> float:
+        """Local bucket, entries expire once refilled"""
+        bucket = self.local.get(key)
+        if bucket is MISSING:
+            tokens, updated = limit.burst, now
+        else:
+            tokens, updated = bucket
+        tokens = min(limit.burst, tokens + max(now - updated, 0) * limit.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / limit.rate
+        self.local.set(key, (tokens, now), ttl=limit.full_after())
+        return wait
+
+    async def take(self, key: str, limit: RateLimit) -> float:
+        """
+        Take one token
+        Returns:
+            0 when taken, else seconds until one is available
+        """
+        now = time.time()
+        if self._redis is not None:
+            try:
+                wait = await self._redis.eval(
+                    TAKE_SCRIPT,
+                    keys=[f'admission:{key}'],
+                    args=[limit.rate, limit.burst, now],
+                )
+                return float(wait)
+            except Exception:  # pylint: disable=broad-except
+                self.redis_errors.inc()
+        return self._take_local(key, limit, now)
+
+    async def start(self):
+        """Connect redis when ADMISSION_BACKEND is redis"""
+        if not self.redis_url or self._redis is not None:
+            return
+        import aioredis  # pylint: disable=import-outside-toplevel
+        try:
+            self._redis = await aioredis.create_redis_pool(self.redis_url)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('admission redis connect fail, use local only')
+
+    async def stop(self):
+        """Close redis connections"""
+        if self._redis is not None:
+            self._redis.close()
+            await self._redis.wait_closed()
+            self._redis = None
+
+
+class AdaptiveLimit:
+    """
+    AIMD concurrency limit driven by latency
+    Notes:
+        Only touched from the event loop, no lock
+    """
+
+    def __init__(
+            self,
+            max_limit: int,
+            tolerance: float,
+            min_limit: int = 1,
+            backoff: float = 0.9,
+            window: int = 100,
+    ):
+        """
+        Args:
+            max_limit: route budget, the limit never goes over it
+            tolerance: latency over no-load latency * tolerance is overload
+            min_limit: the limit never goes under it
+            backoff: limit multiplier on overload
+            window: samples per no-load latency window
+        """
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.window = window
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.no_load: typing.Optional[float] = None
+        self._window_min = math.inf
+        self._samples = 0
+        self._since_decrease = 0
+
+    def full(self) -> bool:
+        """No room under the current limit"""
+        return self.in_flight >= int(self.limit)
+
+    def acquire(self) -> bool:
+        """Take a slot if one is free"""
+        if self.full():
+            return False
+        self.in_flight += 1
+        return True
+
+    def _update_no_load(self, latency: float):
+        """
+        Minimum latency of the last window, it may only grow slowly so a
+        long overload does not become the new normal
+        """
+        self._window_min = min(self._window_min, latency)
+        self._samples += 1
+        if self.no_load is None:
+            self.no_load = latency
+        if self._samples >= self.window:
+            self.no_load = min(self._window_min, self.no_load * 1.05)
+            self._window_min = math.inf
+            self._samples = 0
+        else:
+            self.no_load = min(self.no_load, latency)
+
+    def release(self, latency: float):
+        """Give the slot back and adapt the limit to its latency"""
+        self.in_flight -= 1
+        self._update_no_load(latency)
+        self._since_decrease += 1
+        if latency > self.no_load * self.tolerance:
+            # about once per round of in-flight requests
+            if self._since_decrease >= self.limit:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self._since_decrease = 0
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+
+class AdmissionPolicy:
+    """Limits declared by the admission decorator"""
+
+    def __init__(
+            self,
+            concurrency: int,
+            per_ip: typing.Optional[str] = None,
+            per_email: typing.Optional[str] = None,
+    ):
+        self.concurrency = concurrency
+        self.per_ip = RateLimit.parse(per_ip)
+        self.per_email = RateLimit.parse(per_email)
+
+
+def admission(
+        concurrency: int,
+        per_ip: typing.Optional[str] = None,
+        per_email: typing.Optional[str] = None,
+) -> typing.Callable:
+    """
+    Declare admission limits of the endpoint, read by ErrorLoggingRoute
+    Args:
+        concurrency: requests running at once in a worker
+        per_ip: 'count/seconds' per client ip
+        per_email: 'count/seconds' per email field of the JSON body
+    """
+
+    def decorator(func: typing.Callable) -> typing.Callable:
+        func.admission = AdmissionPolicy(concurrency, per_ip, per_email)
+        return func
+
+    return decorator
+
+
+def client_ip(request: Request) -> str:
+    """First X-Forwarded-For with ADMISSION_TRUST_FORWARDED else peer"""
+    if ADMISSION_TRUST_FORWARDED:
+        forwarded = request.headers.get('x-forwarded-for')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.client.host if request.client else 'unknown'
+
+
+async def body_email(request: Request) -> typing.Optional[str]:
+    """email field of a JSON body, the body is cached for the endpoint"""
+    try:
+        data = json.loads(await request.body())
+    except ValueError:
+        return None
+    email = data.get('email') if isinstance(data, dict) else None
+    return email.strip().lower() if isinstance(email, str) else None
+
+
+def rejection(status_code: int, retry_after: float) -> Response:
+    """429/503 with Retry-After in whole seconds"""
+    detail = 'Too many requests' if status_code == 429 else 'Server is busy'
+    return JSONResponse(
+        {'detail': detail},
+        status_code=status_code,
+        headers={'Retry-After': str(max(1, math.ceil(retry_after)))},
+    )
+
+
+class Admission:
+    """Admission control of one route"""
+
+    def __init__(
+            self, path: str, policy: AdmissionPolicy, bucket_store: Buckets
+    ):
+        self.path = path
+        self.policy = policy
+        self.buckets = bucket_store
+        self.limiter = AdaptiveLimit(
+            policy.concurrency, tolerance=ADMISSION_LATENCY_TOLERANCE
+        )
+        self.admitted = Counter()
+        self.rate_limited = Counter()
+        self.shed = Counter()
+        self._registered = False
+
+    def _key(self, kind: str, value: str) -> str:
+        """Bucket key, client values are hashed"""
+        digest = hashlib.sha256(value.encode()).hexdigest()[:32]
+        return f'{self.path}:{kind}:{digest}'
+
+    async def _rate_limit(self, request: Request) -> float:
+        """
+        Returns:
+            0 or seconds until the ip and email buckets allow the request
+        """
+        if self.policy.per_ip is not None:
+            wait = await self.buckets.take(
+                self._key('ip', client_ip(request)), self.policy.per_ip
+            )
+            if wait:
+                return wait
+        if self.policy.per_email is not None:
+            email = await body_email(request)
+            if email:
+                return await self.buckets.take(
+                    self._key('email', email), self.policy.per_email
+                )
+        return 0.0
+
+    async def handle(
+            self,
+            request: Request,
+            call_next: typing.Callable[[Request], typing.Awaitable[Response]],
+    ) -> Response:
+        """Run call_next when admitted, else the rejection response"""
+        if not self._registered:
+            # include_router copies routes, only the served one is listed
+            self._registered = True
+            controllers.append(self)
+        # shed before spending tokens
+        if self.limiter.full():
+            self.shed.inc()
+            return rejection(503, 1)
+        wait = await self._rate_limit(request)
+        if wait:
+            self.rate_limited.inc()
+            return rejection(429, wait)
+        if not self.limiter.acquire():
+            self.shed.inc()
+            return rejection(503, 1)
+        self.admitted.inc()
+        started_at = time.perf_counter()
+        try:
+            return await call_next(request)
+        finally:
+            self.limiter.release(time.perf_counter() - started_at)
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            limit, usage and rejection counters
+        """
+        return {
+            'path': self.path,
+            'budget': self.policy.concurrency,
+            'limit': round(self.limiter.limit, 2),
+            'in_flight': self.limiter.in_flight,
+            'no_load_ms': (
+                None if self.limiter.no_load is None
+                else round(self.limiter.no_load * 1000, 3)
+            ),
+            'admitted': self.admitted.value,
+            'rate_limited': self.rate_limited.value,
+            'shed': self.shed.value,
+        }
+
+
+buckets = Buckets(
+    max_keys=ADMISSION_MAX_KEYS,
+    redis_url=REDIS_URL if ADMISSION_BACKEND == 'redis' else None,
+)
+# routes with a policy which served a request, for stats
+controllers: typing.List[Admission] = []
+
+
+def for_endpoint(
+        path: str, endpoint: typing.Callable
+) -> typing.Optional[Admission]:
+    """
+    Admission of a route when its endpoint declares a policy
+    Returns:
+        None when disabled or no policy
+    """
+    policy = getattr(endpoint, 'admission', None)
+    if not ADMISSION_ENABLED or policy is None:
+        return None
+    return Admission(path, policy, buckets)
+
+
+def stats() -> dict:
+    """
+    Returns:
+        routes and bucket backend
+    """
+    return {
+        'backend': buckets.backend,
+        'redis_errors': buckets.redis_errors.value,
+        'routes': [controller.stats() for controller in controllers],
+    }
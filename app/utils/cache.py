@@ -0,0 +1,84 @@
+"""
+Bounded in-process LRU cache with per entry TTL
+Examples:
+    cache = TTLCache(max_size=1000, ttl=30)
+    cache.set('key', value)
+    cache.get('key')
+"""
+import collections
+import threading
+import time
+import typing
+
+from utils.stats import Counter
+
+MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe LRU cache, entries expire ttl seconds after set"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()
+        self.hits = Counter()
+        self.misses = Counter()
+        self.evictions = Counter()
+        self.expirations = Counter()
+
+    def get(self, key: typing.Hashable, default=MISSING):
+        """
+        Returns:
+            cached value or default when missing or expired
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._data[key]
+                self.expirations.inc()
+                entry = None
+            if entry is None:
+                self.misses.inc()
+                return default
+            self._data.move_to_end(key)
+        self.hits.inc()
+        return entry[1]
+
+    def set(self, key: typing.Hashable, value, ttl: float = None):
+        """Set value, the least recently used entry is evicted when full"""
+        expire_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expire_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions.inc()
+
+    def delete(self, key: typing.Hashable):
+        """Remove key if cached"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove everything"""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            size and counters
+        """
+        hits, misses = self.hits.value, self.misses.value
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 4) if hits else 0.0,
+            'evictions': self.evictions.value,
+            'expirations': self.expirations.value,
+        }
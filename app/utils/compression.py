@@ -0,0 +1,221 @@
+"""
+Response compression negotiated from Accept-Encoding
+Examples:
+    app.add_middleware(CompressionMiddleware)
+    # body which never changes, compressed once and served from memory
+    register_static('/openapi.json', body, 'application/json')
+
+br is used when the brotli package is installed, gzip otherwise
+Streaming responses are flushed per chunk so they keep streaming
+"""
+import typing
+import zlib
+
+from config import config
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+MINIMUM_SIZE = config.get('COMPRESSION_MIN_SIZE', cast=int, default=500)
+GZIP_LEVEL = config.get('COMPRESSION_GZIP_LEVEL', cast=int, default=6)
+BROTLI_QUALITY = config.get('COMPRESSION_BROTLI_QUALITY', cast=int, default=4)
+# most preferred first
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+# path -> (media type, {encoding: body})
+_static: typing.Dict[str, typing.Tuple[str, typing.Dict[str, bytes]]] = {}
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    """
+    Returns:
+        body compressed with encoding
+    """
+    if encoding == 'br':
+        return brotli.compress(body, quality=11)
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def register_static(path: str, body: bytes, media_type: str):
+    """
+    Compress body with every encoding once at the highest level,
+    GET path is answered from memory by CompressionMiddleware
+    """
+    _static[path] = (
+        media_type,
+        {encoding: compress(body, encoding) for encoding in ENCODINGS},
+    )
+
+
+def negotiate(accept_encoding: str) -> typing.Optional[str]:
+    """
+    Pick encoding from Accept-Encoding
+    Returns:
+        'br', 'gzip' or None for identity
+    """
+    accepted = {}
+    for item in accept_encoding.lower().split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip()] = quality
+    wildcard = accepted.get('*', 0.0)
+    candidates = [
+        (accepted.get(encoding, wildcard), -index, encoding)
+        for index, encoding in enumerate(ENCODINGS)
+    ]
+    quality, _, encoding = max(candidates)
+    return encoding if quality > 0 else None
+
+
+class StreamCompressor:
+    """Incremental compressor of one response"""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(
+                GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+            )
+
+    def compress(self, body: bytes, more_body: bool) -> bytes:
+        """
+        Args:
+            body: next chunk
+            more_body: False for the last chunk
+        Returns:
+            compressed bytes to send now
+        """
+        if self.encoding == 'br':
+            data = self._compressor.process(body)
+            if more_body:
+                return data + self._compressor.flush()
+            return data + self._compressor.finish()
+        data = self._compressor.compress(body)
+        if more_body:
+            return data + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return data + self._compressor.flush()
+
+
+class CompressionMiddleware:
+    """Compress responses over minimum_size with br or gzip"""
+
+    def __init__(self, app: ASGIApp, minimum_size: int = MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        encoding = negotiate(headers.get('accept-encoding', ''))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        static = _static.get(scope['path'])
+        if static is not None and scope['method'] in ('GET', 'HEAD'):
+            await self.send_static(scope, send, encoding, *static)
+            return
+        responder = CompressionResponder(
+            self.app, encoding, self.minimum_size
+        )
+        await responder(scope, receive, send)
+
+    @staticmethod
+    async def send_static(
+            scope: Scope,
+            send: Send,
+            encoding: str,
+            media_type: str,
+            bodies: typing.Dict[str, bytes],
+    ):
+        """Send precompressed body of register_static"""
+        body = bodies[encoding]
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', media_type.encode()),
+                (b'content-encoding', encoding.encode()),
+                (b'content-length', str(len(body)).encode()),
+                (b'vary', b'Accept-Encoding'),
+            ],
+        })
+        await send({
+            'type': 'http.response.body',
+            'body': body if scope['method'] == 'GET' else b'',
+        })
+
+
+class CompressionResponder:
+    """Wrap send of one request, decide on the first body message"""
+
+    def __init__(self, app: ASGIApp, encoding: str, minimum_size: int):
+        self.app = app
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.send = None
+        self.start_message = None
+        self.compressor = None
+        self.started = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message: Message):
+        """Replace body messages with compressed ones"""
+        if message['type'] == 'http.response.start':
+            # sent with the first body once we know the size
+            self.start_message = message
+            return
+        if message['type'] != 'http.response.body':
+            await self.send(message)
+            return
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if not self.started:
+            self.started = True
+            headers = MutableHeaders(raw=self.start_message['headers'])
+            if (
+                    'content-encoding' in headers or
+                    (len(body) < self.minimum_size and not more_body)
+            ):
+                await self.send(self.start_message)
+                await self.send(message)
+                return
+            self.compressor = StreamCompressor(self.encoding)
+            body = self.compressor.compress(body, more_body)
+            headers['Content-Encoding'] = self.encoding
+            headers.add_vary_header('Accept-Encoding')
+            if more_body:
+                del headers['Content-Length']
+            else:
+                headers['Content-Length'] = str(len(body))
+            await self.send(self.start_message)
+            await self.send({
+                'type': 'http.response.body',
+                'body': body,
+                'more_body': more_body,
+            })
+            return
+        if self.compressor is not None:
+            body = self.compressor.compress(body, more_body)
+        await self.send({
+            'type': 'http.response.body',
+            'body': body,
+            'more_body': more_body,
+        })
@@ -3,7 +3,16 @@ Encrypt user password
 """
 import base64
 import hashlib
+import hmac
 import os
+import typing
+
+# version -> (hash name, iterations)
+# version 1 is stored as bare hex, others as "v{version}${hex}"
+HASH_VERSIONS = {
+    1: ('sha256', 10000),
+}
+CURRENT_HASH_VERSION = max(HASH_VERSIONS)
 
 
 def get_salt() -> bytes:
@@ -33,12 +42,68 @@ def transfer_salt_str_to_bytes(salt: str) -> bytes:
     return base64.b64decode(salt)
 
 
-def get_hash(text: str, salt: bytes) -> str:
+def get_hash(text: str, salt: bytes, version: int = 1) -> str:
     """
     Hash the text
+    Args:
+        text: raw text
+        salt: salt(bytes)
+        version: key of HASH_VERSIONS
     Returns:
         text hash result
     """
-    digest = hashlib.pbkdf2_hmac('sha256', text.encode(), salt, 10000)
+    hash_name, iterations = HASH_VERSIONS[version]
+    digest = hashlib.pbkdf2_hmac(hash_name, text.encode(), salt, iterations)
     hex_hash = digest.hex()
     return hex_hash
+
+
+def make_password(
+        text: str,
+        salt: bytes,
+        version: typing.Optional[int] = None
+) -> str:
+    """
+    Hash the password with version prefix
+    Args:
+        version: key of HASH_VERSIONS, CURRENT_HASH_VERSION by default
+    Returns:
+        password to store
+    """
+    if version is None:
+        version = CURRENT_HASH_VERSION
+    hex_hash = get_hash(text, salt, version)
+    if version == 1:
+        return hex_hash
+    return f'v{version}${hex_hash}'
+
+
+def parse_password(password: str) -> typing.Tuple[int, str]:
+    """
+    Split stored password
+    Returns:
+        (version, hex hash)
+    """
+    if password.startswith('v') and '$' in password:
+        version, hex_hash = password[1:].split('$', 1)
+        return int(version), hex_hash
+    return 1, password
+
+
+def check_password(text: str, salt: bytes, password: str) -> bool:
+    """
+    Compare text with stored password
+    Returns:
+         bool
+    """
+    version, hex_hash = parse_password(password)
+    return hmac.compare_digest(get_hash(text, salt, version), hex_hash)
+
+
+def needs_rehash(password: str) -> bool:
+    """
+    Returns:
+        True if password is not hashed by CURRENT_HASH_VERSION
+    """
+    version, _ = parse_password(password)
+    return version != CURRENT_HASH_VERSION
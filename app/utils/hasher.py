@@ -0,0 +1,148 @@
+"""
+Password hashing off the event loop
+Examples:
+    salt, password = await password_hasher.make_password(raw_password)
+    ok = await password_hasher.check_password(raw_password, salt, password)
+"""
+import asyncio
+import functools
+import time
+import typing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from config import config
+from fastapi.exceptions import HTTPException
+from utils import encrypt, timing
+from utils.stats import Counter, Histogram
+
+
+def _timed(func: typing.Callable, *args):
+    """
+    Run func in pool worker and time it
+    Returns:
+        (result, seconds)
+    """
+    started_at = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started_at
+
+
+class PasswordHasher:
+    """
+    PBKDF2 on a process or thread pool with admission control
+    pbkdf2_hmac releases the GIL, so thread pool is the default
+    """
+
+    def __init__(self, max_workers: int, max_queue: int, kind: str):
+        """
+        Args:
+            max_workers: hashes running at the same time
+            max_queue: hashes waiting, more get 503
+            kind: process|thread
+        """
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.kind = kind
+        self.pending = 0
+        self.rejected = Counter()
+        self.queue_time = Histogram()
+        self.hash_time = Histogram()
+        self._pool = None
+
+    @property
+    def pool(self) -> Executor:
+        """Create pool on first use"""
+        if self._pool is None:
+            if self.kind == 'process':
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='hash',
+                )
+        return self._pool
+
+    async def run(self, func: typing.Callable, *args):
+        """
+        Run hash function in pool
+        Raises:
+            HTTPException(503) when the queue is full
+        """
+        if self.pending >= self.max_workers + self.max_queue:
+            self.rejected.inc()
+            raise HTTPException(
+                status_code=503,
+                detail='Server is busy',
+                headers={'Retry-After': '1'},
+            )
+        self.pending += 1
+        loop = asyncio.get_event_loop()
+        submitted_at = time.perf_counter()
+        try:
+            result, elapsed = await loop.run_in_executor(
+                self.pool, functools.partial(_timed, func, *args)
+            )
+        finally:
+            self.pending -= 1
+        total = time.perf_counter() - submitted_at
+        timing.add('hash', elapsed)
+        timing.add('hash_queue', max(total - elapsed, 0.0))
+        self.hash_time.observe(elapsed)
+        self.queue_time.observe(max(total - elapsed, 0.0))
+        return result
+
+    async def make_password(self, raw_password: str) -> typing.Tuple[str, str]:
+        """
+        Hash new password with current hash version
+        Returns:
+            (salt(str), password)
+        """
+        salt = encrypt.get_salt()
+        password = await self.run(encrypt.make_password, raw_password, salt)
+        return encrypt.transfter_salt_to_str(salt), password
+
+    async def check_password(
+            self,
+            raw_password: str,
+            salt: typing.Optional[str],
+            password: typing.Optional[str],
+    ) -> bool:
+        """
+        Compare with stored password
+        Returns:
+            bool
+        """
+        if password is None or salt is None:
+            return False
+        salt_ = encrypt.transfer_salt_str_to_bytes(salt)
+        return await self.run(
+            encrypt.check_password, raw_password, salt_, password
+        )
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            pool usage, queue time and hash time histograms
+        """
+        return {
+            'kind': self.kind,
+            'max_workers': self.max_workers,
+            'max_queue': self.max_queue,
+            'pending': self.pending,
+            'rejected': self.rejected.value,
+            'queue_time': self.queue_time.snapshot(),
+            'hash_time': self.hash_time.snapshot(),
+        }
+
+    def shutdown(self):
+        """Stop pool"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+
+password_hasher = PasswordHasher(
+    max_workers=config.get('HASH_POOL_SIZE', cast=int, default=2),
+    max_queue=config.get('HASH_QUEUE_DEPTH', cast=int, default=32),
+    kind=config.get('HASH_POOL_KIND', default='thread'),
+)
@@ -0,0 +1,167 @@
+"""
+Shared keep-alive http client for outbound calls
+Examples:
+    response = await request('POST', url, json=data)
+
+Every host has a circuit breaker, after HTTP_BREAKER_FAILURES errors
+(connection, timeout or 5xx) in a row calls fail with CircuitOpen
+at once for HTTP_BREAKER_RESET_SECONDS, then one call is let through
+and closes the breaker again when it succeeds
+"""
+import time
+import typing
+from urllib.parse import urlsplit
+
+import httpx
+from config import config
+from utils.stats import Counter
+
+TIMEOUT = config.get('HTTP_TIMEOUT_SECONDS', cast=float, default=10.0)
+MAX_CONNECTIONS = config.get('HTTP_MAX_CONNECTIONS', cast=int, default=20)
+BREAKER_FAILURES = config.get('HTTP_BREAKER_FAILURES', cast=int, default=5)
+BREAKER_RESET_SECONDS = config.get(
+    'HTTP_BREAKER_RESET_SECONDS', cast=float, default=30.0
+)
+
+_client: typing.Optional[httpx.AsyncClient] = None
+
+
+class CircuitOpen(Exception):
+    """Host failed too often lately, the call was not made"""
+
+
+class CircuitBreaker:
+    """
+    Consecutive failure breaker of one host
+    Notes:
+        Only touched from the event loop, no lock
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: typing.Optional[float] = None
+        # start of the half-open trial, a lost trial is retried after reset
+        self._trial_at: typing.Optional[float] = None
+        self.rejected = Counter()
+        self.opened = Counter()
+
+    @property
+    def state(self) -> str:
+        """closed, open or half-open"""
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return 'open'
+        return 'half-open'
+
+    def allow(self) -> bool:
+        """Call may be made, half-open lets one trial through"""
+        state = self.state
+        if state == 'closed':
+            return True
+        now = time.monotonic()
+        if state == 'half-open' and (
+                self._trial_at is None or
+                now - self._trial_at >= self.reset_seconds
+        ):
+            self._trial_at = now
+            return True
+        self.rejected.inc()
+        return False
+
+    def success(self):
+        """Close the breaker"""
+        self.failures = 0
+        self.opened_at = None
+        self._trial_at = None
+
+    def failure(self):
+        """Open after failure_threshold failures in a row"""
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                self.opened.inc()
+            # a failed trial opens it for another reset_seconds
+            self.opened_at = time.monotonic()
+            self._trial_at = None
+
+
+_breakers: typing.Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(host: str) -> CircuitBreaker:
+    """Breaker of host, created on first use"""
+    breaker = _breakers.get(host)
+    if breaker is None:
+        breaker = _breakers[host] = CircuitBreaker(
+            BREAKER_FAILURES, BREAKER_RESET_SECONDS
+        )
+    return breaker
+
+
+def get_client() -> httpx.AsyncClient:
+    """
+    Get the process wide client, connections are kept alive between calls
+    Returns:
+        httpx.AsyncClient
+    """
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_CONNECTIONS,
+            ),
+        )
+    return _client
+
+
+async def request(method: str, url: str, **kwargs) -> httpx.Response:
+    """
+    Call url with the shared client through the breaker of its host
+    Args:
+        kwargs: for httpx.AsyncClient.request
+    Raises:
+        CircuitOpen when the breaker of the host is open
+        httpx.HTTPError for connection errors and timeouts
+    """
+    breaker = get_breaker(urlsplit(url).netloc)
+    if not breaker.allow():
+        raise CircuitOpen(urlsplit(url).netloc)
+    try:
+        response = await get_client().request(method, url, **kwargs)
+    except httpx.HTTPError:
+        breaker.failure()
+        raise
+    if response.status_code >= 500:
+        breaker.failure()
+    else:
+        breaker.success()
+    return response
+
+
+def breaker_stats() -> dict:
+    """
+    Returns:
+        {host: state and counters}
+    """
+    return {
+        host: {
+            'state': breaker.state,
+            'failures': breaker.failures,
+            'opened': breaker.opened.value,
+            'rejected': breaker.rejected.value,
+        }
+        for host, breaker in _breakers.items()
+    }
+
+
+async def close_client():
+    """Close the client on shutdown"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
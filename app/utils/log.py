@@ -3,22 +3,173 @@ use loguru package for logging
 Ref:
     https://cuiqingcai.com/7776.html
     https://blog.csdn.net/mouday/article/details/88560543
+
+File output goes through QueuedFileSink, request handlers only put the
+message into a bounded queue and a background thread writes the file
 """
 
 import datetime
 import logging
 import os
+import queue
+import sys
+import threading
+import typing
 
 import pytz
-from config import env
+from config import config, env
 from loguru import logger
+from utils.stats import Counter
 
 upload_path = '/tmp/logs'
-if not os.path.exists(upload_path):
-    os.mkdir(upload_path)
 
 tz = pytz.timezone('Asia/Taipei')
 
+LOG_JSON = config.get('LOG_JSON', cast=bool, default=False)
+LOG_QUEUE_SIZE = config.get('LOG_QUEUE_SIZE', cast=int, default=10000)
+LOG_ACCESS = config.get('LOG_ACCESS', cast=bool, default=True)
+LOG_RETENTION_DAYS = config.get(
+    'LOG_RETENTION_DAYS', cast=int, default=7
+)
+
+
+class QueuedFileSink:
+    """
+    Loguru sink with a bounded queue and a writer thread
+    Messages are dropped and counted when the queue is full,
+    one file per day, files older than retention_days are removed
+    A batch the file does not take is written to stderr instead
+    """
+
+    def __init__(self, directory: str, max_queue: int, retention_days: int):
+        self.directory = directory
+        self.retention_days = retention_days
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = Counter()
+        self.written = Counter()
+        self.failed = Counter()
+        self._thread = None
+        self._file = None
+        self._day = None
+
+    def write(self, message: str):
+        """Called by loguru on the logging thread, never blocks"""
+        try:
+            self.queue.put_nowait(str(message))
+        except queue.Full:
+            self.dropped.inc()
+
+    def _open(self, day: datetime.date):
+        """Switch to the file of day and remove old files"""
+        self._close()
+        self._file = open(
+            os.path.join(self.directory, f'{day:%Y%m%d}.log'),
+            'a',
+            encoding='utf-8',
+        )
+        self._day = day
+        oldest = f'{day - datetime.timedelta(days=self.retention_days):%Y%m%d}'
+        for name in os.listdir(self.directory):
+            if name.endswith('.log') and name[:-4] < oldest:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    # removed by another worker
+                    pass
+
+    def _close(self):
+        """Close the file, the next batch opens it again"""
+        file, self._file, self._day = self._file, None, None
+        if file is not None:
+            try:
+                file.close()
+            except OSError:
+                pass
+
+    def _write(self, messages: typing.List[str]):
+        """Write a batch to the file of today"""
+        day = datetime.datetime.now(tz).date()
+        if day != self._day or self._file is None:
+            self._open(day)
+        self._file.write(''.join(messages))
+        self._file.flush()
+        self.written.inc(len(messages))
+
+    def _run(self):
+        """Writer thread, write everything queued then flush once"""
+        while True:
+            messages = [self.queue.get()]
+            while len(messages) < 1000:
+                try:
+                    messages.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in messages
+            messages = [message for message in messages if message is not None]
+            try:
+                self._write(messages)
+            except Exception:  # pylint: disable=broad-except
+                # disk full, directory removed..., keep the thread alive
+                self.failed.inc(len(messages))
+                self._close()
+                try:
+                    sys.stderr.write(''.join(messages))
+                except Exception:  # pylint: disable=broad-except
+                    pass
+            if stop:
+                self._close()
+                return
+
+    def start(self):
+        """Start writer thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='log-writer', daemon=True
+            )
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Write what is queued then stop writer thread"""
+        if self._thread is not None:
+            try:
+                self.queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            queue depth and counters
+        """
+        return {
+            'depth': self.queue.qsize(),
+            'max_queue': self.queue.maxsize,
+            'written': self.written.value,
+            'dropped': self.dropped.value,
+            'failed': self.failed.value,
+        }
+
+
+file_sink = QueuedFileSink(
+    upload_path,
+    max_queue=LOG_QUEUE_SIZE,
+    retention_days=LOG_RETENTION_DAYS,
+)
+
+
+def _patch_std_record(record):
+    """Use caller info of the stdlib record instead of walking frames"""
+    std_record = record['extra'].pop('std_record', None)
+    if std_record is not None:
+        record['name'] = std_record.name
+        record['function'] = std_record.funcName
+        record['line'] = std_record.lineno
+
+
+std_logger = logger.patch(_patch_std_record)
+
 
 class InterceptHandler(logging.Handler):
     """get all logger message including default fastapi log"""
@@ -28,25 +179,31 @@ class InterceptHandler(logging.Handler):
         Args:
             record: logging record
         """
+        if not LOG_ACCESS and record.name == 'uvicorn.access':
+            return
         # Get corresponding Loguru level if it exists
         try:
             level = logger.level(record.levelname).name
         except ValueError:
             level = record.levelno
 
-        # Find caller from where originated the logged message
-        frame, depth = logging.currentframe(), 2
-        while frame.f_code.co_filename == logging.__file__:
-            frame = frame.f_back
-            depth += 1
-
-        logger.opt(depth=depth, exception=record.exc_info).log(
-            level, record.getMessage()
-        )
+        std_logger.opt(exception=record.exc_info).bind(
+            std_record=record
+        ).log(level, record.getMessage())
 
 
 def setup_logging():
     """setting up all log to loguru"""
+    if not os.path.exists(upload_path):
+        os.mkdir(upload_path)
+    file_sink.start()
+    logger.add(
+        file_sink.write,
+        level='INFO',
+        filter=lambda record: record['extra'].get('name') is None,
+        serialize=LOG_JSON,
+    )
+
     # intercept everything at the root logger
     logging.root.handlers = [InterceptHandler()]
     logging.root.setLevel('INFO')
@@ -67,11 +224,3 @@ fmt = (
     '<cyan>{function}</cyan>:<cyan>{line}</cyan> - '
     '<level>{message}</level>'
 ).replace('%%%', env)
-
-logger.add(
-    f'/tmp/logs/{datetime.datetime.now(tz):%Y%m%d}.log',
-    rotation='1 week',
-    retention='7 days',
-    level='INFO',
-    filter=lambda record: record['extra'].get('name') is None,
-)
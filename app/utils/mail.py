@@ -1,24 +1,249 @@
-"""Sending Email by sendgrid"""
-import sendgrid
+"""
+Sending Email by sendgrid through the EmailOutbox table
+Examples:
+    # inside db_executor.run, committed with the caller's transaction
+    enqueue_email(to=email, subject='Hi', message='Hello')
+    # after commit
+    email_dispatcher.wake()
+
+Background workers claim due rows, post them to sendgrid over the shared
+keep-alive client and retry failures with exponential backoff
+Sends run outside any request, their time is in stats() (send_time) and
+the email_* metrics instead of Server-Timing
+"""
+import asyncio
+import datetime
+import time
+import typing
+
 from config import config
-from sendgrid.helpers.mail import Content, Email, Mail, To
+from db import models
+from db.executor import db_executor
+from psycopg2.extras import RealDictCursor
+from utils.http import request
+from utils.log import logger
+from utils.stats import Counter, Histogram
+
+SENDGRID_API_URL = config.get(
+    'SENDGRID_API_URL', default='https://api.sendgrid.com'
+)
 
+CLAIM_SQL = (
+    'UPDATE "EmailOutbox" SET attempts = attempts + 1, '
+    'next_attempt_at = %(lease_until)s '
+    'WHERE id IN ('
+    ' SELECT id FROM "EmailOutbox"'
+    ' WHERE status = %(pending)s AND next_attempt_at <= %(now)s'
+    ' ORDER BY next_attempt_at LIMIT %(limit)s'
+    ' FOR UPDATE SKIP LOCKED'
+    ') RETURNING id, "to", subject, message, attempts'
+)
 
-def send_email(to, subject, message):
+
+def enqueue_email(to: typing.Union[str, typing.List[str]], subject, message):
     """
-    Send Email
-    Returns:
-        send email response
+    Add email to outbox
+    Notes:
+        Must run inside db_executor.run
     """
-    sg = sendgrid.SendGridAPIClient(api_key=config.get('SENDGRID_API_KEY'))
-    from_email = Email(config.get('SENDGRID_FROM_MAIL'))
     if isinstance(to, list):
-        to_email = []
-        for el in to:
-            to_email.append(el)
-    else:
-        to_email = To(to)
-    content = Content('text/plain', message)
-    mail = Mail(from_email, to_email, subject, content)
-    response = sg.client.mail.send.post(request_body=mail.get())
-    return response
+        to = ','.join(to)
+    models.EmailOutbox(to=to, subject=subject, message=message)
+
+
+def build_payload(to: str, subject: str, message: str) -> dict:
+    """
+    Returns:
+        sendgrid v3 mail send body
+    """
+    return {
+        'personalizations': [
+            {'to': [{'email': email} for email in to.split(',')]}
+        ],
+        'from': {'email': config.get('SENDGRID_FROM_MAIL')},
+        'subject': subject,
+        'content': [{'type': 'text/plain', 'value': message}],
+    }
+
+
+class EmailDispatcher:
+    """Drain EmailOutbox with background workers"""
+
+    def __init__(
+            self,
+            workers: int,
+            batch_size: int,
+            poll_interval: float,
+            max_attempts: int,
+            retry_base: float,
+    ):
+        """
+        Args:
+            workers: background tasks per process
+            batch_size: rows claimed and sent concurrently per round
+            poll_interval: seconds between outbox polls without wake()
+            max_attempts: attempts before the row is marked failed
+            retry_base: seconds, retry after retry_base * 2 ** attempts
+        """
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.sent = Counter()
+        self.retried = Counter()
+        self.failed = Counter()
+        # sendgrid round trip of every send, failed ones included
+        self.send_time = Histogram()
+        self._event = None
+        self._tasks = []
+
+    def claim(self) -> typing.List[dict]:
+        """
+        Lock due rows for this worker, other processes skip them
+        Notes:
+            Must run inside db_executor.run
+        """
+        now = datetime.datetime.now()
+        cursor = models.db.get_connection().cursor(
+            cursor_factory=RealDictCursor
+        )
+        with models.raw_sql():
+            cursor.execute(CLAIM_SQL, {
+                'now': now,
+                # not picked again while this worker sends it
+                'lease_until': now + datetime.timedelta(minutes=5),
+                'pending': models.EmailOutbox.PENDING,
+                'limit': self.batch_size,
+            })
+            return cursor.fetchall()
+
+    def save_results(self, results: typing.List[tuple]):
+        """
+        Mark sent rows and schedule retries
+        Args:
+            results: [(row, error or None, retry), ...]
+        Notes:
+            Must run inside db_executor.run
+        """
+        now = datetime.datetime.now()
+        for row, error, retry in results:
+            outbox = models.EmailOutbox[row['id']]
+            if error is None:
+                outbox.status = models.EmailOutbox.SENT
+                outbox.sent_at = now
+                self.sent.inc()
+                continue
+            outbox.last_error = error[:1000]
+            if not retry or row['attempts'] >= self.max_attempts:
+                outbox.status = models.EmailOutbox.FAILED
+                self.failed.inc()
+                continue
+            self.retried.inc()
+            delay = self.retry_base * 2 ** (row['attempts'] - 1)
+            outbox.next_attempt_at = now + datetime.timedelta(seconds=delay)
+
+    async def send(
+            self, row: dict
+    ) -> typing.Tuple[typing.Optional[str], bool]:
+        """
+        Post one email to sendgrid
+        Returns:
+            (error or None, should retry)
+        """
+        started_at = time.perf_counter()
+        try:
+            response = await request(
+                'POST',
+                f'{SENDGRID_API_URL}/v3/mail/send',
+                json=build_payload(row['to'], row['subject'], row['message']),
+                headers={
+                    'Authorization':
+                        f'Bearer {config.get("SENDGRID_API_KEY")}'
+                },
+            )
+        except Exception as exc:  # pylint: disable=broad-except
+            return f'{type(exc).__name__}: {exc}', True
+        finally:
+            self.send_time.observe(time.perf_counter() - started_at)
+        if response.status_code < 300:
+            return None, False
+        # bad request will not pass by retry
+        retry = response.status_code == 429 or response.status_code >= 500
+        return f'{response.status_code}: {response.text}', retry
+
+    async def drain(self):
+        """Send due rows until none is left"""
+        while True:
+            rows = await db_executor.run(self.claim)
+            if not rows:
+                return
+            sent = await asyncio.gather(*(self.send(row) for row in rows))
+            results = [
+                (row, error, retry) for row, (error, retry) in zip(rows, sent)
+            ]
+            for row, error, _ in results:
+                if error is not None:
+                    logger.warning(f'email {row["id"]} send fail: {error}')
+            await db_executor.run(self.save_results, results)
+
+    async def _work_forever(self):
+        """Background worker loop"""
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._event.wait(), timeout=self.poll_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._event.clear()
+            try:
+                await self.drain()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('email outbox drain fail')
+
+    def wake(self):
+        """Drain now, call after the outbox row is committed"""
+        if self._event is not None:
+            self._event.set()
+
+    def start(self):
+        """Start background workers"""
+        if self._tasks:
+            return
+        self._event = asyncio.Event()
+        self._tasks = [
+            asyncio.ensure_future(self._work_forever())
+            for _ in range(self.workers)
+        ]
+        # rows left by a previous process
+        self._event.set()
+
+    async def stop(self):
+        """Stop background workers, unsent rows stay in outbox"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            outcome counters and sendgrid send time of this process
+        """
+        return {
+            'workers': len(self._tasks),
+            'sent': self.sent.value,
+            'retried': self.retried.value,
+            'failed': self.failed.value,
+            'send_time': self.send_time.snapshot(),
+        }
+
+
+email_dispatcher = EmailDispatcher(
+    workers=config.get('EMAIL_WORKERS', cast=int, default=2),
+    batch_size=config.get('EMAIL_BATCH_SIZE', cast=int, default=20),
+    poll_interval=config.get('EMAIL_POLL_SECONDS', cast=float, default=10.0),
+    max_attempts=config.get('EMAIL_MAX_ATTEMPTS', cast=int, default=8),
+    retry_base=config.get('EMAIL_RETRY_BASE_SECONDS', cast=float, default=5),
+)
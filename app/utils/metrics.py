@@ -0,0 +1,318 @@
+"""
+Prometheus metrics, aggregated over gunicorn workers
+Examples:
+    app.add_middleware(MetricsMiddleware)
+    GET /metrics with header Authorization: Bearer <METRICS_TOKEN>
+
+With PROMETHEUS_MULTIPROC_DIR set (Dockerfile.prod) every worker writes
+its values to files in that directory and /metrics of any worker reads
+all of them, the directory must be emptied before the workers start
+Internal stats (buffers, caches, pools) are copied into the metrics by a
+background task of each worker every METRICS_SYNC_SECONDS, which also
+measures event-loop lag
+/metrics answers 404 while METRICS_TOKEN is not set
+"""
+import asyncio
+import os
+import secrets
+import time
+import typing
+
+from config import config
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry,
+                               Counter, Gauge, Histogram, generate_latest,
+                               multiprocess)
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from utils.log import logger
+
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+METRICS_SYNC_SECONDS = config.get(
+    'METRICS_SYNC_SECONDS', cast=float, default=5.0
+)
+METRICS_TOKEN = config.get('METRICS_TOKEN', default='')
+
+HTTP_REQUESTS = Counter(
+    'http_requests_total', 'HTTP requests', ['method', 'route', 'status']
+)
+HTTP_LATENCY = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency',
+    ['method', 'route'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+DB_QUERIES = Counter(
+    'db_queries_total', 'SQL statements of Pony and db.models.raw_sql'
+)
+EVENT_LOOP_LAG = Gauge(
+    'event_loop_lag_seconds', 'Event-loop lag of the last sync',
+    multiprocess_mode='max',
+)
+# values of the live workers are summed
+GAUGES = {
+    name: Gauge(name, description, multiprocess_mode='livesum')
+    for name, description in (
+        ('activity_buffer_depth', 'Users waiting for activity flush'),
+        ('db_executor_pending', 'DB calls running or queued'),
+        ('password_hasher_pending', 'Hashes running or queued'),
+        ('log_queue_depth', 'Log messages waiting for the file writer'),
+        ('user_cache_size', 'Cached user snapshots'),
+        ('jwt_cache_size', 'Cached verified JWTs'),
+        ('db_pool_size', 'Open database connections'),
+        ('db_pool_in_use', 'Database connections checked out'),
+        ('db_pool_waiting', 'Threads waiting for a connection'),
+        ('db_replicas_healthy', 'Replicas taking read-only sessions'),
+        ('admission_in_flight', 'Requests running on admission routes'),
+        ('http_breakers_open', 'Outbound hosts with an open breaker'),
+    )
+}
+# internal counters are copied by delta, so they survive worker restarts
+COUNTERS = {
+    name: Counter(name, description)
+    for name, description in (
+        ('activity_dropped_total', 'Activity dropped, buffer full'),
+        ('activity_flushed_total', 'Activity records written'),
+        ('db_executor_rejected_total', 'DB calls rejected with 503'),
+        ('password_hasher_rejected_total', 'Hashes rejected with 503'),
+        ('log_dropped_total', 'Log messages dropped, queue full'),
+        ('user_cache_hits_total', 'User cache hits'),
+        ('user_cache_misses_total', 'User cache misses'),
+        ('user_cache_evictions_total', 'User cache evictions'),
+        ('jwt_cache_hits_total', 'Verified JWT cache hits'),
+        ('jwt_cache_misses_total', 'Verified JWT cache misses'),
+        ('jwt_cache_evictions_total', 'Verified JWT cache evictions'),
+        ('db_pool_created_total', 'Database connections opened'),
+        ('db_pool_timeouts_total', 'Connection checkouts timed out'),
+        ('db_pool_ping_failures_total', 'Idle connections failing ping'),
+        ('db_replica_reads_total', 'Read-only sessions run on a replica'),
+        ('db_replica_fallbacks_total', 'Read-only sessions sent to primary'),
+        ('admission_rate_limited_total', 'Requests rejected with 429'),
+        ('admission_shed_total', 'Requests shed with 503 over the limit'),
+        ('http_breaker_opened_total', 'Outbound host breakers opened'),
+        ('http_breaker_rejected_total', 'Outbound calls failed fast'),
+        ('email_sent_total', 'Emails accepted by sendgrid'),
+        ('email_retried_total', 'Email sends scheduled for retry'),
+        ('email_failed_total', 'Emails given up on'),
+        ('email_sends_total', 'Sendgrid send calls'),
+        ('email_send_seconds_total', 'Seconds spent in sendgrid send calls'),
+    )
+}
+
+
+def route_label(scope: Scope) -> str:
+    """
+    Route path template, never the raw path of a path parameter route
+    Returns:
+        '/api/user/verify/{verify_id}/' or 'unmatched'
+    """
+    route_path = scope.get('route_path')
+    if route_path is not None:
+        return route_path
+    # routes of main.py have no path parameters
+    if 'endpoint' in scope:
+        return scope['path']
+    return 'unmatched'
+
+
+def instrument_provider(provider):
+    """
+    Count every SQL Pony executes
+    Args:
+        provider: db.provider after bind
+    """
+    execute = provider.execute
+    if getattr(execute, 'counted', False):
+        return
+
+    def counted_execute(cursor, sql, arguments=None, returning_id=False):
+        DB_QUERIES.inc()
+        return execute(cursor, sql, arguments, returning_id)
+
+    counted_execute.counted = True
+    provider.execute = counted_execute
+
+
+class MetricsMiddleware:
+    """Count and time every http request by route"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        started_at = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message: Message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = route_label(scope)
+            HTTP_REQUESTS.labels(scope['method'], route, status).inc()
+            HTTP_LATENCY.labels(scope['method'], route).observe(
+                time.perf_counter() - started_at
+            )
+
+
+class StatsSync:
+    """Copy internal stats into metrics and measure event-loop lag"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._last: typing.Dict[str, float] = {}
+        self._task = None
+
+    @staticmethod
+    def read() -> typing.Tuple[dict, dict]:
+        """
+        Returns:
+            (gauge values, counter values) of this worker
+        """
+        # pylint: disable=import-outside-toplevel
+        from api.deps import jwt_cache
+        from db.activity import activity_buffer
+        from db.executor import db_executor
+        from db.models import db
+        from db.user_cache import user_cache
+        from utils import admission
+        from utils.hasher import password_hasher
+        from utils.http import breaker_stats
+        from utils.log import file_sink
+        from utils.mail import email_dispatcher
+
+        activity = activity_buffer.stats()
+        user = user_cache.local.stats()
+        jwt = jwt_cache.stats()
+        log = file_sink.stats()
+        # empty before init_db
+        pool = db.provider.pool.stats() if db.provider else {}
+        routes = admission.stats()['routes']
+        email = email_dispatcher.stats()
+        breakers = breaker_stats().values()
+        gauges = {
+            'activity_buffer_depth': activity_buffer.depth(),
+            'db_executor_pending': db_executor.pending,
+            'password_hasher_pending': password_hasher.pending,
+            'log_queue_depth': log['depth'],
+            'user_cache_size': user['size'],
+            'jwt_cache_size': jwt['size'],
+            'db_pool_size': pool.get('size', 0),
+            'db_pool_in_use': pool.get('in_use', 0),
+            'db_pool_waiting': pool.get('waiting', 0),
+            'db_replicas_healthy': pool.get('replicas_healthy', 0),
+            'admission_in_flight': sum(
+                route['in_flight'] for route in routes
+            ),
+            'http_breakers_open': sum(
+                breaker['state'] != 'closed' for breaker in breakers
+            ),
+        }
+        counters = {
+            'activity_dropped_total': activity['dropped'],
+            'activity_flushed_total': activity['flushed'],
+            'db_executor_rejected_total': db_executor.rejected.value,
+            'password_hasher_rejected_total': password_hasher.rejected.value,
+            'log_dropped_total': log['dropped'],
+            'user_cache_hits_total': user['hits'],
+            'user_cache_misses_total': user['misses'],
+            'user_cache_evictions_total': user['evictions'],
+            'jwt_cache_hits_total': jwt['hits'],
+            'jwt_cache_misses_total': jwt['misses'],
+            'jwt_cache_evictions_total': jwt['evictions'],
+            'db_pool_created_total': pool.get('created', 0),
+            'db_pool_timeouts_total': pool.get('timeouts', 0),
+            'db_pool_ping_failures_total': pool.get('ping_failures', 0),
+            'db_replica_reads_total': pool.get('replica_reads', 0),
+            'db_replica_fallbacks_total': pool.get('replica_fallbacks', 0),
+            'admission_rate_limited_total': sum(
+                route['rate_limited'] for route in routes
+            ),
+            'admission_shed_total': sum(route['shed'] for route in routes),
+            'http_breaker_opened_total': sum(
+                breaker['opened'] for breaker in breakers
+            ),
+            'http_breaker_rejected_total': sum(
+                breaker['rejected'] for breaker in breakers
+            ),
+            'email_sent_total': email['sent'],
+            'email_retried_total': email['retried'],
+            'email_failed_total': email['failed'],
+            'email_sends_total': email['send_time']['count'],
+            'email_send_seconds_total': email['send_time']['sum'],
+        }
+        return gauges, counters
+
+    def sync(self):
+        """Set gauges and increase counters by what changed"""
+        gauges, counters = self.read()
+        for name, value in gauges.items():
+            GAUGES[name].set(value)
+        for name, value in counters.items():
+            delta = value - self._last.get(name, 0)
+            if delta > 0:
+                COUNTERS[name].inc(delta)
+            self._last[name] = value
+
+    async def _run(self):
+        """Background loop, lag is how late the sleep wakes up"""
+        while True:
+            started_at = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            EVENT_LOOP_LAG.set(
+                max(time.perf_counter() - started_at - self.interval, 0.0)
+            )
+            try:
+                self.sync()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('metrics sync fail')
+
+    def start(self):
+        """Start background task"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop background task, drop this worker from live gauges"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if MULTIPROC_DIR:
+            multiprocess.mark_process_dead(os.getpid())
+
+
+stats_sync = StatsSync(interval=METRICS_SYNC_SECONDS)
+
+
+def authorized(authorization: typing.Optional[str]) -> bool:
+    """
+    Args:
+        authorization: Authorization header of the scrape request
+    Returns:
+        True when it is the bearer METRICS_TOKEN
+    """
+    if not METRICS_TOKEN or not authorization:
+        return False
+    scheme, _, token = authorization.partition(' ')
+    return scheme.lower() == 'bearer' and secrets.compare_digest(
+        token.encode(), METRICS_TOKEN.encode()
+    )
+
+
+def render() -> typing.Tuple[bytes, str]:
+    """
+    Returns:
+        (exposition body of every worker, content type)
+    """
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    # pylint: disable=import-outside-toplevel
+    from prometheus_client import REGISTRY
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
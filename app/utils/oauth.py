@@ -0,0 +1,350 @@
+"""
+Google (OpenID Connect) and Facebook login without per-request discovery
+Examples:
+    url = await oauth.google.authorization_url(request, redirect_uri)
+    token = await oauth.google.exchange(request, redirect_uri)
+    user_data = await oauth.google.user_info(request, token)
+
+Google discovery document and JWKS are cached and refreshed every
+OAUTH_REFRESH_SECONDS by a background task, an id_token signed by an
+unknown kid refetches the JWKS (at most every OAUTH_KID_REFETCH_SECONDS)
+so a callback costs the token exchange only (plus Graph /me for Facebook)
+Calls go through utils.http, point the *_URL settings to a fake IdP
+(python -m benchmarks.fake_idp) for local tests
+"""
+import abc
+import asyncio
+import base64
+import json
+import secrets
+import time
+import typing
+from urllib.parse import urlencode
+
+from config import config
+from utils.http import request
+from utils.log import logger
+
+GOOGLE_DISCOVERY_URL = config.get(
+    'GOOGLE_DISCOVERY_URL',
+    default='https://accounts.google.com/.well-known/openid-configuration',
+)
+FACEBOOK_AUTHORIZE_URL = config.get(
+    'FACEBOOK_AUTHORIZE_URL',
+    default='https://www.facebook.com/v7.0/dialog/oauth',
+)
+FACEBOOK_TOKEN_URL = config.get(
+    'FACEBOOK_TOKEN_URL',
+    default='https://graph.facebook.com/v7.0/oauth/access_token',
+)
+FACEBOOK_GRAPH_URL = config.get(
+    'FACEBOOK_GRAPH_URL', default='https://graph.facebook.com/v7.0/'
+)
+OAUTH_REFRESH_SECONDS = config.get(
+    'OAUTH_REFRESH_SECONDS', cast=float, default=3600.0
+)
+OAUTH_KID_REFETCH_SECONDS = config.get(
+    'OAUTH_KID_REFETCH_SECONDS', cast=float, default=30.0
+)
+# clock skew allowed for id_token exp/iat
+OAUTH_LEEWAY_SECONDS = 120
+
+
+class OAuthError(Exception):
+    """Callback can not be trusted or the provider refused it"""
+
+
+def jwt_header(token: str) -> dict:
+    """Unverified JOSE header, for the kid"""
+    try:
+        segment = token.split('.', 1)[0]
+        padded = segment + '=' * (-len(segment) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded))
+    except ValueError as exc:
+        raise OAuthError('Malformed id_token') from exc
+
+
+def json_body(response, what: str) -> dict:
+    """
+    JSON object of a provider response
+    Raises:
+        OAuthError when the body is not a JSON object
+    """
+    try:
+        data = response.json()
+    except ValueError as exc:
+        raise OAuthError(f'{what} is not JSON') from exc
+    if not isinstance(data, dict):
+        raise OAuthError(f'{what} is not a JSON object')
+    return data
+
+
+class OAuthProvider(abc.ABC):
+    """Authorization code flow, state is kept in the session cookie"""
+
+    def __init__(
+            self,
+            name: str,
+            client_id: str,
+            client_secret: str,
+            scope: str,
+    ):
+        self.name = name
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.scope = scope
+
+    @property
+    def _state_key(self) -> str:
+        return f'oauth_{self.name}_state'
+
+    @abc.abstractmethod
+    async def endpoints(self) -> typing.Tuple[str, str]:
+        """
+        Returns:
+            (authorization url, token url)
+        """
+
+    def extra_params(self, request_) -> dict:
+        """More authorization parameters, may keep state in the session"""
+        # pylint: disable=unused-argument,no-self-use
+        return {}
+
+    async def authorization_url(self, request_, redirect_uri: str) -> str:
+        """
+        Provider login page, state is saved for the callback
+        Args:
+            request_: starlette Request with session
+        """
+        authorize_url, _ = await self.endpoints()
+        state = secrets.token_urlsafe(24)
+        request_.session[self._state_key] = state
+        params = {
+            'response_type': 'code',
+            'client_id': self.client_id,
+            'redirect_uri': redirect_uri,
+            'scope': self.scope,
+            'state': state,
+            **self.extra_params(request_),
+        }
+        return f'{authorize_url}?{urlencode(params)}'
+
+    async def exchange(self, request_, redirect_uri: str) -> dict:
+        """
+        Check state and trade the code for tokens
+        Returns:
+            token response
+        Raises:
+            OAuthError for a bad callback or a refused exchange
+        """
+        state = request_.session.pop(self._state_key, None)
+        if (
+                state is None or
+                not secrets.compare_digest(
+                    state, request_.query_params.get('state', '')
+                )
+        ):
+            raise OAuthError('State mismatch')
+        code = request_.query_params.get('code')
+        if not code:
+            raise OAuthError(
+                request_.query_params.get('error', 'Missing code')
+            )
+        _, token_url = await self.endpoints()
+        response = await request('POST', token_url, data={
+            'grant_type': 'authorization_code',
+            'code': code,
+            'redirect_uri': redirect_uri,
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+        }, headers={'Accept': 'application/json'})
+        if response.status_code != 200:
+            raise OAuthError(f'Token exchange {response.status_code}')
+        return json_body(response, 'Token exchange')
+
+    @abc.abstractmethod
+    async def user_info(self, request_, token: dict) -> dict:
+        """
+        Returns:
+            dict with email and name
+        """
+
+
+class OIDCProvider(OAuthProvider):
+    """OpenID Connect provider with cached discovery and JWKS"""
+
+    def __init__(self, discovery_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.discovery_url = discovery_url
+        self.metadata: typing.Optional[dict] = None
+        # kid -> authlib Key, parsed once
+        self.keys: typing.Dict[str, typing.Any] = {}
+        self.keys_fetched_at = 0.0
+        self._refresh_lock: typing.Optional[asyncio.Lock] = None
+
+    @property
+    def _nonce_key(self) -> str:
+        return f'oauth_{self.name}_nonce'
+
+    async def _get_json(self, url: str) -> dict:
+        """GET a provider document"""
+        response = await request('GET', url)
+        if response.status_code != 200:
+            raise OAuthError(f'{url} {response.status_code}')
+        return json_body(response, url)
+
+    async def _fetch_keys(self):
+        """Replace keys with the current JWKS"""
+        # pylint: disable=import-outside-toplevel
+        from authlib.jose import JsonWebKey
+        jwks = await self._get_json(self.metadata['jwks_uri'])
+        self.keys = {
+            key['kid']: JsonWebKey.import_key(key)
+            for key in jwks.get('keys', []) if 'kid' in key
+        }
+        self.keys_fetched_at = time.monotonic()
+
+    async def refresh(self):
+        """Fetch discovery document and JWKS, one fetch at a time"""
+        if self._refresh_lock is None:
+            self._refresh_lock = asyncio.Lock()
+        async with self._refresh_lock:
+            self.metadata = await self._get_json(self.discovery_url)
+            await self._fetch_keys()
+
+    async def _metadata(self) -> dict:
+        """Cached discovery document, fetched on first use"""
+        if self.metadata is None:
+            await self.refresh()
+        return self.metadata
+
+    async def endpoints(self) -> typing.Tuple[str, str]:
+        metadata = await self._metadata()
+        return metadata['authorization_endpoint'], metadata['token_endpoint']
+
+    def extra_params(self, request_) -> dict:
+        nonce = secrets.token_urlsafe(24)
+        request_.session[self._nonce_key] = nonce
+        return {'nonce': nonce}
+
+    async def key(self, kid: str):
+        """
+        Signing key by kid, an unknown kid refetches the JWKS
+        Raises:
+            OAuthError when the kid is still unknown
+        """
+        key = self.keys.get(kid)
+        if key is None and (
+                time.monotonic() - self.keys_fetched_at >=
+                OAUTH_KID_REFETCH_SECONDS
+        ):
+            await self._metadata()
+            await self._fetch_keys()
+            key = self.keys.get(kid)
+        if key is None:
+            raise OAuthError(f'Unknown signing key {kid}')
+        return key
+
+    async def user_info(self, request_, token: dict) -> dict:
+        """Claims of the verified id_token"""
+        # pylint: disable=import-outside-toplevel
+        from authlib.jose import JsonWebToken
+        from authlib.jose.errors import JoseError
+        from authlib.oidc.core import CodeIDToken
+
+        id_token = token.get('id_token')
+        if not id_token:
+            raise OAuthError('Missing id_token')
+        metadata = await self._metadata()
+        key = await self.key(jwt_header(id_token).get('kid'))
+        algorithms = metadata.get(
+            'id_token_signing_alg_values_supported', ['RS256']
+        )
+        try:
+            claims = JsonWebToken(algorithms).decode(
+                id_token,
+                key=key,
+                claims_cls=CodeIDToken,
+                claims_options={'iss': {'values': [metadata['issuer']]}},
+                claims_params={
+                    'nonce': request_.session.pop(self._nonce_key, None),
+                    'client_id': self.client_id,
+                    'access_token': token.get('access_token'),
+                },
+            )
+            claims.validate(leeway=OAUTH_LEEWAY_SECONDS)
+        except (JoseError, ValueError) as exc:
+            raise OAuthError(f'Invalid id_token: {exc}') from exc
+        return dict(claims)
+
+
+class FacebookProvider(OAuthProvider):
+    """Facebook login, user data from Graph /me"""
+
+    async def endpoints(self) -> typing.Tuple[str, str]:
+        return FACEBOOK_AUTHORIZE_URL, FACEBOOK_TOKEN_URL
+
+    async def user_info(self, request_, token: dict) -> dict:
+        response = await request(
+            'GET',
+            f'{FACEBOOK_GRAPH_URL}me',
+            params={
+                'fields': 'name,email,picture',
+                'access_token': token.get('access_token', ''),
+            },
+        )
+        if response.status_code != 200:
+            raise OAuthError(f'Graph me {response.status_code}')
+        return json_body(response, 'Graph me')
+
+
+google = OIDCProvider(
+    name='google',
+    discovery_url=GOOGLE_DISCOVERY_URL,
+    client_id=config.get('GOOGLE_CLIENT_ID', default=''),
+    client_secret=config.get('GOOGLE_CLIENT_SECRET', default=''),
+    scope='openid email profile',
+)
+facebook = FacebookProvider(
+    name='facebook',
+    client_id=config.get('FACEBOOK_CLIENT_ID', default=''),
+    client_secret=config.get('FACEBOOK_CLIENT_SECRET', default=''),
+    scope='email public_profile',
+)
+
+
+class MetadataRefresher:
+    """Refresh OIDC discovery and JWKS in background"""
+
+    def __init__(self, providers: typing.List[OIDCProvider], interval: float):
+        self.providers = providers
+        self.interval = interval
+        self._task = None
+
+    async def _run(self):
+        """Background loop, a failed refresh keeps the cached documents"""
+        while True:
+            for provider in self.providers:
+                try:
+                    await provider.refresh()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception(f'oauth {provider.name} refresh fail')
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """Start background task for providers with a client id"""
+        self.providers = [
+            provider for provider in self.providers if provider.client_id
+        ]
+        if self._task is None and self.providers:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop background task"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+metadata_refresher = MetadataRefresher([google], OAUTH_REFRESH_SECONDS)
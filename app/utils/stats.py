@@ -0,0 +1,99 @@
+"""
+In-process counters and latency histograms
+Examples:
+    histogram = Histogram()
+    histogram.observe(0.012)
+    histogram.snapshot()
+"""
+import bisect
+import threading
+import typing
+
+# seconds
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Counter:
+    """Thread-safe counter"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        """Increase counter by amount"""
+        with self._lock:
+            self.value += amount
+
+
+class Histogram:
+    """Thread-safe histogram with fixed buckets"""
+
+    def __init__(self, buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        """Record a value"""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q: float) -> typing.Optional[float]:
+        """
+        Estimate quantile by bucket upper bound
+        Returns:
+            upper bound of the bucket or None if nothing observed
+        """
+        with self._lock:
+            counts = list(self._counts)
+            total = self.count
+            max_ = self.max
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if seen >= rank:
+                if index < len(self.buckets):
+                    return min(self.buckets[index], max_)
+                return max_
+        return max_
+
+    def snapshot(self) -> dict:
+        """
+        Returns:
+            dict of count, sum, max, cumulative buckets and percentiles
+        """
+        with self._lock:
+            counts = list(self._counts)
+            total = self.count
+            sum_ = self.sum
+            max_ = self.max
+        cumulative = {}
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            cumulative[str(bound)] = seen
+        cumulative['+Inf'] = total
+        return {
+            'count': total,
+            'sum': round(sum_, 6),
+            'max': round(max_, 6),
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'buckets': cumulative,
+        }
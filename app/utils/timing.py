@@ -0,0 +1,194 @@
+"""
+Per-request timing spans reported with the Server-Timing header
+Examples:
+    with timing.span('hash'):
+        ...
+    timing.add('db', seconds)
+
+TimingMiddleware starts a RequestTimer for every http request, code called
+outside a request (background tasks, command line) adds to nothing
+A sample of requests and every slow request is logged with its spans
+The header is on by default and never has the hash spans, their duration
+tells a login of a known email from an unknown one
+"""
+import contextvars
+import random
+import threading
+import time
+import typing
+
+from config import config
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from utils.log import logger
+
+TIMING_HEADER = config.get('TIMING_HEADER', cast=bool, default=True)
+# logged, never sent to clients
+PRIVATE_SPANS = frozenset(('hash', 'hash_queue'))
+TIMING_LOG_SAMPLE_RATE = config.get(
+    'TIMING_LOG_SAMPLE_RATE', cast=float, default=0.01
+)
+TIMING_SLOW_SECONDS = config.get(
+    'TIMING_SLOW_SECONDS', cast=float, default=1.0
+)
+
+_timer: contextvars.ContextVar = contextvars.ContextVar('timer', default=None)
+
+
+class RequestTimer:
+    """Total seconds and count per span name of one request"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.spans: typing.Dict[str, typing.List[float]] = {}
+        # db spans are added from db_executor threads
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        """Add one span"""
+        with self._lock:
+            span_ = self.spans.get(name)
+            if span_ is None:
+                self.spans[name] = [seconds, 1]
+            else:
+                span_[0] += seconds
+                span_[1] += 1
+
+    def elapsed(self) -> float:
+        """Seconds since the request started"""
+        return time.perf_counter() - self.started_at
+
+    def header(self) -> str:
+        """
+        Returns:
+            Server-Timing value, durations in milliseconds
+            without PRIVATE_SPANS
+        """
+        with self._lock:
+            spans = list(self.spans.items())
+        items = [
+            f'{name};dur={seconds * 1000:.2f};desc="{count}"'
+            for name, (seconds, count) in spans
+            if name not in PRIVATE_SPANS
+        ]
+        items.append(f'total;dur={self.elapsed() * 1000:.2f}')
+        return ', '.join(items)
+
+    def as_dict(self) -> dict:
+        """
+        Returns:
+            {name: {'ms', 'count'}} for the log record
+        """
+        with self._lock:
+            return {
+                name: {'ms': round(seconds * 1000, 3), 'count': count}
+                for name, (seconds, count) in self.spans.items()
+            }
+
+
+def current() -> typing.Optional[RequestTimer]:
+    """RequestTimer of the running request or None"""
+    return _timer.get()
+
+
+def add(name: str, seconds: float):
+    """Add span to the running request if any"""
+    timer = _timer.get()
+    if timer is not None:
+        timer.add(name, seconds)
+
+
+class span:  # pylint: disable=invalid-name
+    """
+    Time the block as span name, works across await
+    Examples:
+        with span('http'):
+            await client.get(url)
+    """
+    __slots__ = ('name', 'timer', 'started_at')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.timer = None
+        self.started_at = 0.0
+
+    def __enter__(self):
+        self.timer = _timer.get()
+        if self.timer is not None:
+            self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.timer is not None:
+            self.timer.add(self.name, time.perf_counter() - self.started_at)
+
+
+def instrument_provider(provider):
+    """
+    Time every SQL Pony executes as span db
+    Args:
+        provider: db.provider after bind
+    """
+    execute = provider.execute
+    if getattr(execute, 'timed', False):
+        return
+
+    def timed_execute(cursor, sql, arguments=None, returning_id=False):
+        timer = _timer.get()
+        if timer is None:
+            return execute(cursor, sql, arguments, returning_id)
+        started_at = time.perf_counter()
+        try:
+            return execute(cursor, sql, arguments, returning_id)
+        finally:
+            timer.add('db', time.perf_counter() - started_at)
+
+    timed_execute.timed = True
+    provider.execute = timed_execute
+
+
+class TimingMiddleware:
+    """
+    Start RequestTimer, add Server-Timing to the response headers
+    and log a sample of requests with their spans
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        timer = RequestTimer()
+        token = _timer.set(timer)
+        status = None
+
+        async def send_with_timing(message: Message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                if TIMING_HEADER:
+                    headers = MutableHeaders(scope=message)
+                    headers.append('Server-Timing', timer.header())
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _timer.reset(token)
+            elapsed = timer.elapsed()
+            if (
+                    elapsed >= TIMING_SLOW_SECONDS or
+                    random.random() < TIMING_LOG_SAMPLE_RATE
+            ):
+                logger.bind(
+                    path=scope['path'],
+                    method=scope['method'],
+                    status=status,
+                    total_ms=round(elapsed * 1000, 3),
+                    spans=timer.as_dict(),
+                ).info(
+                    f'timing {scope["method"]} {scope["path"]} {status} '
+                    f'{elapsed * 1000:.1f}ms {timer.as_dict()}'
+                )